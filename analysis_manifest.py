@@ -0,0 +1,61 @@
+"""This script keeps a manifest of the PGN files analyzed by pgn_engine_vs_engine_eval_analyzer.py in its output
+directory. For each input PGN file it records the content hash, size, modification time, number of games and the
+settings of the run (analyzer version, WDL model, etc.), so that files that did not change since the last run can
+be skipped and their previous outputs reused.
+"""
+
+import hashlib
+import json
+import os
+
+MANIFEST_FILE_NAME = "analyzer_manifest.json"
+
+# Function to load the manifest of an output directory, or an empty one if there is none
+def load_manifest(output_dir):
+    manifest_path = os.path.join(output_dir, MANIFEST_FILE_NAME)
+    if not os.path.exists(manifest_path):
+        return {"files": {}}
+    try:
+        with open(manifest_path, 'r') as manifest_file:
+            return json.load(manifest_file)
+    except (ValueError, OSError) as e:
+        print(f"Ignoring unreadable manifest {manifest_path}: {e}")
+        return {"files": {}}
+
+# Function to save the manifest. It is written to a temporary file first, so an interrupted run never leaves a
+# truncated manifest behind.
+def save_manifest(output_dir, manifest):
+    manifest_path = os.path.join(output_dir, MANIFEST_FILE_NAME)
+    with open(manifest_path + ".tmp", 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=4)
+    os.replace(manifest_path + ".tmp", manifest_path)
+
+# Function to calculate the SHA-256 hash of a file
+def file_sha256(file_path):
+    sha256 = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+# Function to describe an input file for the manifest. The file is only hashed again if its size or modification
+# time differ from the previous entry.
+def describe_input_file(file_path, previous_entry=None):
+    stat = os.stat(file_path)
+    entry = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+    if previous_entry and previous_entry.get("size") == entry["size"] \
+            and previous_entry.get("mtime_ns") == entry["mtime_ns"] and previous_entry.get("sha256"):
+        entry["sha256"] = previous_entry["sha256"]
+    else:
+        entry["sha256"] = file_sha256(file_path)
+    return entry
+
+# Function to check if the outputs of a previous run can be reused: the content hash and the settings are the same
+# and the output files still exist. The modification time alone does not matter.
+def is_up_to_date(previous_entry, entry, output_paths):
+    if not previous_entry:
+        return False
+    for name, value in entry.items():
+        if name != "mtime_ns" and previous_entry.get(name) != value:
+            return False
+    return all(os.path.exists(output_path) for output_path in output_paths)
@@ -0,0 +1,163 @@
+"""This script computes the per-game stats of pgn_engine_vs_engine_eval_analyzer.py (GI, GPL, sGI, sGPL, STCPL and
+ACPL) for a batch of games at once with NumPy. The games are given as one flat array of evals (the concatenated
+pawns_lists) and an array of offsets, where the pawns_list of game g is pawns[offsets[g]:offsets[g + 1]].
+The results are the same as the ones of calculate_acpl, gi_and_gpl and calculate_engine_vs_engine_GI: the WDL
+values come from python-chess (through lookup tables per WDL model) and all sums are accumulated in the same order
+as in those functions.
+"""
+
+import functools
+import numpy as np
+from chess.engine import Cp
+
+# WDL models of python-chess (Cp.wdl). "sf" is the default of python-chess, the Stockfish models are evaluated at a
+# fixed ply and the lichess model does not depend on the ply.
+WDL_MODELS = ["sf", "sf16.1", "sf16", "sf15.1", "sf15", "sf14", "sf12", "lichess"]
+DEFAULT_WDL_MODEL = "sf"
+DEFAULT_WDL_PLY = 30
+
+# Mates are scored as +/-10000 centipawns by extract_eval_from_node. Every WDL model saturates well before that
+# (below 1000 centipawns), so larger values are clamped to the tables without changing the result.
+MAX_TABLE_CP = 10000
+
+RESULT_WHITE_WINS, RESULT_BLACK_WINS, RESULT_DRAW, RESULT_OTHER = 1, 2, 3, 0
+
+RESULT_CODES = {'1-0': RESULT_WHITE_WINS, '0-1': RESULT_BLACK_WINS, '1/2-1/2': RESULT_DRAW}
+
+# Function to build the tables of the expected points of White and Black for every centipawn value (from White's
+# perspective) between -MAX_TABLE_CP and MAX_TABLE_CP, for one of the WDL models of python-chess at a fixed ply.
+# The tables are built once per model and ply.
+@functools.lru_cache(maxsize=None)
+def expected_points_table(wdl_model=DEFAULT_WDL_MODEL, wdl_ply=DEFAULT_WDL_PLY):
+    wins = np.empty(2 * MAX_TABLE_CP + 1, dtype=np.int64)
+    draws = np.empty(2 * MAX_TABLE_CP + 1, dtype=np.int64)
+    losses = np.empty(2 * MAX_TABLE_CP + 1, dtype=np.int64)
+    for index, cp in enumerate(range(-MAX_TABLE_CP, MAX_TABLE_CP + 1)):
+        win_draw_loss = Cp(cp).wdl(model=wdl_model, ply=wdl_ply)
+        wins[index], draws[index], losses[index] = win_draw_loss.wins, win_draw_loss.draws, win_draw_loss.losses
+    win_prob, draw_prob, loss_prob = wins / 1000, draws / 1000, losses / 1000
+    expected_white = win_prob * 1 + draw_prob * 0.5
+    expected_black = loss_prob * 1 + draw_prob * 0.5
+    expected_white.flags.writeable = False
+    expected_black.flags.writeable = False
+    return expected_white, expected_black
+
+# Function to look up the expected points of White and Black for an array of centipawn values
+def expected_points(cps, wdl_model=DEFAULT_WDL_MODEL, wdl_ply=DEFAULT_WDL_PLY):
+    expected_white, expected_black = expected_points_table(wdl_model, wdl_ply)
+    index = np.clip(cps, -MAX_TABLE_CP, MAX_TABLE_CP) + MAX_TABLE_CP
+    return expected_white[index], expected_black[index]
+
+# Function to sum the values of each game in the order of the flat array, like a Python loop with +=
+def sum_by_game(game_index, values, mask, n_games):
+    return np.bincount(game_index[mask], weights=values[mask], minlength=n_games)
+
+# Function to calculate GI based on game result for arrays of games, as calculate_gi_by_result
+def calculate_gi_by_result(white_gpl, black_gpl, result_codes, postmove_exp_white, postmove_exp_black):
+    white_gi = np.select([result_codes == RESULT_DRAW, result_codes == RESULT_WHITE_WINS, result_codes == RESULT_BLACK_WINS],
+                         [0.5 - white_gpl, 1 - white_gpl, -white_gpl], postmove_exp_white - white_gpl)
+    black_gi = np.select([result_codes == RESULT_DRAW, result_codes == RESULT_WHITE_WINS, result_codes == RESULT_BLACK_WINS],
+                         [0.5 - black_gpl, -black_gpl, 1 - black_gpl], postmove_exp_black - black_gpl)
+    return white_gi, black_gi
+
+# Function to calculate the stats of a batch of games. Every pawns_list must hold at least one value, as built by
+# pawns_list_from_evals. Returns a dict of arrays with one value per game. With per_move=True it also returns a dict
+# of arrays with one value per move: the game index in the batch, the ply (1 for White's first move), whether it is a
+# White move, the evals before and after it, and its terms in the stats of the game: the centipawn loss (ACPL), the
+# expected-point loss (GPL) and the skipped loss in pawns and expected points (STCPL and sGPL; NaN for the last move
+# of a side that has no eval after the reply).
+def calculate_batch_stats(pawns, offsets, results, wdl_model=DEFAULT_WDL_MODEL, wdl_ply=DEFAULT_WDL_PLY,
+                          per_move=False):
+    pawns = np.asarray(pawns, dtype=np.float64)
+    offsets = np.asarray(offsets, dtype=np.int64)
+    result_codes = np.array([RESULT_CODES.get(result, RESULT_OTHER) for result in results], dtype=np.int64)
+    n_games = len(offsets) - 1
+    lengths = np.diff(offsets)
+    game_index = np.repeat(np.arange(n_games), lengths)
+    # Index of each value within its pawns_list
+    ply = np.arange(len(pawns)) - offsets[game_index]
+    game_length = lengths[game_index]
+    last = offsets[1:] - 1
+
+    cps = np.trunc(100 * pawns).astype(np.int64)
+    expected_white, expected_black = expected_points(cps, wdl_model, wdl_ply)
+    flat_index = np.arange(len(pawns))
+    previous = np.maximum(flat_index - 1, 0)
+    odd = ply % 2 == 1
+    even = ~odd
+
+    # ACPL, as calculate_acpl
+    centipawn_loss = np.zeros(len(pawns))
+    centipawn_loss[1:] = 100 * (pawns[1:] - pawns[:-1])
+    white_acpl_mask = odd
+    black_acpl_mask = even & (ply > 0)
+    white_loss_count = np.bincount(game_index[white_acpl_mask], minlength=n_games)
+    black_loss_count = np.bincount(game_index[black_acpl_mask], minlength=n_games)
+    white_loss_sum = sum_by_game(game_index, -centipawn_loss, white_acpl_mask, n_games)
+    black_loss_sum = sum_by_game(game_index, centipawn_loss, black_acpl_mask, n_games)
+    white_acpl = np.divide(white_loss_sum, white_loss_count, out=np.zeros(n_games), where=white_loss_count > 0)
+    black_acpl = np.divide(black_loss_sum, black_loss_count, out=np.zeros(n_games), where=black_loss_count > 0)
+
+    # GI and GPL, as gi_and_gpl. The eval before the first move is the eval after it (pawns_list[1]).
+    premove = np.where(ply == 0, np.minimum(flat_index + 1, offsets[1:][game_index] - 1), previous)
+    white_gpl = sum_by_game(game_index, expected_black - expected_black[premove], odd, n_games)
+    black_gpl = sum_by_game(game_index, expected_black[premove] - expected_black, even, n_games)
+    white_move_number = lengths // 2
+    black_move_number = (lengths + 1) // 2 - 1
+    # The expected values after the last move depend on whose turn it was in gi_and_gpl
+    last_is_white = (lengths - 1) % 2 == 0
+    postmove_exp_white = np.where(last_is_white, expected_white[last], expected_black[last])
+    postmove_exp_black = np.where(last_is_white, expected_black[last], expected_white[last])
+    white_gi, black_gi = calculate_gi_by_result(white_gpl, black_gpl, result_codes, postmove_exp_white, postmove_exp_black)
+
+    # Skipped stats, as calculate_engine_vs_engine_GI. A White move at index i is scored between the values at
+    # i - 1 and i + 1, and a Black move at index i + 1 between the values at i and i + 2, for odd i.
+    following = np.minimum(flat_index + 1, len(pawns) - 1)
+    after_next = np.minimum(flat_index + 2, len(pawns) - 1)
+    white_mask = odd & (ply < game_length - 1)
+    white_sgpl_mask = white_mask & (ply > 1)
+    black_mask = odd & (ply + 2 < game_length)
+    white_scpl = np.where(ply == 1, 0.0, pawns[previous] - pawns[following])
+    black_scpl = pawns[after_next] - pawns
+    white_stcpl = sum_by_game(game_index, white_scpl, white_mask, n_games)
+    black_stcpl = sum_by_game(game_index, black_scpl, black_mask, n_games)
+    white_sgpl = sum_by_game(game_index, expected_white[previous] - expected_white[following], white_sgpl_mask, n_games)
+    black_sgpl = sum_by_game(game_index, expected_black - expected_black[after_next], black_mask, n_games)
+    white_sgi, black_sgi = calculate_gi_by_result(white_sgpl, black_sgpl, result_codes, expected_white[last], expected_black[last])
+
+    stats = {
+        "white_sgi": white_sgi, "black_sgi": black_sgi,
+        "white_sgpl": white_sgpl, "black_sgpl": black_sgpl,
+        "white_stcpl": white_stcpl, "black_stcpl": black_stcpl,
+        "white_gi": white_gi, "black_gi": black_gi,
+        "white_gpl": white_gpl, "black_gpl": black_gpl,
+        "white_acpl": white_acpl, "black_acpl": black_acpl,
+        "white_move_number": white_move_number, "black_move_number": black_move_number,
+    }
+    if not per_move:
+        return stats
+
+    # The terms of each move, summed above into the stats of the games. The skipped terms of a Black move at index
+    # i + 1 are at index i in the arrays above.
+    move = ply > 0
+    black_skipped = np.maximum(flat_index - 1, 0)
+    white_skipped_sgpl = np.where(ply == 1, 0.0, expected_white[previous] - expected_white[following])
+    black_skipped_sgpl = expected_black - expected_black[after_next]
+    moves = {
+        "game": game_index[move], "ply": ply[move], "white": odd[move],
+        "eval_before": pawns[previous][move], "eval_after": pawns[move],
+        "cpl": np.where(odd, -centipawn_loss, centipawn_loss)[move],
+        "gpl": np.where(odd, expected_black - expected_black[premove], expected_black[premove] - expected_black)[move],
+        "scpl": np.where(odd, np.where(white_mask, white_scpl, np.nan),
+                         np.where(black_mask[black_skipped], black_scpl[black_skipped], np.nan))[move],
+        "sgpl": np.where(odd, np.where(white_mask, white_skipped_sgpl, np.nan),
+                         np.where(black_mask[black_skipped], black_skipped_sgpl[black_skipped], np.nan))[move],
+    }
+    return stats, moves
+
+# Function to build the flat array of evals and the offsets from a list of pawns_lists
+def flatten_pawns_lists(pawns_lists):
+    offsets = np.zeros(len(pawns_lists) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(pawns_list) for pawns_list in pawns_lists])
+    pawns = np.fromiter((value for pawns_list in pawns_lists for value in pawns_list), dtype=np.float64, count=offsets[-1])
+    return pawns, offsets
@@ -4,14 +4,22 @@ containing the following statistics:
 - Average and median of the merged white and black columns
 - Total number of moves
 - Total number of games
-It also outputs a density distribution plot for each merged column.
+It also outputs a density distribution plot for each merged column. With --headless the densities are estimated from
+binned histograms with NumPy (FFT-based Gaussian smoothing instead of a KDE over every value), the plots are rendered
+in parallel with the Agg backend and saved, and the binned densities are saved to density_distributions.csv.
 """
 import pandas as pd
+import numpy as np
+import matplotlib
 import matplotlib.pyplot as plt
 import seaborn as sns
-import sys
+import argparse
 import os
 import glob
+from concurrent.futures import ProcessPoolExecutor
+
+# Number of bins of the density estimates of --headless
+DENSITY_BINS = 512
 
 def combine_csv_files(input_dir, output_filename='combined.csv'):
     csv_files = glob.glob(os.path.join(input_dir, '*.csv'))
@@ -26,10 +34,13 @@ def combine_csv_files(input_dir, output_filename='combined.csv'):
     print(f"Combined CSV created at {output_path}")
     return output_path
 
-def calculate_statistics(csv_input_file, output_directory):
+def calculate_statistics(csv_input_file, output_directory, headless=False, workers=None):
     # Reading the CSV file
     df = pd.read_csv(csv_input_file)
+    summarize_games(df, output_directory, headless, workers)
 
+# Function to calculate and save the statistics of a DataFrame of games, e.g. one that is already in memory
+def summarize_games(df, output_directory, headless=False, workers=None, mp_context=None):
     # Calculating the total number of games
     total_games = len(df)
 
@@ -58,18 +69,12 @@ def calculate_statistics(csv_input_file, output_directory):
     # Calculating the total sum of moves
     total_moves = df['white_move_number'].sum() + df['black_move_number'].sum()
 
-    # Preparing the DataFrame for CSV output
-    result_data = {
-        'Metric': cols_to_analyze + merge_cols + ['total_move_number', 'total_games'],
-        'Average': averages.tolist() + list(overall_averages.values()) + [None, None],
-        'Median': medians.tolist() + list(overall_medians.values()) + [None, None],
-        'Total Moves': [None] * (len(cols_to_analyze) + len(merge_cols)) + [total_moves, None],
-        'Total Games': [None] * (len(cols_to_analyze) + len(merge_cols)) + [None, total_games]
-    }
+    save_summary(output_directory, cols_to_analyze, averages.tolist(), medians.tolist(), merge_cols, overall_averages,
+                 overall_medians, total_moves, total_games)
 
-    output_df = pd.DataFrame(result_data)
-    output_csv_file = f"{output_directory}/summarized_game_data.csv"
-    output_df.to_csv(output_csv_file, index=False)
+    if headless:
+        save_density_distributions(merged_data, overall_averages, output_directory, workers, mp_context)
+        return
 
     # Graphing the density distribution of merged data and showing averages
     for col in merge_cols:
@@ -83,22 +88,99 @@ def calculate_statistics(csv_input_file, output_directory):
         # plt.savefig(plot_file)
         plt.show()
 
+# Function to estimate the density of a series on DENSITY_BINS bins: the histogram of the values and a Gaussian KDE
+# computed by convolving the histogram with the kernel via FFT. The bandwidth follows Scott's rule and the grid extends
+# 3 bandwidths beyond the data, as in sns.kdeplot.
+def estimate_density(values, bins=DENSITY_BINS):
+    values = np.asarray(values, dtype=float)
+    values = values[np.isfinite(values)]
+    if len(values) < 2:
+        return pd.DataFrame(columns=['bin_start', 'bin_end', 'bin_center', 'count', 'histogram_density',
+                                     'kde_density'])
+    bandwidth = values.std(ddof=1) * len(values) ** (-1 / 5)
+    if bandwidth == 0:
+        bandwidth = 1e-3 * max(abs(values[0]), 1)
+    low, high = values.min() - 3 * bandwidth, values.max() + 3 * bandwidth
+    counts, edges = np.histogram(values, bins=bins, range=(low, high))
+    width = edges[1] - edges[0]
+    # Gaussian kernel sampled on the bin grid, zero-padded so the convolution does not wrap around
+    offsets = np.arange(-bins + 1, bins) * width
+    kernel = np.exp(-0.5 * (offsets / bandwidth) ** 2)
+    kernel /= kernel.sum()
+    size = 1 << int(np.ceil(np.log2(len(counts) + len(kernel) - 1)))
+    smoothed = np.fft.irfft(np.fft.rfft(counts, size) * np.fft.rfft(kernel, size), size)[bins - 1:2 * bins - 1]
+    return pd.DataFrame({
+        'bin_start': edges[:-1],
+        'bin_end': edges[1:],
+        'bin_center': (edges[:-1] + edges[1:]) / 2,
+        'count': counts,
+        'histogram_density': counts / (len(values) * width),
+        'kde_density': np.clip(smoothed, 0, None) / (len(values) * width)
+    })
+
+# Function to render the density plot of a merged column with the Agg backend. Runs in worker processes.
+def render_density_plot(task):
+    col, density, average, plot_file = task
+    matplotlib.use('Agg')
+    fig, ax = plt.subplots()
+    ax.bar(density['bin_center'], density['histogram_density'], width=density['bin_end'] - density['bin_start'],
+           alpha=0.3)
+    ax.fill_between(density['bin_center'], density['kde_density'], alpha=0.5)
+    ax.axvline(average, color='r', linestyle='--')
+    ax.set_title(f'Density Distribution of {col.upper()} (Avg: {average:.2f})')
+    ax.set_xlabel(col)
+    ax.set_ylabel('Density')
+    fig.savefig(plot_file)
+    plt.close(fig)
+    return plot_file
+
+# Function to save the density plots of the merged columns and their binned densities without showing them
+def save_density_distributions(merged_data, overall_averages, output_directory, workers=None, mp_context=None):
+    densities = {col: estimate_density(values) for col, values in merged_data.items()}
+    tasks = [(col, density, overall_averages[col], f"{output_directory}/{col}_density_distribution.png")
+             for col, density in densities.items()]
+    with ProcessPoolExecutor(max_workers=workers, mp_context=mp_context) as executor:
+        for plot_file in executor.map(render_density_plot, tasks):
+            print(f"Plot saved to {plot_file}")
+    density_file = f"{output_directory}/density_distributions.csv"
+    pd.concat([density.assign(Metric=col) for col, density in densities.items()], ignore_index=True)[
+        ['Metric', 'bin_start', 'bin_end', 'bin_center', 'count', 'histogram_density', 'kde_density']
+    ].to_csv(density_file, index=False)
+    print(f"Densities saved to {density_file}")
+
+# Function to save the averages and medians of the columns, of the merged white and black columns and the totals
+def save_summary(output_directory, cols_to_analyze, averages, medians, merge_cols, overall_averages, overall_medians,
+                 total_moves, total_games):
+    # Preparing the DataFrame for CSV output
+    result_data = {
+        'Metric': cols_to_analyze + merge_cols + ['total_move_number', 'total_games'],
+        'Average': averages + list(overall_averages.values()) + [None, None],
+        'Median': medians + list(overall_medians.values()) + [None, None],
+        'Total Moves': [None] * (len(cols_to_analyze) + len(merge_cols)) + [total_moves, None],
+        'Total Games': [None] * (len(cols_to_analyze) + len(merge_cols)) + [None, total_games]
+    }
 
-def main(input_csv_path, output_directory):
+    output_df = pd.DataFrame(result_data)
+    output_csv_file = f"{output_directory}/summarized_game_data.csv"
+    output_df.to_csv(output_csv_file, index=False)
+
+def main(input_csv_path, output_directory, headless=False, workers=None):
     # Ensure the output directory exists
     if not os.path.exists(output_directory):
         os.makedirs(output_directory)
 
-    calculate_statistics(input_csv_path, output_directory)
+    calculate_statistics(input_csv_path, output_directory, headless, workers)
 
 if __name__ == "__main__":
     # If multiple CSVs: 
     # input_dir = ""
     # csv_all_games_path = combine_csv_files(input_dir, output_filename='combined.csv')
-    if len(sys.argv) < 3:
-        print("Usage: python chess_stats_summarizer.py <input_csv_path> <output_directory>")
-        sys.exit(1)
-
-    input_csv_path = sys.argv[1]
-    output_directory = sys.argv[2]
-    main(input_csv_path, output_directory)
+    parser = argparse.ArgumentParser(usage="python chess_stats_summarizer.py <input_csv_path> <output_directory> [--headless [--workers N]]")
+    parser.add_argument("input_csv_path")
+    parser.add_argument("output_directory")
+    parser.add_argument("--headless", action="store_true",
+                        help="save the density plots and binned densities instead of showing KDE plots")
+    parser.add_argument("--workers", type=int, help="number of plots rendered in parallel with --headless")
+    args = parser.parse_args()
+
+    main(args.input_csv_path, args.output_directory, args.headless, args.workers)
@@ -0,0 +1,175 @@
+"""This script writes the per-game stats of pgn_engine_vs_engine_eval_analyzer.py as typed columnar files instead
+of JSON: Parquet, or Arrow IPC files that can be memory-mapped by the next stages. Engine names and events are
+dictionary-encoded, stats are float64 and move numbers and Elos are integers. pyarrow is required for both formats.
+The per-move terms of the stats can also be written, as a dataset partitioned by source PGN file.
+"""
+
+import os
+import numpy as np
+try:
+    import pyarrow as pa
+    # Loads the pa.ipc submodule, which pyarrow does not import by itself
+    import pyarrow.ipc  # noqa: F401
+except ImportError:
+    pa = None
+try:
+    import pyarrow.parquet as pq
+except ImportError:
+    pq = None
+
+OUTPUT_FORMATS = ["json", "jsonl", "parquet", "arrow"]
+
+OUTPUT_EXTENSIONS = {"json": ".json", "jsonl": ".jsonl", "parquet": ".parquet", "arrow": ".arrow"}
+
+METRIC_COLUMNS = ["white_sgi", "black_sgi", "white_sgpl", "black_sgpl", "white_stcpl", "black_stcpl",
+                  "white_gi", "black_gi", "white_gpl", "black_gpl", "white_acpl", "black_acpl"]
+
+MOVE_NUMBER_COLUMNS = ["white_move_number", "black_move_number"]
+
+MOVES_FORMATS = ["parquet", "arrow"]
+
+# Columns of the per-move dataset after the game key, the ply and the side to move, as returned by
+# batch_metrics.calculate_batch_stats with per_move=True
+MOVE_COLUMNS = ["eval_before", "eval_after", "cpl", "gpl", "scpl", "sgpl"]
+
+SIDES = ["White", "Black"]
+
+NAME_COLUMNS = ["White", "Black", "Event", "Site"]
+
+# Function to build the schema of the columnar files. The columns are in the same order as the keys of the games
+# in the JSON files, after the game key.
+def get_game_schema():
+    name_type = pa.dictionary(pa.int32(), pa.string())
+    return pa.schema(
+        [("key", pa.int64())]
+        + [(column, pa.float64()) for column in METRIC_COLUMNS]
+        + [(column, pa.int32()) for column in MOVE_NUMBER_COLUMNS]
+        + [("White", name_type), ("Black", name_type), ("Event", name_type), ("Site", name_type),
+           ("Round", pa.string()), ("WhiteElo", pa.int32()), ("BlackElo", pa.int32()),
+           ("WhiteResult", pa.float64()), ("BlackResult", pa.float64()), ("Date", pa.string())]
+    )
+
+# Function to check that the output format can be written. Falls back to Arrow IPC if pyarrow has no Parquet support.
+def resolve_output_format(output_format):
+    if output_format in ("json", "jsonl"):
+        return output_format
+    if pa is None:
+        raise ImportError(f"pyarrow is required to write {output_format} files, install it with: pip install pyarrow")
+    if output_format == "parquet" and pq is None:
+        print("pyarrow was built without Parquet support, writing Arrow IPC files instead")
+        return "arrow"
+    return output_format
+
+# Function to parse an Elo header, which is not always a number
+def parse_elo(elo):
+    try:
+        return int(elo)
+    except (TypeError, ValueError):
+        return None
+
+# Function to dictionary-encode the values of a name column against the dictionary of the batches already written to
+# a file, which is extended with the new values. Arrow IPC files only accept one dictionary per column, extended with
+# deltas, so the batches of a file must share it.
+def encode_names(values, dictionary):
+    indices = [None if value is None else dictionary.setdefault(value, len(dictionary)) for value in values]
+    return pa.DictionaryArray.from_arrays(pa.array(indices, pa.int32()), pa.array(list(dictionary), pa.string()))
+
+# Function to convert a batch of games (dicts as written to the JSON files) with consecutive keys to a table. When
+# the batches are written to the same file, dictionaries (one per name column, empty at first) is shared by them.
+def games_to_table(first_key, games_data, dictionaries=None):
+    schema = get_game_schema()
+    columns = [pa.array(range(first_key, first_key + len(games_data)), pa.int64())]
+    for field in schema:
+        if field.name == "key":
+            continue
+        values = [game_data[field.name] for game_data in games_data]
+        if field.name in NAME_COLUMNS and dictionaries is not None:
+            columns.append(encode_names(values, dictionaries.setdefault(field.name, {})))
+            continue
+        if field.name in NAME_COLUMNS:
+            columns.append(pa.array(values, pa.string()).dictionary_encode())
+            continue
+        if field.name in ("WhiteElo", "BlackElo"):
+            values = [parse_elo(value) for value in values]
+        elif field.name in ("WhiteResult", "BlackResult"):
+            # Unfinished games have '...' as result
+            values = [value if value != '...' else None for value in values]
+        columns.append(pa.array(values, field.type))
+    return pa.Table.from_arrays(columns, schema=schema)
+
+def get_move_schema():
+    return pa.schema([("key", pa.int64()), ("ply", pa.int32()), ("side", pa.dictionary(pa.int8(), pa.string()))]
+                     + [(column, pa.float64()) for column in MOVE_COLUMNS])
+
+# Function to convert the per-move arrays of a batch of games to a table, where the game with index 0 in the batch
+# has the key first_key. Missing skipped losses (NaN) are written as nulls.
+def moves_to_table(first_key, moves):
+    sides = pa.DictionaryArray.from_arrays(pa.array(np.where(moves["white"], 0, 1).astype(np.int8)),
+                                           pa.array(SIDES, pa.string()))
+    columns = [pa.array(first_key + moves["game"], pa.int64()), pa.array(moves["ply"], pa.int32()), sides]
+    columns += [pa.array(moves[column], pa.float64(), from_pandas=True) for column in MOVE_COLUMNS]
+    return pa.Table.from_arrays(columns, schema=get_move_schema())
+
+# Function to get the path of the per-move file of a PGN file in the dataset, partitioned by source file
+# (moves_dir/source_file=<name>/moves.parquet), so it can be read with pyarrow.dataset and hive partitioning
+def get_moves_path(moves_dir, pgn_file_path, moves_format):
+    return os.path.join(moves_dir, f"source_file={os.path.basename(pgn_file_path)}",
+                        "moves" + OUTPUT_EXTENSIONS[moves_format])
+
+# Function to open a writer for the per-move file of a PGN file. Each batch of games is written as a row group (or
+# record batch), so the moves of a file are never all in memory.
+def open_moves_writer(moves_path, moves_format):
+    os.makedirs(os.path.dirname(moves_path), exist_ok=True)
+    if moves_format == "parquet":
+        return pq.ParquetWriter(moves_path, get_move_schema())
+    return pa.ipc.new_file(moves_path, get_move_schema())
+
+# Function to open a writer for a columnar file. The writer has write_table(table) and close() methods.
+def open_columnar_writer(output_path, output_format):
+    if output_format == "parquet":
+        return pq.ParquetWriter(output_path, get_game_schema())
+    return pa.ipc.new_file(output_path, get_game_schema(), options=pa.ipc.IpcWriteOptions(emit_dictionary_deltas=True))
+
+# Function to read a columnar file into a DataFrame with the same columns as the games in the JSON files
+def read_columnar_games(file_path):
+    if file_path.endswith(".parquet"):
+        return table_to_games_frame(pq.read_table(file_path, memory_map=True))
+    with pa.memory_map(file_path) as source:
+        return table_to_games_frame(pa.ipc.open_file(source).read_all())
+
+# Function to iterate over the games of a columnar file in batches of at most batch_rows games, as dicts with the
+# same values as the games in the JSON files
+def iter_columnar_games(file_path, batch_rows):
+    if file_path.endswith(".parquet"):
+        for batch in pq.ParquetFile(file_path, memory_map=True).iter_batches(batch_size=batch_rows):
+            yield batch_to_games(batch)
+        return
+    with pa.memory_map(file_path) as source:
+        reader = pa.ipc.open_file(source)
+        for index in range(reader.num_record_batches):
+            batch = reader.get_batch(index)
+            for start in range(0, batch.num_rows, batch_rows):
+                yield batch_to_games(batch.slice(start, batch_rows))
+
+def batch_to_games(batch):
+    games_data = batch.to_pylist()
+    for game_data in games_data:
+        del game_data["key"]
+        game_data["WhiteResult"] = json_result(game_data["WhiteResult"])
+        game_data["BlackResult"] = json_result(game_data["BlackResult"])
+    return games_data
+
+def table_to_games_frame(table):
+    table = table.select([name for name in table.column_names if name != "key"])
+    df = table.to_pandas(integer_object_nulls=True)
+    # Results are written to the JSON files as 1, 0, 0.5 or '...'
+    for column in ("WhiteResult", "BlackResult"):
+        if column in df.columns:
+            df[column] = df[column].astype(object).map(json_result)
+    return df
+
+# Function to convert a result read from a columnar file back to its value in the JSON files
+def json_result(value):
+    if value is None or value != value:
+        return '...'
+    return int(value) if value.is_integer() else value
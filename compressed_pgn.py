@@ -0,0 +1,60 @@
+"""This script opens PGN files that are compressed (.pgn.gz, .pgn.bz2, .pgn.xz or .pgn.zst), as CCRL distributes them,
+as streams, so that eval_corrector_ccrl.py, the analyzer and split_large_pgn.py read them without decompressing them to
+disk first. Plain .pgn files are opened as usual. Compressed files cannot be seeked into, so they are read from start
+to end: they are not split into shards and have no game index.
+.zst files require the zstd module of the standard library (Python 3.14+) or zstandard (pip install zstandard).
+"""
+
+import bz2
+import gzip
+import io
+import lzma
+
+COMPRESSED_EXTENSIONS = ['.gz', '.bz2', '.xz', '.zst']
+
+PGN_EXTENSIONS = ['.pgn'] + ['.pgn' + extension for extension in COMPRESSED_EXTENSIONS]
+
+# Function to check whether a file name is a PGN file, compressed or not
+def is_pgn_file(file_name):
+    return file_name.endswith(tuple(PGN_EXTENSIONS))
+
+# Function to check whether a file is compressed
+def is_compressed(file_path):
+    return file_path.endswith(tuple(COMPRESSED_EXTENSIONS))
+
+# Function to remove the compression extension of a file name, e.g. games.pgn.gz -> games.pgn
+def strip_compression_extension(file_name):
+    for extension in COMPRESSED_EXTENSIONS:
+        if file_name.endswith(extension):
+            return file_name[:-len(extension)]
+    return file_name
+
+# Function to open a .zst file as a binary stream
+def open_zstd(file_path):
+    try:
+        from compression import zstd
+        return zstd.open(file_path, 'rb')
+    except ImportError:
+        pass
+    try:
+        import zstandard
+    except ImportError:
+        raise ImportError("zstandard is required to read .zst files, install it with: pip install zstandard")
+    return io.BufferedReader(zstandard.open(file_path, 'rb'))
+
+# Function to open a PGN file for reading, decompressing it on the fly if it is compressed. The mode is 'rb' (bytes)
+# or 'r' (text, with the encoding and errors of open).
+def open_pgn(file_path, mode='rb', encoding=None, errors=None):
+    if not is_compressed(file_path):
+        return open(file_path, mode, encoding=encoding, errors=errors)
+    if file_path.endswith('.gz'):
+        stream = gzip.open(file_path, 'rb')
+    elif file_path.endswith('.bz2'):
+        stream = bz2.open(file_path, 'rb')
+    elif file_path.endswith('.xz'):
+        stream = lzma.open(file_path, 'rb')
+    else:
+        stream = open_zstd(file_path)
+    if 'b' in mode:
+        return stream
+    return io.TextIOWrapper(stream, encoding=encoding, errors=errors)
@@ -1,11 +1,28 @@
 """This script analyzes chess game data, calculates various statistics (including sums, medians, and averages), 
 and generates a final DataFrame with player statistics, sorted by the average gi score in descending order.
+Optionally, bootstrap confidence intervals of avg_sgi, avg_sgpl and avg_stcpl are added for each player.
 """
 
 import pandas as pd
+import numpy as np
 import os
 import glob
-import sys
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+STATS = ['sgi', 'sgpl', 'stcpl', 'gi', 'gpl', 'acpl']
+
+# Stats whose averages get bootstrap confidence intervals
+BOOTSTRAP_STATS = ['sgi', 'sgpl', 'stcpl']
+
+# Maximum number of games of the players that are bootstrapped together in a task, of values drawn at a time and of
+# resampled means kept by a task (resamples x players x stats, 32 MB of floats)
+BOOTSTRAP_CHUNK_GAMES = 4096
+BOOTSTRAP_DRAWS = 1 << 22
+BOOTSTRAP_MEANS = 1 << 22
+
+# Columns of the all-games CSV that are needed for the player stats
+PLAYER_STATS_COLUMNS = ['White', 'Black'] + [f'{color}_{stat}' for color in ['white', 'black'] for stat in STATS + ['move_number']]
 
 def combine_csv_files(input_dir, output_filename='combined.csv'):
     csv_files = glob.glob(os.path.join(input_dir, '*.csv'))
@@ -21,48 +38,123 @@ def combine_csv_files(input_dir, output_filename='combined.csv'):
     return output_path
 
 # Functions
-def read_csv(file_path):
-    return pd.read_csv(file_path)
+def read_csv(file_path, usecols=None):
+    return pd.read_csv(file_path, usecols=usecols)
 
 def check_dataframe(df, df_name):
     print(f"Columns in {df_name}: {df.columns}")
 
-def calculate_sum(df, group_col, value_col, prefix):
-    sums = df.groupby(group_col).agg({value_col: 'sum'}).reset_index()
-    sums.columns = ['Player', f'{prefix}_sum']
-    return sums
-
-def calculate_games(df, player_col):
-    game_count = df[player_col].value_counts().reset_index()
-    game_count.columns = ['Player', f'{player_col}_games']
-    return game_count
-
-def calculate_total_games(white_games, black_games):
-    total_games = pd.merge(white_games, black_games, on='Player', how='outer').fillna(0)
-    total_games['total_game_count'] = total_games['White_games'] + total_games['Black_games']
-    return total_games
-
-def calculate_total_moves(df):
-    # Summing up the moves made by each player as White and Black
-    white_moves = calculate_sum(df, 'White', 'white_move_number', 'white_move')
-    black_moves = calculate_sum(df, 'Black', 'black_move_number', 'black_move')
-    total_moves = pd.merge(white_moves, black_moves, on='Player', how='outer').fillna(0)
-    total_moves['total_moves'] = total_moves['white_move_sum'] + total_moves['black_move_sum']
-    return total_moves[['Player', 'total_moves']]
-
-def calculate_statistics(df, value_col):
-    stats = df.groupby('Player').agg(median=(value_col, 'median'), 
-                                     var=(value_col, 'var'), 
-                                     std=(value_col, 'std')).reset_index()
-    return stats.rename(columns={'median': f'{value_col}_median', 
-                                 'var': f'{value_col}_var', 
-                                 'std': f'{value_col}_std'})
-
-def merge_dataframes(dfs, merge_on='Player'):
-    merged_df = dfs[0]
-    for df in dfs[1:]:
-        merged_df = pd.merge(merged_df, df, on=merge_on, how='outer').fillna(0)
-    return merged_df
+# Function to reshape the games to one row per player and game: the White rows of all games followed by the Black
+# rows. Players are replaced by their index in the sorted list of players and colors by 0 (White) or 1 (Black);
+# games without a player name are dropped.
+def games_by_player(df):
+    white_codes, white_players = pd.factorize(df['White'])
+    black_codes, black_players = pd.factorize(df['Black'])
+    players = pd.Index(white_players).union(pd.Index(black_players))
+    codes = np.concatenate([players.get_indexer(white_players)[white_codes], players.get_indexer(black_players)[black_codes]])
+    # Missing names have code -1 in pd.factorize
+    codes[np.concatenate([white_codes, black_codes]) < 0] = -1
+    games = pd.DataFrame({stat: np.concatenate([df[f'white_{stat}'].to_numpy(), df[f'black_{stat}'].to_numpy()])
+                          for stat in STATS + ['move_number']})
+    games['Player'] = codes
+    games['color'] = np.repeat(np.array([0, 1], dtype=np.int64), len(df))
+    if (codes < 0).any():
+        games = games[codes >= 0]
+    return games, players
+
+# Function to calculate the sums and game counts of each player by color and the median, variance and standard
+# deviation of each stat over all the games of a player, in one grouped pass each. Players who only played one
+# color get 0 for the other one.
+def aggregate_player_stats(df):
+    games, players = games_by_player(df)
+    by_color = games.groupby(games['Player'] * 2 + games['color'])
+    color_sums = by_color[STATS + ['move_number']].sum()
+    color_sums['games'] = by_color.size()
+    color_sums = color_sums.reindex(range(2 * len(players)))
+    white_sums = color_sums.iloc[0::2].reset_index(drop=True)
+    black_sums = color_sums.iloc[1::2].reset_index(drop=True)
+    player_stats = pd.DataFrame(index=range(len(players)))
+    for color, sums in [('white', white_sums), ('black', black_sums)]:
+        for stat in STATS:
+            player_stats[f'{color}_{stat}_sum'] = sums[stat]
+    player_stats['White_games'] = white_sums['games']
+    player_stats['Black_games'] = black_sums['games']
+    player_stats['white_move_sum'] = white_sums['move_number']
+    player_stats['black_move_sum'] = black_sums['move_number']
+    player_stats = player_stats.fillna(0)
+    player_stats['total_game_count'] = player_stats['White_games'] + player_stats['Black_games']
+    player_stats['total_moves'] = player_stats['white_move_sum'] + player_stats['black_move_sum']
+    for stat in STATS:
+        player_stats[f'total_{stat}_sum'] = player_stats[f'white_{stat}_sum'] + player_stats[f'black_{stat}_sum']
+
+    statistics = games.groupby('Player')[STATS].agg(['median', 'var', 'std'])
+    statistics.columns = [f'{stat}_{name}' for stat, name in statistics.columns]
+    player_stats = player_stats.join(statistics.fillna(0))
+    player_stats.insert(0, 'Player', players)
+    return player_stats
+
+# Function to calculate the bootstrap confidence intervals of the averages of a chunk of players. values holds one row
+# per stat with the games of the players in order, the games of player p starting at starts[p].
+# Every resample draws the games of all the players at once, and the means of each player are summed over its
+# slice of the drawn games with np.add.reduceat. Runs in worker processes.
+def bootstrap_chunk(task):
+    values, starts, n_resamples, seed, confidence = task
+    rng = np.random.default_rng(seed)
+    n_games = values.shape[1]
+    sizes = np.diff(np.append(starts, n_games))
+    # The first game and the number of games of the player of each drawn game
+    slot_starts = np.repeat(starts, sizes)
+    slot_sizes = np.repeat(sizes, sizes)
+    means = np.empty((n_resamples, len(starts), len(values)))
+    block = max(1, BOOTSTRAP_DRAWS // n_games)
+    for first in range(0, n_resamples, block):
+        n_block = min(block, n_resamples - first)
+        drawn = slot_starts + (rng.random((n_block, n_games)) * slot_sizes).astype(np.int64)
+        # The same games are drawn for every stat
+        for index, stat_values in enumerate(values):
+            sums = np.add.reduceat(np.take(stat_values, drawn), starts, axis=1)
+            means[first:first + n_block, :, index] = sums / sizes
+    alpha = (1 - confidence) / 2
+    return np.quantile(means, [alpha, 1 - alpha], axis=0)
+
+# Function to calculate bootstrap confidence intervals (percentile method) of avg_sgi, avg_sgpl and avg_stcpl of each
+# player, in the order of the players of aggregate_player_stats. The players are split into chunks of about
+# BOOTSTRAP_CHUNK_GAMES games, with at most as many players as keep the means of all their resamples within
+# BOOTSTRAP_MEANS, that are bootstrapped in a process pool; each chunk has its own random stream derived from the
+# seed, so the results only depend on the seed, the number of resamples and the games, not on the number of workers.
+def bootstrap_player_cis(df, n_resamples=10000, seed=0, confidence=0.95, workers=1, mp_context=None):
+    games, players = games_by_player(df)
+    order = np.argsort(games['Player'].to_numpy(), kind='stable')
+    # Missing values count as 0, as in the sums of the averages
+    values = np.ascontiguousarray(np.nan_to_num(games[BOOTSTRAP_STATS].to_numpy(dtype=np.float64)[order]).T)
+    sizes = np.bincount(games['Player'].to_numpy(), minlength=len(players))
+    starts = np.cumsum(sizes) - sizes
+    max_players = max(1, BOOTSTRAP_MEANS // (n_resamples * len(BOOTSTRAP_STATS)))
+    tasks = []
+    first = 0
+    while first < len(players):
+        last = first + 1
+        while last < len(players) and last - first < max_players and \
+                starts[last] + sizes[last] - starts[first] <= BOOTSTRAP_CHUNK_GAMES:
+            last += 1
+        tasks.append([values[:, starts[first]:starts[last - 1] + sizes[last - 1]], starts[first:last] - starts[first]])
+        first = last
+    seeds = np.random.SeedSequence(seed).spawn(len(tasks))
+    tasks = [(chunk_values, chunk_starts, n_resamples, chunk_seed, confidence)
+             for (chunk_values, chunk_starts), chunk_seed in zip(tasks, seeds)]
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers, mp_context=mp_context) as executor:
+            intervals = list(executor.map(bootstrap_chunk, tasks))
+    else:
+        intervals = list(map(bootstrap_chunk, tasks))
+    intervals = np.concatenate(intervals, axis=1) if intervals else np.empty((2, 0, len(BOOTSTRAP_STATS)))
+    cis = pd.DataFrame(index=range(len(players)))
+    for index, stat in enumerate(BOOTSTRAP_STATS):
+        cis[f'avg_{stat}_ci_low'] = intervals[0, :, index]
+        cis[f'avg_{stat}_ci_high'] = intervals[1, :, index]
+    cis['normalized_sgi_ci_low'] = 142.33 + 27.90 * cis['avg_sgi_ci_low']
+    cis['normalized_sgi_ci_high'] = 142.33 + 27.90 * cis['avg_sgi_ci_high']
+    return cis
 
 def calculate_averages(player_stats):
     player_stats['avg_sgi'] = player_stats['total_sgi_sum'] / player_stats['total_game_count']
@@ -89,60 +181,26 @@ def save_to_csv(df, file_path):
     df.to_csv(file_path, index=False)
 
 # Main Functionality
-def main(csv_all_games_path, player_stats_output_dir):
+def main(csv_all_games_path, player_stats_output_dir, bootstrap_resamples=0, bootstrap_seed=0, confidence=0.95,
+         workers=1):
     if not os.path.exists(csv_all_games_path):
         print(f"File not found: {csv_all_games_path}")
         return
-    df = read_csv(csv_all_games_path)
+    df = read_csv(csv_all_games_path, usecols=PLAYER_STATS_COLUMNS)
     # check_dataframe(df, "Initial DataFrame")
     #print("Columns in DataFrame:", df.columns)
-    # Calculating Sums
-    white_sgi_sum = calculate_sum(df, 'White', 'white_sgi', 'white_sgi')
-    black_sgi_sum = calculate_sum(df, 'Black', 'black_sgi', 'black_sgi')
-    white_sgpl_sum = calculate_sum(df, 'White', 'white_sgpl', 'white_sgpl')
-    black_sgpl_sum = calculate_sum(df, 'Black', 'black_sgpl', 'black_sgpl')
-    white_stcpl_sum = calculate_sum(df, 'White', 'white_stcpl', 'white_stcpl')
-    black_stcpl_sum = calculate_sum(df, 'Black', 'black_stcpl', 'black_stcpl')
-    white_gi_sum = calculate_sum(df, 'White', 'white_gi', 'white_gi')
-    black_gi_sum = calculate_sum(df, 'Black', 'black_gi', 'black_gi')
-    white_gpl_sum = calculate_sum(df, 'White', 'white_gpl', 'white_gpl')
-    black_gpl_sum = calculate_sum(df, 'Black', 'black_gpl', 'black_gpl')
-    white_acpl_sum = calculate_sum(df, 'White', 'white_acpl', 'white_acpl')
-    black_acpl_sum = calculate_sum(df, 'Black', 'black_acpl', 'black_acpl')
-
-    # Calculating Game Counts
-    white_games = calculate_games(df, 'White')
-    black_games = calculate_games(df, 'Black')
-    total_games = calculate_total_games(white_games, black_games)
-    total_moves = calculate_total_moves(df)
-    
-    # Calculating Statistics
-    combined_df = pd.concat([
-        df[['White', 'white_sgi', 'white_sgpl', 'white_stcpl', 'white_gi', 'white_gpl', 'white_acpl', 'white_move_number']].rename(columns={'White': 'Player', 'white_sgi': 'sgi', 'white_sgpl': 'sgpl', 'white_stcpl': 'stcpl', 'white_gi': 'gi', 'white_gpl': 'gpl', 'white_acpl': 'acpl', 'white_move_number': 'move_number'}),
-        df[['Black', 'black_sgi', 'black_sgpl', 'black_stcpl', 'black_gi', 'black_gpl', 'black_acpl', 'black_move_number']].rename(columns={'Black': 'Player', 'black_sgi': 'sgi', 'black_sgpl': 'sgpl', 'black_stcpl': 'stcpl', 'black_gi': 'gi', 'black_gpl': 'gpl', 'black_acpl': 'acpl', 'black_move_number': 'move_number'})
-    ])
-    sgi_stats = calculate_statistics(combined_df, 'sgi')
-    sgpl_stats = calculate_statistics(combined_df, 'sgpl')
-    stcpl_stats = calculate_statistics(combined_df, 'stcpl')
-    gi_stats = calculate_statistics(combined_df, 'gi')
-    gpl_stats = calculate_statistics(combined_df, 'gpl')
-    acpl_stats = calculate_statistics(combined_df, 'acpl')
-
-    # Merging DataFrames
-    sums = [white_sgi_sum, black_sgi_sum, white_sgpl_sum, black_sgpl_sum, white_stcpl_sum, black_stcpl_sum, white_gi_sum, black_gi_sum, white_gpl_sum, black_gpl_sum, white_acpl_sum, black_acpl_sum]
-    total_sums = merge_dataframes(sums + [total_games, total_moves])
-    total_sums['total_sgi_sum'] = total_sums['white_sgi_sum'] + total_sums['black_sgi_sum']
-    total_sums['total_sgpl_sum'] = total_sums['white_sgpl_sum'] + total_sums['black_sgpl_sum']
-    total_sums['total_stcpl_sum'] = total_sums['white_stcpl_sum'] + total_sums['black_stcpl_sum']
-    total_sums['total_gi_sum'] = total_sums['white_gi_sum'] + total_sums['black_gi_sum']
-    total_sums['total_gpl_sum'] = total_sums['white_gpl_sum'] + total_sums['black_gpl_sum']
-    total_sums['total_acpl_sum'] = total_sums['white_acpl_sum'] + total_sums['black_acpl_sum']
-
-    player_stats = merge_dataframes([total_sums, sgi_stats, sgpl_stats, stcpl_stats, gi_stats, gpl_stats, acpl_stats])
+    # Calculating Sums, Game Counts and Statistics
+    player_stats = aggregate_player_stats(df)
+    if bootstrap_resamples:
+        player_stats = player_stats.join(bootstrap_player_cis(df, bootstrap_resamples, bootstrap_seed, confidence,
+                                                              workers))
+
+    save_player_stats(player_stats, player_stats_output_dir)
 
+# Function to calculate the averages of the aggregated player stats and save them, sorted by avg_sgi
+def save_player_stats(player_stats, player_stats_output_dir):
     # Calculating Averages
     player_stats = calculate_averages(player_stats)
-    
 
     # Reordering columns
     columns_order = ['Player', 'avg_sgi', 'normalized_sgi', 'avg_sgpl', 'avg_stcpl', 'avg_white_sgi', 
@@ -152,6 +210,8 @@ def main(csv_all_games_path, player_stats_output_dir):
                      'sgi_std', 'sgpl_median', 'sgpl_var', 'sgpl_std', 'stcpl_median', 'stcpl_var', 
                      'stcpl_std', 'gi_median', 'gi_var', 'gi_std', 'gpl_median', 'gpl_var', 'gpl_std',
                      'acpl_median', 'acpl_var', 'acpl_std']
+    # Bootstrap confidence intervals, if calculated
+    columns_order += [column for column in player_stats.columns if column.endswith(('_ci_low', '_ci_high'))]
     player_stats = player_stats[columns_order]
     
     # Ensure the output directory exists
@@ -170,10 +230,17 @@ if __name__ == "__main__":
     # If multiple CSVs: 
     # input_dir = ""
     # csv_all_games_path = combine_csv_files(input_dir, output_filename='combined.csv')
-    if len(sys.argv) < 3:
-        print("Usage: python csv_to_player_stats.py <csv_all_games_path> <player_stats_output_dir>")
-        sys.exit(1)
-
-    csv_all_games_path = sys.argv[1]
-    player_stats_output_dir = sys.argv[2]
-    main(csv_all_games_path, player_stats_output_dir)
+    parser = argparse.ArgumentParser(usage="python csv_to_player_stats.py <csv_all_games_path> <player_stats_output_dir> [--bootstrap N [--seed S] [--confidence C] [--workers N]]")
+    parser.add_argument("csv_all_games_path")
+    parser.add_argument("player_stats_output_dir")
+    parser.add_argument("--bootstrap", type=int, default=0,
+                        help="number of bootstrap resamples for the confidence intervals of avg_sgi, avg_sgpl and "
+                             "avg_stcpl (0: no confidence intervals)")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="seed of the bootstrap; the same seed gives the same intervals")
+    parser.add_argument("--confidence", type=float, default=0.95, help="confidence level of the intervals")
+    parser.add_argument("--workers", type=int, default=1, help="number of processes for the bootstrap")
+    args = parser.parse_args()
+
+    main(args.csv_all_games_path, args.player_stats_output_dir, args.bootstrap, args.seed, args.confidence,
+         args.workers)
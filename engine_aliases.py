@@ -0,0 +1,70 @@
+"""This script normalizes engine names so that all versions of the same engine are merged, e.g. "Stockfish 16" and
+"asmFish 2.0" both become "Stockfish". The alias table maps each engine to its aliases and can be loaded from a
+JSON file with the same layout as DEFAULT_ENGINE_ALIASES. A plain alias matches the first word of an engine name,
+"prefix:<text>" matches names that start with the text and "regex:<pattern>" names that start with a match of the
+pattern (flags must be scoped, e.g. "regex:(?i:sugar)"); the first matching alias wins. Names without an alias are
+reduced to their first word.
+The table is compiled into a single regular expression and each distinct name is resolved once.
+"""
+
+import json
+import re
+import pandas as pd
+
+DEFAULT_ENGINE_ALIASES = {
+    "Stockfish": ["MateFinder", "asmFish", "SugaR", "ShashChess", "Fat"],
+    "Komodo": ["Dragon", "Doch"],
+    "Zappa": ["Zap!Chess"],
+    "Bouquet": ["DeepSaros", "Elektro", "IvanHoe", "RobboLito"]
+}
+
+# Function to load an alias table from a JSON file, or the default one
+def load_engine_aliases(alias_table_path=None):
+    if not alias_table_path:
+        return DEFAULT_ENGINE_ALIASES
+    with open(alias_table_path, 'r') as alias_file:
+        return json.load(alias_file)
+
+# Function to compile an alias table into an alias index: a single regular expression with one named group per
+# alias, the engine of each group and a cache of the resolved names
+def compile_engine_aliases(engine_aliases=None):
+    if engine_aliases is None:
+        engine_aliases = DEFAULT_ENGINE_ALIASES
+    patterns = []
+    engines = []
+    for engine, aliases in engine_aliases.items():
+        for alias in aliases:
+            if alias.startswith('regex:'):
+                pattern = f'(?:{alias[len("regex:"):]})'
+            elif alias.startswith('prefix:'):
+                pattern = re.escape(alias[len('prefix:'):])
+            else:
+                pattern = re.escape(alias) + r'(?:\s|\Z)'
+            patterns.append(f'(?P<alias{len(engines)}>{pattern})')
+            engines.append(engine)
+    regex = re.compile(r'\s*(?:' + '|'.join(patterns) + ')') if patterns else None
+    return {'regex': regex, 'engines': engines, 'cache': {}}
+
+# Function to get the merged engine name of a player name
+def resolve_engine_name(alias_index, name):
+    if name in alias_index['cache']:
+        return alias_index['cache'][name]
+    engine = None
+    match = alias_index['regex'].match(name) if alias_index['regex'] and isinstance(name, str) else None
+    if match:
+        engine = alias_index['engines'][int(match.lastgroup[len('alias'):])]
+    elif isinstance(name, str):
+        words = name.split()
+        engine = words[0] if words else ''
+    alias_index['cache'][name] = engine
+    return engine
+
+# Function to convert a column of player names to categorical engine IDs with the merged engine names. Only the
+# distinct names are resolved; missing names stay missing.
+def engine_ids(alias_index, names):
+    codes, uniques = pd.factorize(names)
+    merged_codes, engines = pd.factorize(pd.Series([resolve_engine_name(alias_index, name) for name in uniques],
+                                                   dtype=object))
+    if len(uniques):
+        codes = merged_codes[codes] * (codes >= 0) - (codes < 0)
+    return pd.Categorical.from_codes(codes, categories=engines)
@@ -0,0 +1,249 @@
+"""This script stores the per-ply evals of PGN files in a compact binary corpus, so that the stats of
+pgn_engine_vs_engine_eval_analyzer.py can be calculated again (e.g. with another WDL model or mate score) without
+parsing the PGN files. A corpus is a directory with:
+- evals.npy: the evals of all plies of all games in centipawns from White's perspective (int16 if they fit, else int32)
+- offsets.npy: the offsets of the games in evals.npy (int64), so the evals of game g are evals[offsets[g]:offsets[g + 1]]
+- results.npy: the result code of each game (int8, see batch_metrics.RESULT_CODES)
+- games.arrow: the headers of the games and their source PGN file (Arrow IPC, requires pyarrow)
+- corpus.json: the number of games and plies, the settings used to read the PGN files and the game ranges of each
+  source file
+The arrays are memory-mapped when read. The evals of the PGN files are always whole centipawns, so the stats
+calculated from a corpus are the same as the ones of the analyzer.
+"""
+
+import argparse
+import json
+import os
+import time
+import numpy as np
+import pgn_engine_vs_engine_eval_analyzer as analyzer
+from batch_metrics import calculate_batch_stats, RESULT_CODES, RESULT_OTHER, WDL_MODELS, DEFAULT_WDL_MODEL, \
+    DEFAULT_WDL_PLY
+from columnar_output import OUTPUT_FORMATS, MOVES_FORMATS, resolve_output_format, games_to_table, \
+    open_columnar_writer, encode_names, moves_to_table, get_moves_path, open_moves_writer, pa
+from pgn_eval_scanner import MATE_SCORE
+from compressed_pgn import open_pgn
+
+CORPUS_VERSION = 1
+
+CORPUS_HEADERS = ["Event", "Site", "Date", "Round", "White", "Black", "Result", "WhiteElo", "BlackElo"]
+
+# Headers that are stored dictionary-encoded
+DICTIONARY_HEADERS = ["Event", "Site", "White", "Black", "source_file"]
+
+# Evals within this distance of the mate score are mates (mate in n is scored as MATE_SCORE - n centipawns)
+MATE_DISTANCE_LIMIT = 1000
+
+# Number of games that are read or analyzed at a time
+CORPUS_BATCH_GAMES = 65536
+
+RESULT_NAMES = {code: name for name, code in RESULT_CODES.items()}
+
+def get_metadata_schema():
+    name_type = pa.dictionary(pa.int32(), pa.string())
+    return pa.schema([(name, name_type if name in DICTIONARY_HEADERS else pa.string())
+                      for name in CORPUS_HEADERS + ["source_file"]])
+
+# Function to write a batch of games to the corpus files being built
+def write_corpus_batch(batch, evals_file, metadata_writer, corpus):
+    cps = np.rint(np.array(batch['evals'], dtype=np.float64) * 100).astype(np.int32)
+    cps.tofile(evals_file)
+    if len(cps):
+        corpus['min_cp'] = min(corpus['min_cp'], int(cps.min()))
+        corpus['max_cp'] = max(corpus['max_cp'], int(cps.max()))
+    corpus['lengths'].extend(batch['lengths'])
+    corpus['results'].extend(RESULT_CODES.get(headers.get('Result'), RESULT_OTHER) for headers in batch['headers'])
+    columns = []
+    for field in get_metadata_schema():
+        if field.name == "source_file":
+            values = [batch['source_file']] * len(batch['headers'])
+        else:
+            values = [headers.get(field.name, None) for headers in batch['headers']]
+        if field.name in DICTIONARY_HEADERS:
+            columns.append(encode_names(values, corpus['dictionaries'].setdefault(field.name, {})))
+        else:
+            columns.append(pa.array(values, pa.string()))
+    metadata_writer.write_table(pa.Table.from_arrays(columns, schema=get_metadata_schema()))
+    batch['evals'], batch['lengths'], batch['headers'] = [], [], []
+
+# Function to read the evals and headers of the games of the PGN files of a directory into a corpus
+def build_eval_corpus(input_pgn_dir, corpus_dir, ccrl=False, validate=False):
+    if pa is None:
+        raise ImportError("pyarrow is required to write the games of a corpus, install it with: pip install pyarrow")
+    if not os.path.exists(corpus_dir):
+        os.makedirs(corpus_dir)
+    corpus = {'min_cp': 0, 'max_cp': 0, 'lengths': [], 'results': [], 'dictionaries': {}}
+    source_files = []
+    evals_tmp_path = os.path.join(corpus_dir, 'evals.int32.tmp')
+    with open(evals_tmp_path, 'wb') as evals_file, \
+            pa.ipc.new_file(os.path.join(corpus_dir, 'games.arrow'), get_metadata_schema(),
+                             options=pa.ipc.IpcWriteOptions(emit_dictionary_deltas=True)) as metadata_writer:
+        for pgn_file_path in analyzer.find_pgn_files(input_pgn_dir):
+            source_file = os.path.relpath(pgn_file_path, input_pgn_dir)
+            first_game = len(corpus['lengths'])
+            batch = {'evals': [], 'lengths': [], 'headers': [], 'source_file': source_file}
+            with open_pgn(pgn_file_path, 'r', encoding=analyzer.detect_encoding(pgn_file_path), errors='replace') as pgn:
+                for headers, pawns_list in analyzer.read_games(pgn, validate, ccrl):
+                    # The first value of a pawns_list is a copy of the eval of the first move
+                    batch['evals'].extend(pawns_list[1:])
+                    batch['lengths'].append(len(pawns_list) - 1)
+                    batch['headers'].append(dict(headers))
+                    if len(batch['lengths']) == CORPUS_BATCH_GAMES:
+                        write_corpus_batch(batch, evals_file, metadata_writer, corpus)
+            write_corpus_batch(batch, evals_file, metadata_writer, corpus)
+            source_files.append({'path': source_file, 'start': first_game, 'end': len(corpus['lengths'])})
+            print(f"{pgn_file_path}: {len(corpus['lengths']) - first_game} games")
+
+    # Store the evals as int16 if they fit
+    offsets = np.zeros(len(corpus['lengths']) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(corpus['lengths'])
+    fits_int16 = np.iinfo(np.int16).min <= corpus['min_cp'] and corpus['max_cp'] <= np.iinfo(np.int16).max
+    eval_dtype = np.int16 if fits_int16 else np.int32
+    tmp_evals = np.memmap(evals_tmp_path, dtype=np.int32, mode='r') if offsets[-1] else np.zeros(0, np.int32)
+    evals = np.lib.format.open_memmap(os.path.join(corpus_dir, 'evals.npy'), mode='w+', dtype=eval_dtype,
+                                      shape=(int(offsets[-1]),))
+    for start in range(0, len(evals), CORPUS_BATCH_GAMES * 128):
+        evals[start:start + CORPUS_BATCH_GAMES * 128] = tmp_evals[start:start + CORPUS_BATCH_GAMES * 128]
+    evals.flush()
+    del evals, tmp_evals
+    os.remove(evals_tmp_path)
+    np.save(os.path.join(corpus_dir, 'offsets.npy'), offsets)
+    np.save(os.path.join(corpus_dir, 'results.npy'), np.array(corpus['results'], dtype=np.int8))
+    info = {'version': CORPUS_VERSION, 'games': len(offsets) - 1, 'plies': int(offsets[-1]),
+            'eval_dtype': np.dtype(eval_dtype).name, 'mate_score': MATE_SCORE, 'ccrl': ccrl, 'validate': validate,
+            'source_files': source_files}
+    with open(os.path.join(corpus_dir, 'corpus.json'), 'w') as info_file:
+        json.dump(info, info_file, indent=4)
+    return info
+
+# Function to open a corpus. The arrays are memory-mapped.
+def open_eval_corpus(corpus_dir):
+    with open(os.path.join(corpus_dir, 'corpus.json')) as info_file:
+        info = json.load(info_file)
+    if info['version'] != CORPUS_VERSION:
+        raise ValueError(f"{corpus_dir} is a corpus of version {info['version']}, expected {CORPUS_VERSION}")
+    return {'dir': corpus_dir, 'info': info,
+            'evals': np.load(os.path.join(corpus_dir, 'evals.npy'), mmap_mode='r'),
+            'offsets': np.load(os.path.join(corpus_dir, 'offsets.npy'), mmap_mode='r'),
+            'results': np.load(os.path.join(corpus_dir, 'results.npy'), mmap_mode='r')}
+
+# Function to read the headers of games start to end of a corpus, as dicts with None for missing headers
+def read_corpus_headers(corpus, start, end):
+    with pa.memory_map(os.path.join(corpus['dir'], 'games.arrow')) as source:
+        table = pa.ipc.open_file(source).read_all().slice(start, end - start)
+        return table.select(CORPUS_HEADERS).to_pylist()
+
+# Function to score the mates of an array of centipawn evals with another mate score, keeping the number of moves
+# to mate
+def rescore_mates(cps, stored_mate_score, mate_score):
+    if mate_score == stored_mate_score:
+        return cps
+    cps = cps.astype(np.int64)
+    is_mate = np.abs(cps) > stored_mate_score - MATE_DISTANCE_LIMIT
+    is_mate &= np.abs(cps) <= stored_mate_score
+    cps[is_mate] = np.sign(cps[is_mate]) * (mate_score - (stored_mate_score - np.abs(cps[is_mate])))
+    return cps
+
+# Function to build the flat pawns array and the offsets of batch_metrics.calculate_batch_stats for games start to
+# end of a corpus, as pawns_list_from_evals does for each game
+def corpus_pawns(corpus, start, end, mate_score=MATE_SCORE):
+    offsets = np.asarray(corpus['offsets'][start:end + 1], dtype=np.int64)
+    cps = rescore_mates(np.asarray(corpus['evals'][offsets[0]:offsets[-1]]), corpus['info']['mate_score'], mate_score)
+    lengths = np.diff(offsets)
+    # Each pawns_list starts with a copy of its first eval, or 0 for games without evals
+    pawns_offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    pawns_offsets[1:] = np.cumsum(lengths + 1)
+    pawns = np.zeros(pawns_offsets[-1], dtype=np.float64)
+    is_first = np.zeros(pawns_offsets[-1], dtype=bool)
+    is_first[pawns_offsets[:-1]] = True
+    pawns[~is_first] = cps / 100.0
+    has_evals = lengths > 0
+    pawns[pawns_offsets[:-1][has_evals]] = pawns[pawns_offsets[:-1][has_evals] + 1]
+    return pawns, pawns_offsets
+
+# Function to calculate the stats of the games of a corpus and write them as the analyzer does: one output file per
+# source PGN file, with the same game keys, and the per-move files to moves_dir if given
+def analyze_corpus(corpus_dir, output_dir, output_format="json", wdl_model=DEFAULT_WDL_MODEL, wdl_ply=DEFAULT_WDL_PLY,
+                   mate_score=MATE_SCORE, moves_dir=None, moves_format="parquet"):
+    output_format = resolve_output_format(output_format)
+    if moves_dir:
+        moves_format = resolve_output_format(moves_format)
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    corpus = open_eval_corpus(corpus_dir)
+    result_names = [RESULT_NAMES.get(code) for code in range(max(RESULT_CODES.values()) + 1)]
+    for source_file in corpus['info']['source_files']:
+        output_path = analyzer.get_output_path(source_file['path'], output_dir, output_format)
+        aggregated_data = {}
+        output_writer = None
+        moves_writer = None
+        name_dictionaries = {}
+        for start in range(source_file['start'], source_file['end'], CORPUS_BATCH_GAMES):
+            end = min(start + CORPUS_BATCH_GAMES, source_file['end'])
+            pawns, offsets = corpus_pawns(corpus, start, end, mate_score)
+            results = [result_names[code] for code in corpus['results'][start:end]]
+            stats = calculate_batch_stats(pawns, offsets, results, wdl_model, wdl_ply, per_move=bool(moves_dir))
+            if moves_dir:
+                stats, moves = stats
+                if moves_writer is None:
+                    moves_writer = open_moves_writer(get_moves_path(moves_dir, source_file['path'], moves_format),
+                                                     moves_format)
+                moves_writer.write_table(moves_to_table(start + 1, moves))
+            games_data = analyzer.games_data_from_stats(stats, read_corpus_headers(corpus, start, end))
+            if output_format == "json":
+                aggregated_data.update(zip(range(start + 1, end + 1), games_data))
+                continue
+            if output_writer is None:
+                output_writer = open(output_path, 'w') if output_format == "jsonl" \
+                    else open_columnar_writer(output_path, output_format)
+            if output_format == "jsonl":
+                analyzer.write_jsonl_games(output_writer, start + 1, games_data)
+                continue
+            output_writer.write_table(games_to_table(start + 1, games_data,
+                                                     name_dictionaries if output_format == "arrow" else None))
+        if output_format == "json":
+            analyzer.write_json(aggregated_data, source_file['path'], output_dir)
+        elif output_writer:
+            output_writer.close()
+        if moves_writer:
+            moves_writer.close()
+        print(f"{source_file['path']}: {source_file['end'] - source_file['start']} games")
+
+if __name__ == "__main__":
+    start_time = time.time()
+    parser = argparse.ArgumentParser(usage="python eval_corpus.py build <input_pgn_dir> <corpus_dir> [--ccrl] [--validate]\n"
+                                           "       python eval_corpus.py analyze <corpus_dir> <output_dir> [--wdl-model MODEL] [--wdl-ply PLY] [--mate-score CP] [--output-format {json,jsonl,parquet,arrow}] [--moves-dir DIR [--moves-format {parquet,arrow}]]")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    build_parser = subparsers.add_parser("build", help="read the evals of PGN files into a corpus")
+    build_parser.add_argument("input_pgn_dir")
+    build_parser.add_argument("corpus_dir")
+    build_parser.add_argument("--ccrl", action="store_true",
+                              help="read raw CCRL PGN files and correct their evals, as eval_corrector_ccrl.py does")
+    build_parser.add_argument("--validate", action="store_true",
+                              help="parse and replay every game with python-chess instead of only scanning the evals")
+    analyze_parser = subparsers.add_parser("analyze", help="calculate the stats of the games of a corpus")
+    analyze_parser.add_argument("corpus_dir")
+    analyze_parser.add_argument("output_dir")
+    analyze_parser.add_argument("--wdl-model", choices=WDL_MODELS, default=DEFAULT_WDL_MODEL,
+                                help="WDL model of python-chess used to convert evals to expected points")
+    analyze_parser.add_argument("--wdl-ply", type=int, default=DEFAULT_WDL_PLY,
+                                help="ply at which the Stockfish WDL models are evaluated")
+    analyze_parser.add_argument("--mate-score", type=int, default=MATE_SCORE,
+                                help="centipawn score of a mate in 0; mate in n is scored as mate score - n. Only [%%eval #n] "
+                                     "mates are rescored; the large evals of CCRL mates are not mates to the analyzer")
+    analyze_parser.add_argument("--output-format", choices=OUTPUT_FORMATS, default="json",
+                                help="write typed columnar files (Parquet or Arrow IPC) or JSON Lines instead of JSON")
+    analyze_parser.add_argument("--moves-dir",
+                                help="also write the per-move terms of the stats to a dataset in this directory, "
+                                     "partitioned by source PGN file")
+    analyze_parser.add_argument("--moves-format", choices=MOVES_FORMATS, default="parquet",
+                                help="format of the per-move files")
+    args = parser.parse_args()
+
+    if args.command == "build":
+        info = build_eval_corpus(args.input_pgn_dir, args.corpus_dir, args.ccrl, args.validate)
+        print(f"Corpus of {info['games']} games and {info['plies']} plies ({info['eval_dtype']}) saved to {args.corpus_dir}")
+    else:
+        analyze_corpus(args.corpus_dir, args.output_dir, args.output_format, args.wdl_model, args.wdl_ply,
+                       args.mate_score, args.moves_dir, args.moves_format)
+    print("Script finished in {:.2f} minutes".format((time.time() - start_time) / 60.0))
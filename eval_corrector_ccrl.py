@@ -3,12 +3,29 @@ where all evals are from White's perspective as is standard."""
 
 import chess.pgn
 import re
-import sys
 import os
+import io
 import time
+import argparse
+from pgn_eval_scanner import eval_from_comment, SAN_PATTERN
+from compressed_pgn import open_pgn, is_pgn_file, strip_compression_extension
+from stage_profiler import PROFILERS, get_profile_options, new_record, phase, add_counts, write_record, \
+    capture_profile, file_size
+
+CCRL_EVAL_PATTERN = r"[\+\-]\d+\.\d+"
+
+CCRL_EVAL_BYTES_REGEX = re.compile(CCRL_EVAL_PATTERN.encode())
+
+# Tokens of the movetext of a game (see pgn_eval_scanner.py), as bytes. Comments may span several lines.
+MOVETEXT_BYTES_REGEX = re.compile(rb"(" + SAN_PATTERN.encode() + rb")|(\{[^}]*\}?)|(;[^\n]*)|(^%[^\n]*)|(\()|(\))",
+                                  re.MULTILINE)
+
+COMMENT_DELIMITERS_BYTES_REGEX = re.compile(rb"[{};]")
+
+TAG_BYTES_REGEX = re.compile(chess.pgn.TAG_REGEX.pattern.encode())
 
 def extract_eval_from_comment(comment):
-    match = re.search(r"[\+\-]\d+\.\d+", comment)
+    match = re.search(CCRL_EVAL_PATTERN, comment)
     if match:
         eval_str = match.group()
         try:
@@ -20,42 +37,163 @@ def extract_eval_from_comment(comment):
         # If no eval is found, then it must be a book move, so return 0
         return None
 
+# Function to get the eval of a move in pawns from White's perspective, as pgn_engine_vs_engine_eval_analyzer.py
+# reads it from the PGN written by process_game, without rewriting the comment. white_to_move is the side to move
+# after the move.
+def eval_from_ccrl_comment(comment, white_to_move):
+    eval_score = extract_eval_from_comment(comment)
+    if eval_score is None:
+        # The comment is left unchanged by process_game
+        return eval_from_comment(comment, white_to_move)
+    # Invert the evaluation score for Black's moves
+    if white_to_move:
+        eval_score = -eval_score
+    return eval_from_comment(f"[%eval {eval_score}]", white_to_move)
+
 def process_game(game):
     node = game
+    # Track the side to move by ply parity instead of calling node.board(), which replays the game from the root
+    turn = game.board().turn
     while node.variations:
         next_node = node.variation(0)
         eval_score = extract_eval_from_comment(next_node.comment)
 
         # Invert the evaluation score for Black's moves
-        if eval_score is not None and node.board().turn == chess.BLACK:
+        if eval_score is not None and turn == chess.BLACK:
             eval_score = -eval_score
 
         if eval_score is not None:
             # Update the comment with the corrected evaluation score in the desired format
             next_node.comment = f"[%eval {eval_score}]"
         node = next_node
+        turn = not turn
+
+# Function to correct the evals in the movetext of a game at the text level. The first comment with an eval of
+# every mainline move is replaced, all other bytes are kept. white_to_move is the side to move at the start.
+def correct_movetext(movetext, white_to_move):
+    variation_depth = 0
+    has_move = False
+    move_corrected = False
+
+    def correct_token(match):
+        nonlocal white_to_move, variation_depth, has_move, move_corrected
+        kind = match.lastindex
+        if kind == 1:
+            if not variation_depth:
+                white_to_move = not white_to_move
+                has_move = True
+                move_corrected = False
+        elif kind == 2:
+            if not variation_depth and has_move and not move_corrected:
+                eval_match = CCRL_EVAL_BYTES_REGEX.search(match.group(2))
+                if eval_match:
+                    eval_score = float(eval_match.group())
+                    # Invert the evaluation score for Black's moves
+                    if white_to_move:
+                        eval_score = -eval_score
+                    move_corrected = True
+                    return f"{{ [%eval {eval_score}] }}".encode()
+        elif kind == 5:
+            if variation_depth or has_move:
+                variation_depth += 1
+        elif kind == 6:
+            if variation_depth:
+                variation_depth -= 1
+        return match.group()
+
+    return MOVETEXT_BYTES_REGEX.sub(correct_token, movetext)
+
+# Function to correct the evals of the lines of a PGN file (as bytes) in a single pass, without parsing the games
+# with python-chess. Yields the corrected lines. If a counts dict is given, the games are counted in counts['games'].
+def correct_pgn_lines(lines, counts=None):
+    movetext_lines = []
+    white_to_move = True
+    in_headers = True
+    in_comment = False
+    for line in lines:
+        if in_headers:
+            if line.startswith(b"["):
+                tag_match = TAG_BYTES_REGEX.match(line)
+                if tag_match and tag_match.group(1) == b"FEN":
+                    fen_fields = tag_match.group(2).split()
+                    white_to_move = not (len(fen_fields) > 1 and fen_fields[1] == b"b")
+                yield line
+                continue
+            if line.isspace() or line.startswith(b"%") or line.startswith(b";"):
+                yield line
+                continue
+            in_headers = False
+        # An empty line outside of a comment means the end of a game
+        if not in_comment and line.isspace():
+            if counts is not None:
+                counts['games'] += 1
+            yield correct_movetext(b"".join(movetext_lines), white_to_move)
+            yield line
+            movetext_lines = []
+            white_to_move = True
+            in_headers = True
+            continue
+        movetext_lines.append(line)
+        for match in COMMENT_DELIMITERS_BYTES_REGEX.finditer(line):
+            delimiter = match.group()
+            if in_comment:
+                in_comment = delimiter != b"}"
+            elif delimiter == b"{":
+                in_comment = True
+            elif delimiter == b";":
+                break
+    if movetext_lines:
+        if counts is not None:
+            counts['games'] += 1
+        yield correct_movetext(b"".join(movetext_lines), white_to_move)
+
+# Function to correct the evals of a PGN file, or of the byte range [start, end) of it, at the text level.
+# Compressed PGN files are decompressed as a stream (byte ranges need an uncompressed file).
+def correct_pgn_file(input_pgn_file_path, output_pgn_file_path, start=0, end=None, counts=None):
+    with open_pgn(input_pgn_file_path) as pgn_bytes, open(output_pgn_file_path, "wb") as output_pgn_file:
+        if start:
+            pgn_bytes.seek(start)
+        if end is not None:
+            pgn_bytes = io.BytesIO(pgn_bytes.read(end - start))
+        output_pgn_file.writelines(correct_pgn_lines(pgn_bytes, counts))
+
+# Function to get the name of the corrected PGN file of an input PGN file, e.g. games.pgn.gz -> games_corrected.pgn
+def get_corrected_pgn_name(input_file):
+    return os.path.splitext(strip_compression_extension(input_file))[0] + "_corrected.pgn"
 
-def main(ccrl_input_dir, pgn_output_dir):
+def main(ccrl_input_dir, pgn_output_dir, validate=False, profile_report=None, profiler=None):
+    profile_options = get_profile_options(profile_report, profiler)
     # Ensure the output directory exists
     if not os.path.exists(pgn_output_dir):
         os.makedirs(pgn_output_dir)
 
     for input_file in os.listdir(ccrl_input_dir):
-        if input_file.endswith(".pgn"):
+        if is_pgn_file(input_file):
             input_pgn_file_path = os.path.join(ccrl_input_dir, input_file)
-            output_pgn_file_name = os.path.splitext(input_file)[0] + "_corrected.pgn"
+            output_pgn_file_name = get_corrected_pgn_name(input_file)
             output_pgn_file_path = os.path.join(pgn_output_dir, output_pgn_file_name)
 
+            record = new_record(profile_options, 'correct', input_pgn_file_path)
             try:
-                with open(input_pgn_file_path) as pgn_text, open(output_pgn_file_path, "w") as output_pgn_file:
-                    exporter = chess.pgn.FileExporter(output_pgn_file)
-                    while True:
-                        game = chess.pgn.read_game(pgn_text)
-                        if game is None:
-                            break
-                        process_game(game)
-                        game.accept(exporter)
+                with phase(record, 'correct'), capture_profile(profile_options, 'correct', input_pgn_file_path):
+                    if not validate:
+                        counts = {'games': 0}
+                        correct_pgn_file(input_pgn_file_path, output_pgn_file_path, counts=counts)
+                        add_counts(record, games=counts['games'])
+                    else:
+                        with open_pgn(input_pgn_file_path, "r") as pgn_text, open(output_pgn_file_path, "w") as output_pgn_file:
+                            exporter = chess.pgn.FileExporter(output_pgn_file)
+                            while True:
+                                game = chess.pgn.read_game(pgn_text)
+                                if game is None:
+                                    break
+                                process_game(game)
+                                game.accept(exporter)
+                                add_counts(record, games=1, plies=game.end().ply())
                 print(f"Updated games written to {output_pgn_file_path}")
+                add_counts(record, bytes_read=file_size(input_pgn_file_path),
+                           bytes_written=file_size(output_pgn_file_path))
+                write_record(profile_options, record)
             except FileNotFoundError:
                 print(f"File not found: {input_pgn_file_path}")
             except Exception as e:
@@ -63,12 +201,18 @@ def main(ccrl_input_dir, pgn_output_dir):
 
 if __name__ == "__main__":
     start_time = time.time()
-    if len(sys.argv) < 3:
-        print("Usage: python eval_corrector_ccrl.py <ccrl_input_dir> <pgn_output_dir>")
-        sys.exit(1)
+    parser = argparse.ArgumentParser(usage="python eval_corrector_ccrl.py <ccrl_input_dir (.pgn, .pgn.gz, .pgn.bz2, .pgn.xz or .pgn.zst files)> <pgn_output_dir> [--validate] [--profile-report report.jsonl [--profiler {cprofile,pyinstrument}]]")
+    parser.add_argument("ccrl_input_dir")
+    parser.add_argument("pgn_output_dir")
+    parser.add_argument("--validate", action="store_true",
+                        help="parse and replay every game with python-chess and export it, instead of only rewriting the eval comments")
+    parser.add_argument("--profile-report",
+                        help="append the timings, rates, bytes and peak RSS of each file to this JSON Lines file")
+    parser.add_argument("--profiler", choices=PROFILERS,
+                        help="with --profile-report, also capture a profile of the correction of each file")
+    args = parser.parse_args()
 
-    ccrl_input_dir = sys.argv[1]
-    pgn_output_dir = sys.argv[2]
-    main(ccrl_input_dir, pgn_output_dir)
+    main(args.ccrl_input_dir, args.pgn_output_dir, validate=args.validate, profile_report=args.profile_report,
+         profiler=args.profiler)
     end_time = time.time()
     print("Script finished in {:.2f} minutes".format((end_time - start_time) / 60.0))
@@ -0,0 +1,191 @@
+"""This script writes reproducible synthetic PGN files in the format of the CCRL dataset, for benchmarks and for
+checking that changes keep the outputs identical. The same seed and settings always give the same bytes.
+Every move has a comment with the eval of the moving engine from its own perspective, its depth and time
+(e.g. { +0.25/22 3s }), except for book moves, which have no eval. Some evals have three decimals and some are mates,
+written as very large evals as CCRL does. The moves are legal, so the files can also be read with python-chess.
+With --edge-case-rate some games also have the constructs that the fast scanner and the text-level corrector handle
+apart from python-chess: a FEN start with Black to move, a variation, a comment over two lines and a rest-of-line
+(;) comment.
+"""
+
+import argparse
+import os
+import random
+import time
+import chess
+
+ENGINE_NAMES = ["Stockfish 16 64-bit", "asmFish 2020", "SugaR AI 2.5", "ShashChess 30", "Komodo 14", "Dragon 3",
+                "Ethereal 14", "Berserk 12", "Zap!Chess Zanzibar", "RobboLito 0.09", "Igel 3.5", "Koivisto 9"]
+
+# Engine names with non-ASCII characters, used when the encoding can represent them
+NON_ASCII_ENGINE_NAMES = ["Fruit Reloaded 2.1 é", "Ginkgo 4 Ü", "Schläfer 1.1"]
+
+RESULTS = ["1-0", "0-1", "1/2-1/2"]
+
+# Number of random legal move sequences that the games are cut from
+MOVE_POOL_SIZE = 256
+
+# Position after 1. e4, the start of the games that begin from a FEN with Black to move (with --edge-case-rate), and
+# number of random legal move sequences from it
+BLACK_TO_MOVE_FEN = "rnbqkbnr/pppppppp/8/8/4P3/8/PPPP1PPP/RNBQKBNR b KQkq - 0 1"
+FEN_MOVE_POOL_SIZE = 32
+
+# Function to play random legal games with python-chess. Returns the SAN moves of each game. Prefixes of the
+# sequences are legal games too, so games of any length can be cut from them.
+def build_move_pool(rng, max_plies, pool_size=MOVE_POOL_SIZE, fen=chess.STARTING_FEN):
+    pool = []
+    for _ in range(pool_size):
+        board = chess.Board(fen)
+        moves = []
+        while len(moves) < max_plies:
+            legal_moves = list(board.legal_moves)
+            if not legal_moves:
+                break
+            move = rng.choice(legal_moves)
+            moves.append(board.san(move))
+            board.push(move)
+        pool.append(moves)
+    return pool
+
+# Function to get the comment of a move: the eval of the moving engine from its own perspective, its depth and time
+def format_eval_comment(rng, white_eval, white_moved, mate_rate):
+    engine_eval = white_eval if white_moved else -white_eval
+    if rng.random() < mate_rate:
+        mate_in = rng.randint(1, 30)
+        engine_eval = (327.67 - mate_in / 100) * (1 if engine_eval >= 0 else -1)
+        return f"{{ {engine_eval:+.2f}/{rng.randint(20, 60)} {rng.randint(1, 60)}s }}"
+    decimals = 3 if rng.random() < 0.01 else 2
+    return f"{{ {engine_eval:+.{decimals}f}/{rng.randint(15, 40)} {rng.randint(1, 60)}s }}"
+
+# Function to get the move number token of a ply (counted from White's first move)
+def format_move_number(ply):
+    return f"{ply // 2 + 1}." if ply % 2 == 0 else f"{ply // 2 + 1}..."
+
+# Function to format the movetext of a game, wrapped at 80 characters like python-chess does. extras holds the
+# variations and rest-of-line comments that follow the comment of each move, if any; a rest-of-line comment ends its
+# line. first_ply is 1 if Black moves first.
+def format_movetext(moves, comments, result, extras=None, first_ply=0):
+    tokens = []
+    after_move = False
+    for index, (move, comment) in enumerate(zip(moves, comments)):
+        ply = first_ply + index
+        if ply % 2 == 0 or not after_move:
+            tokens.append(format_move_number(ply))
+        tokens.append(move)
+        after_move = True
+        for token in ([comment] if comment else []) + (extras[index] if extras else []):
+            tokens.append(token)
+            after_move = False
+    tokens.append(result)
+    lines = []
+    line = ""
+    for token in tokens:
+        if line and len(line) + 1 + len(token) > 80:
+            lines.append(line)
+            line = token
+        else:
+            line = f"{line} {token}" if line else token
+        if token.startswith(";"):
+            lines.append(line)
+            line = ""
+    lines.append(line)
+    return "\n".join(lines)
+
+# Function to add the edge cases of a game, each with probability edge_case_rate: a variation replacing a move, an
+# eval comment over two lines and a rest-of-line comment with an eval-like text in it. Returns the extras of
+# format_movetext.
+def add_edge_cases(rng, moves, comments, first_ply, edge_case_rate, mate_rate):
+    extras = [[] for _ in moves]
+    if not moves:
+        return extras
+    if rng.random() < edge_case_rate:
+        index = rng.randrange(len(moves))
+        board = chess.Board(BLACK_TO_MOVE_FEN if first_ply else chess.STARTING_FEN)
+        for move in moves[:index]:
+            board.push_san(move)
+        alternatives = sorted(board.san(move) for move in board.legal_moves if board.san(move) != moves[index])
+        if alternatives:
+            ply = first_ply + index
+            comment = format_eval_comment(rng, rng.uniform(-1, 1), ply % 2 == 0, mate_rate)
+            extras[index].append(f"( {format_move_number(ply)} {rng.choice(alternatives)} {comment} )")
+    if rng.random() < edge_case_rate:
+        index = rng.randrange(len(moves))
+        if comments[index].startswith("{ ") and comments[index] != "{ book }":
+            comments[index] = comments[index][:-2] + "\nponder hit }"
+    if rng.random() < edge_case_rate:
+        extras[rng.randrange(len(moves))].append("; not an eval: { +9.99/99 1s }")
+    return extras
+
+# Function to generate the text of a game
+def generate_game(rng, game_number, move_pool, engine_names, min_plies, max_plies, mate_rate, book_plies,
+                  edge_case_rate=0.0, fen_move_pool=None):
+    white, black = rng.sample(engine_names, 2)
+    result = rng.choice(RESULTS)
+    first_ply = 1 if edge_case_rate and rng.random() < edge_case_rate else 0
+    sequence = rng.choice(fen_move_pool if first_ply else move_pool)
+    moves = sequence[:rng.randint(min(min_plies, len(sequence)), min(max_plies, len(sequence)))]
+    game_book_plies = rng.randint(0, book_plies) if book_plies else 0
+    white_eval = rng.uniform(-0.5, 0.5)
+    comments = []
+    for ply in range(len(moves)):
+        white_eval += rng.gauss(0, 0.3)
+        if ply < game_book_plies:
+            comments.append("{ book }" if rng.random() < 0.5 else "")
+        else:
+            comments.append(format_eval_comment(rng, white_eval, (first_ply + ply) % 2 == 0, mate_rate))
+    extras = add_edge_cases(rng, moves, comments, first_ply, edge_case_rate, mate_rate) if edge_case_rate else None
+    headers = [("Event", "CCRL 40/15"), ("Site", "CCRL"), ("Date", f"20{10 + game_number % 14}.01.01"),
+               ("Round", f"{game_number + 1}.1"), ("White", white), ("Black", black), ("Result", result),
+               ("WhiteElo", str(rng.randint(2800, 3600))), ("BlackElo", str(rng.randint(2800, 3600)))]
+    if first_ply:
+        headers += [("SetUp", "1"), ("FEN", BLACK_TO_MOVE_FEN)]
+    header_text = "\n".join(f'[{name} "{value}"]' for name, value in headers)
+    return f"{header_text}\n\n{format_movetext(moves, comments, result, extras, first_ply)}\n\n"
+
+# Function to write a synthetic CCRL PGN file with the given number of games, or until it reaches target_size_mb.
+# Returns the number of games written.
+def generate_ccrl_pgn(output_path, games=1000, seed=0, min_plies=20, max_plies=160, mate_rate=0.005, book_plies=8,
+                      encoding="utf-8", target_size_mb=None, edge_case_rate=0.0):
+    rng = random.Random(seed)
+    move_pool = build_move_pool(rng, max_plies)
+    fen_move_pool = build_move_pool(rng, max_plies, FEN_MOVE_POOL_SIZE, BLACK_TO_MOVE_FEN) if edge_case_rate else None
+    engine_names = list(ENGINE_NAMES)
+    if encoding.replace("-", "").lower() not in ("ascii", "usascii"):
+        engine_names += NON_ASCII_ENGINE_NAMES
+    target_size = target_size_mb * 1024 * 1024 if target_size_mb else None
+    output_directory = os.path.dirname(output_path)
+    if output_directory and not os.path.exists(output_directory):
+        os.makedirs(output_directory)
+    game_number = 0
+    size = 0
+    with open(output_path, "wb") as output_file:
+        while (size < target_size) if target_size else (game_number < games):
+            game_bytes = generate_game(rng, game_number, move_pool, engine_names, min_plies, max_plies, mate_rate,
+                                       book_plies, edge_case_rate, fen_move_pool).encode(encoding)
+            output_file.write(game_bytes)
+            size += len(game_bytes)
+            game_number += 1
+    return game_number
+
+if __name__ == "__main__":
+    start_time = time.time()
+    parser = argparse.ArgumentParser(usage="python generate_ccrl_pgn.py <output_pgn_path> [--games N | --target-size-mb MB] [--seed S] [--min-plies N] [--max-plies N] [--mate-rate P] [--book-plies N] [--encoding ENCODING] [--edge-case-rate P]")
+    parser.add_argument("output_pgn_path")
+    parser.add_argument("--games", type=int, default=1000, help="number of games")
+    parser.add_argument("--target-size-mb", type=float, help="write games until the file reaches this size instead")
+    parser.add_argument("--seed", type=int, default=0, help="random seed; the same seed gives the same file")
+    parser.add_argument("--min-plies", type=int, default=20, help="minimum length of the games")
+    parser.add_argument("--max-plies", type=int, default=160, help="maximum length of the games")
+    parser.add_argument("--mate-rate", type=float, default=0.005, help="probability that an eval is a mate score")
+    parser.add_argument("--book-plies", type=int, default=8,
+                        help="maximum number of book moves without evals at the start of a game")
+    parser.add_argument("--encoding", default="utf-8", help="encoding of the file, e.g. utf-8, latin-1 or ascii")
+    parser.add_argument("--edge-case-rate", type=float, default=0.0,
+                        help="probability that a game starts from a FEN with Black to move, and that it has a "
+                             "variation, a comment over two lines and a ; comment")
+    args = parser.parse_args()
+
+    games = generate_ccrl_pgn(args.output_pgn_path, args.games, args.seed, args.min_plies, args.max_plies,
+                              args.mate_rate, args.book_plies, args.encoding, args.target_size_mb,
+                              args.edge_case_rate)
+    print(f"Wrote {games} games to {args.output_pgn_path} in {time.time() - start_time:.2f} seconds")
@@ -1,62 +1,206 @@
-"""This script inputs the JSON file generated by lichess_evals_extractor.py and outputs a CSV file
-containing the following columns:
+"""This script inputs the JSON file generated by lichess_evals_extractor.py (or the JSON Lines, Parquet or Arrow IPC files
+of pgn_engine_vs_engine_eval_analyzer.py --output-format) and outputs a CSV file containing the following columns:
 - White, Black, WhiteElo, BlackElo, WhiteResult, BlackResult, gi, gpl, acpl, white_move_number, black_move_number
+The results are 1.0, 0.0 or 0.5, or '...' for unfinished games.
+The games are converted and appended to the output file in chunks, so the whole dataset never has to fit in memory.
+With --merge-engines, the file with all versions of the same engine merged is written in the same pass.
 """
 
 import json
 import os
 import pandas as pd
-from pandas import json_normalize
-import sys
+import argparse
 import glob
+import time
+from columnar_output import iter_columnar_games, games_to_table, pa, pq, METRIC_COLUMNS
+from engine_aliases import load_engine_aliases, compile_engine_aliases, engine_ids
+from analysis_manifest import MANIFEST_FILE_NAME
+from stage_profiler import PROFILERS, get_profile_options, new_record, phase, add_counts, write_record, \
+    capture_profile, file_size
 
-def process_single_json_file(json_file_path):
-    data_list = []
-    with open(json_file_path, 'r') as f:
+# Number of games that are converted and written at a time
+CHUNK_ROWS = 50000
+
+# Function to list the output files of the analyzer in a directory, without its manifest
+def find_game_files(json_dir_path):
+    all_files = []
+    for extension in ('json', 'jsonl', 'parquet', 'arrow'):
+        all_files.extend(glob.glob(os.path.join(json_dir_path, f'**/*.{extension}'), recursive=True))
+    return [file_path for file_path in all_files if os.path.basename(file_path) != MANIFEST_FILE_NAME]
+
+# Function to iterate over the games of a JSON Lines file of the analyzer in chunks, reading one line at a time, so
+# the memory used does not depend on the size of the file
+def iter_jsonl_games(file_path, chunk_rows):
+    games = []
+    with open(file_path, 'r') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            game_data = json.loads(line)
+            del game_data['key']
+            games.append(game_data)
+            if len(games) == chunk_rows:
+                yield games
+                games = []
+    if games:
+        yield games
+
+# Function to iterate over the games (dicts) of a JSON, JSON Lines, Parquet or Arrow IPC file of the analyzer in chunks
+def iter_game_chunks(file_path, chunk_rows=CHUNK_ROWS):
+    if file_path.endswith('.jsonl'):
+        yield from iter_jsonl_games(file_path, chunk_rows)
+        return
+    if not file_path.endswith('.json'):
+        yield from iter_columnar_games(file_path, chunk_rows)
+        return
+    with open(file_path, 'r') as f:
         all_data = json.load(f)
-        if not all_data:
-            print(f"No data found in {json_file_path}")
-            return pd.DataFrame()
-        for key, data in all_data.items():
-            """To merge all versions of the same engine, add:
-            white_player = data.get('White', '')
-            black_player = data.get('Black', '')
-
-            data['White'] = extract_first_word(white_player)
-            data['Black'] = extract_first_word(black_player)
-            """
-            flattened_data = pd.json_normalize(data)
-            data_list.append(flattened_data)
-    return pd.concat(data_list, ignore_index=True)
-
-def process_json_files(json_dir_path, csv_output_dir):
-    all_files = glob.glob(os.path.join(json_dir_path, '**/*.json'), recursive=True)
-    aggregated_data = pd.DataFrame()
-
-    for json_file in all_files:
+    if not all_data:
+        print(f"No data found in {file_path}")
+    games = list(all_data.values())
+    del all_data
+    for start in range(0, len(games), chunk_rows):
+        yield games[start:start + chunk_rows]
+
+# Function to convert a chunk of games to a DataFrame. Stats are always floats and results are written as floats
+# (1.0, 0.0 or 0.5, as pandas wrote them before the conversion was streamed) or '...' for unfinished games, so every
+# chunk is written in the same way.
+def games_to_frame(games, columns):
+    df = pd.DataFrame(games, columns=columns)
+    for col in columns:
+        if col in METRIC_COLUMNS:
+            df[col] = df[col].astype(float)
+        elif col in ('WhiteResult', 'BlackResult'):
+            df[col] = pd.Series([result_value(game.get(col)) for game in games], dtype=object)
+    return df
+
+# Function to get the value of a result in the CSV files: a float, or the result as it is if it is not a number
+def result_value(result):
+    if isinstance(result, (int, float)) and not isinstance(result, bool):
+        return float(result)
+    return result
+
+# Function to replace the player names of a chunk of games with their merged engine names. The names stay
+# categorical (dictionary-encoded for Parquet), so each distinct name is only resolved once.
+def merge_frame_engines(df, alias_index):
+    return df.assign(**{col: engine_ids(alias_index, df[col]) for col in ('White', 'Black') if col in df.columns})
+
+def merge_table_engines(table, alias_index):
+    for col in ('White', 'Black'):
+        i = table.column_names.index(col)
+        ids = engine_ids(alias_index, table.column(col).to_pandas())
+        merged = pa.DictionaryArray.from_arrays(pa.array(ids.codes, type=pa.int32(), mask=ids.codes < 0),
+                                                pa.array(ids.categories, type=pa.string()))
+        table = table.set_column(i, table.schema.field(i), merged)
+    return table
+
+# Function to convert the games of the given files to CSV or Parquet files, chunk by chunk. output_files is a list of
+# (output_file, alias_index) pairs: every output is written from the same pass over the games, with the player
+# names merged by the alias index of engine_aliases.py, or kept as they are if it is None. Returns the number of games.
+# With the profile_options of stage_profiler.py, a profiling record of each input file is written.
+def convert_game_files(all_files, output_files, output_format="csv", profile_options=None):
+    if output_format == "parquet" and pq is None:
+        raise ImportError("pyarrow is required to write Parquet files, install it with: pip install pyarrow")
+    start_time = time.time()
+    rows = 0
+    columns = None
+    parquet_writers = {}
+    for file_path in all_files:
+        file_rows = 0
+        record = new_record(profile_options, 'convert', file_path)
+        output_sizes = [file_size(output_file) for output_file, _ in output_files] if record else []
         try:
-            df = process_single_json_file(json_file)
-            aggregated_data = pd.concat([aggregated_data, df], ignore_index=True)
+            with capture_profile(profile_options, 'convert', file_path):
+                chunks = iter_game_chunks(file_path)
+                while True:
+                    with phase(record, 'read'):
+                        games = next(chunks, None)
+                    if games is None:
+                        break
+                    with phase(record, 'transform'):
+                        if output_format == "parquet":
+                            table = games_to_table(rows, games)
+                            table = table.select([name for name in table.column_names if name != 'key'])
+                        else:
+                            if columns is None:
+                                columns = list(games[0].keys())
+                            df = games_to_frame(games, columns)
+                    for output_file, alias_index in output_files:
+                        if output_format == "parquet":
+                            with phase(record, 'merge_engines'):
+                                output_table = table if alias_index is None else merge_table_engines(table, alias_index)
+                            with phase(record, 'write'):
+                                if output_file not in parquet_writers:
+                                    parquet_writers[output_file] = pq.ParquetWriter(output_file, output_table.schema)
+                                parquet_writers[output_file].write_table(output_table)
+                        else:
+                            with phase(record, 'merge_engines'):
+                                output_df = df if alias_index is None else merge_frame_engines(df, alias_index)
+                            with phase(record, 'write'):
+                                output_df.to_csv(output_file, mode='a' if rows else 'w', header=not rows, index=False)
+                    if record is not None:
+                        add_counts(record, games=len(games), plies=sum(game.get('white_move_number', 0) +
+                                                                       game.get('black_move_number', 0)
+                                                                       for game in games))
+                    rows += len(games)
+                    file_rows += len(games)
         except Exception as e:
-            print(f'Error processing {json_file}: {e}')
-
-    if not aggregated_data.empty:
-        csv_output_file = os.path.join(csv_output_dir, 'engine_aggregated_game_data.csv')
-        if not os.path.exists(csv_output_dir):
-            os.makedirs(csv_output_dir)
-        aggregated_data.to_csv(csv_output_file, index=False)
-        print(f"Data saved to {csv_output_file}")
+            print(f'Error processing {file_path}: {e}')
+        if record is not None:
+            add_counts(record, bytes_read=file_size(file_path),
+                       bytes_written=sum(file_size(output_file) for output_file, _ in output_files) - sum(output_sizes))
+            write_record(profile_options, record)
+        elapsed = time.time() - start_time
+        print(f"{file_path}: {file_rows} rows ({rows / elapsed if elapsed else 0:.0f} rows/sec)")
+    for parquet_writer in parquet_writers.values():
+        parquet_writer.close()
+    elapsed = time.time() - start_time
+    print(f"Converted {rows} rows in {elapsed:.2f} seconds ({rows / elapsed if elapsed else 0:.0f} rows/sec)")
+    return rows
+
+# Function to get the path of the output file of the converters
+def get_converted_output_path(csv_output_dir, file_name, output_format="csv"):
+    if not os.path.exists(csv_output_dir):
+        os.makedirs(csv_output_dir)
+    return os.path.join(csv_output_dir, f"{file_name}.{output_format}")
+
+# Function to convert the games to engine_aggregated_game_data, and with merge_engines also to
+# engine_aggregated_game_data_merged_engines (all versions of the same engine merged), in a single pass
+def process_json_files(json_dir_path, csv_output_dir, output_format="csv", merge_engines=False, alias_table_path=None,
+                       profile_options=None):
+    all_files = find_game_files(json_dir_path)
+    output_files = [(get_converted_output_path(csv_output_dir, 'engine_aggregated_game_data', output_format), None)]
+    if merge_engines:
+        alias_index = compile_engine_aliases(load_engine_aliases(alias_table_path))
+        output_files.append((get_converted_output_path(csv_output_dir, 'engine_aggregated_game_data_merged_engines',
+                                                       output_format), alias_index))
+
+    if convert_game_files(all_files, output_files, output_format, profile_options):
+        for csv_output_file, _ in output_files:
+            print(f"Data saved to {csv_output_file}")
     else:
         print("No data to save.")
 
-def main(json_dir, csv_output_dir):
-    process_json_files(json_dir, csv_output_dir)
+def main(json_dir, csv_output_dir, output_format="csv", merge_engines=False, alias_table_path=None,
+         profile_report=None, profiler=None):
+    process_json_files(json_dir, csv_output_dir, output_format, merge_engines, alias_table_path,
+                       get_profile_options(profile_report, profiler))
 
 if __name__ == "__main__":
-    if len(sys.argv) < 3:
-        print("Usage: python json_to_csv_converter.py <json_file_path> <csv_output_dir>")
-        sys.exit(1)
+    parser = argparse.ArgumentParser(usage="python json_to_csv_converter.py <json_file_path> <csv_output_dir> [--output-format {csv,parquet}] [--merge-engines [--alias-table aliases.json]] [--profile-report report.jsonl [--profiler {cprofile,pyinstrument}]]")
+    parser.add_argument("json_dir")
+    parser.add_argument("csv_output_dir")
+    parser.add_argument("--output-format", choices=["csv", "parquet"], default="csv",
+                        help="write the aggregated game data as CSV or as Parquet")
+    parser.add_argument("--merge-engines", action="store_true",
+                        help="also write the games with all versions of the same engine merged, in the same pass")
+    parser.add_argument("--alias-table",
+                        help="JSON file mapping each engine to its aliases (default: the table of engine_aliases.py)")
+    parser.add_argument("--profile-report",
+                        help="append the timings, rates, bytes and peak RSS of each file to this JSON Lines file")
+    parser.add_argument("--profiler", choices=PROFILERS,
+                        help="with --profile-report, also capture a profile of the conversion of each file")
+    args = parser.parse_args()
 
-    json_dir = sys.argv[1]
-    csv_output_dir = sys.argv[2]
-    main(json_dir, csv_output_dir)
+    main(args.json_dir, args.csv_output_dir, args.output_format, args.merge_engines, args.alias_table,
+         args.profile_report, args.profiler)
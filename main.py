@@ -1,53 +1,319 @@
+"""This script runs the whole pipeline in a single process: the stages are modeled as a dependency graph and the
+stages that do not depend on each other run concurrently. The game tables are read once and handed over to the
+stats stages as DataFrames. A stage is skipped when its inputs and settings are the same as in the last run and its
+outputs still exist (see pipeline_cache.json in the CSV output directory).
+The paths and settings are read from a JSON config file (--config) with the keys of DEFAULT_CONFIG, and can be
+overridden on the command line.
+"""
+
+import argparse
+import hashlib
+import json
+import multiprocessing
 import os
-import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import pandas as pd
+import pgn_engine_vs_engine_eval_analyzer
+import json_to_csv_converter
+import chess_stats_summarizer
+import csv_to_player_stats
+import pairing_matrix
+from batch_metrics import WDL_MODELS, DEFAULT_WDL_MODEL, DEFAULT_WDL_PLY
+from stage_profiler import get_profile_options, new_record, phase, write_record
 
-def prompt_for_path(message):
-    return input(f"Enter the {message}: ").strip()
+PIPELINE_CACHE_FILE_NAME = "pipeline_cache.json"
 
-def run_script(script_path, args):
-    try:
-        subprocess.run(['python', script_path] + args, check=True)
-    except subprocess.CalledProcessError as e:
-        print(f"An error occurred while running {script_path}: {e}")
-
-def main():
-    base_path = os.path.dirname(os.path.abspath(__file__))
-    # input directory for CCRL .pgn files, e.g., from https://computerchess.org.uk/ccrl/4040/games.html
-    ccrl_input_dir = ''
-    # output directory for PGN files
-    pgn_output_dir = ''
-    # input directory for PGN files
-    input_pgn_dir = pgn_output_dir
-    # folder path for the output JSON file (from PGN files)
-    json_output_dir = '' 
-    # dir path for the input JSON files (from PGN files)
-    json_dir = json_output_dir
-    # path for the output CSV file (from JSON file)
-    csv_output_dir = ''
-    # input CSV file path for calculating statistics
-    csv_all_games_path = '.../engine_aggregated_game_data.csv'
-    # input CSV file path for calculating merged statistics
-    csv_merged_file_path = '.../engine_aggregated_game_data_merged_engines.csv'
-    # output directory for statistics
-    stats_output_dir = csv_output_dir
-
-
-    # Define the paths and arguments for each script
-    scripts = [
-        ('eval_corrector_ccrl.py', [ccrl_input_dir, pgn_output_dir]), 
-        ('pgn_engine_vs_engine_eval_analyzer.py', [input_pgn_dir, json_output_dir]),
-        ('json_to_csv_converter.py', [json_dir, csv_output_dir]),
-        ('json_to_csv_merge_versions.py', [json_dir, csv_output_dir]),
-        ('chess_stats_summarizer.py', [csv_all_games_path, stats_output_dir]),
-        #('csv_to_player_stats.py', [csv_all_games_path, stats_output_dir]),
-        ('csv_to_player_stats.py', [csv_merged_file_path, player_stats_output_dir])
+# Columns of the game table that is read once for the player stats and the pairing matrix
+PLAYER_GAMES_COLUMNS = csv_to_player_stats.PLAYER_STATS_COLUMNS + \
+    [column for column in pairing_matrix.PAIRING_COLUMNS if column not in csv_to_player_stats.PLAYER_STATS_COLUMNS]
+
+DEFAULT_CONFIG = {
+    # input directory for PGN files, e.g., CCRL .pgn files from https://computerchess.org.uk/ccrl/4040/games.html.
+    # Leave it empty to start from the analyzer outputs in json_dir.
+    "input_pgn_dir": "",
+    # correct the CCRL evals while analyzing, as eval_corrector_ccrl.py does
+    "ccrl": True,
+    # output directory for the corrected PGN files (with ccrl), or empty to not keep them
+    "corrected_pgn_dir": "",
+    # folder path for the output JSON files of the analyzer (from PGN files)
+    "json_dir": "",
+    # output format of the analyzer: json, jsonl (one game per line, written as the games are scored), parquet or arrow
+    "analyzer_output_format": "json",
+    # number of worker processes of the analyzer
+    "workers": 1,
+    # size in MB of the shards of large PGN files that the worker processes of the analyzer analyze
+    "shard_size_mb": 64,
+    # parse and replay every game with python-chess instead of only scanning the headers and the evals
+    "validate": False,
+    # WDL model used to convert the evals to expected points: sf, sf16.1, sf16, sf15.1, sf15, sf14, sf12 or lichess
+    "wdl_model": DEFAULT_WDL_MODEL,
+    # ply at which the WDL model is evaluated (ignored by the lichess model)
+    "wdl_ply": DEFAULT_WDL_PLY,
+    # overlap the reading, analysis and writing of the analyzer with threads connected by bounded queues
+    "analyzer_pipeline": False,
+    # with analyzer_pipeline, number of shards each queue of the analyzer holds
+    "analyzer_queue_depth": 4,
+    # output directory for the per-move dataset of the analyzer, or empty to not write it
+    "moves_dir": "",
+    # format of the per-move dataset: parquet or arrow
+    "moves_format": "parquet",
+    # path for the output CSV files (from JSON files)
+    "csv_output_dir": "",
+    # format of the game tables: csv or parquet
+    "table_format": "csv",
+    # JSON file mapping each engine to its aliases, or empty for the table of engine_aliases.py
+    "alias_table": "",
+    # output directory for statistics (default: csv_output_dir)
+    "stats_output_dir": "",
+    # output directory for the player stats (default: stats_output_dir)
+    "player_stats_output_dir": "",
+    # calculate the player stats from the games with the versions of each engine merged ("merged") or not ("all")
+    "player_stats_input": "merged",
+    # number of bootstrap resamples for the confidence intervals of the player averages, or 0 to not calculate them
+    "bootstrap_resamples": 0,
+    # seed of the bootstrap
+    "bootstrap_seed": 0,
+    # save the density plots of the summary instead of showing them
+    "headless": True,
+    # JSON Lines file for the profiling records of the stages and of the files they process, or empty to not profile
+    "profile_report": "",
+    # with profile_report, also capture profiles of the hot loops: cprofile or pyinstrument
+    "profiler": ""
+}
+
+# Function to get the paths of the game tables written by the convert stage
+def get_game_table_paths(config):
+    return {view: os.path.join(config["csv_output_dir"], f"{file_name}.{config['table_format']}")
+            for view, file_name in [("all", "engine_aggregated_game_data"),
+                                    ("merged", "engine_aggregated_game_data_merged_engines")]}
+
+# Function to read a game table written by the convert stage
+def read_game_table(path, columns=None):
+    if path.endswith('.parquet'):
+        return pd.read_parquet(path, columns=columns)
+    return csv_to_player_stats.read_csv(path, usecols=columns)
+
+# Function to get the context of the worker processes of the stages. They are started from a fork server, because
+# stages run in several threads and forking a process while another thread holds a lock can deadlock it.
+def get_mp_context():
+    return multiprocessing.get_context("forkserver")
+
+def run_analyze(config, inputs):
+    pgn_engine_vs_engine_eval_analyzer.main(
+        config["input_pgn_dir"], config["json_dir"], validate=config["validate"], workers=config["workers"],
+        shard_size_mb=config["shard_size_mb"], wdl_model=config["wdl_model"], wdl_ply=config["wdl_ply"],
+        ccrl=config["ccrl"],
+        corrected_pgn_dir=config["corrected_pgn_dir"] or None, output_format=config["analyzer_output_format"],
+        profile_report=config["profile_report"] or None, profiler=config["profiler"] or None,
+        moves_dir=config["moves_dir"] or None, moves_format=config["moves_format"],
+        pipeline=config["analyzer_pipeline"], queue_depth=config["analyzer_queue_depth"], mp_context=get_mp_context())
+
+def run_convert(config, inputs):
+    json_to_csv_converter.main(config["json_dir"], config["csv_output_dir"], config["table_format"],
+                               merge_engines=True, alias_table_path=config["alias_table"] or None,
+                               profile_report=config["profile_report"] or None, profiler=config["profiler"] or None)
+
+def run_summary(config, inputs):
+    if not os.path.exists(config["stats_output_dir"]):
+        os.makedirs(config["stats_output_dir"])
+    chess_stats_summarizer.summarize_games(inputs["games"], config["stats_output_dir"], config["headless"],
+                                           mp_context=get_mp_context())
+
+def run_pairing_matrix(config, inputs):
+    games = inputs["player_games"][pairing_matrix.PAIRING_COLUMNS]
+    pairing_matrix.save_pairing_matrix(*pairing_matrix.aggregate_pairs(games), config["stats_output_dir"],
+                                       config["table_format"])
+
+def run_player_stats(config, inputs):
+    player_stats = csv_to_player_stats.aggregate_player_stats(inputs["player_games"])
+    if config["bootstrap_resamples"]:
+        player_stats = player_stats.join(csv_to_player_stats.bootstrap_player_cis(
+            inputs["player_games"], config["bootstrap_resamples"], config["bootstrap_seed"], workers=config["workers"],
+            mp_context=get_mp_context()))
+    csv_to_player_stats.save_player_stats(player_stats, config["player_stats_output_dir"])
+
+# Function to define the stages of the pipeline. For each stage:
+# - deps: the stages it depends on, whose results are passed to run(config, inputs) in inputs
+# - inputs: the files whose size and modification time are part of the cache key of the stage
+# - params: the settings that are part of the cache key of the stage
+# - outputs: the files that must exist to skip the stage
+# - lazy: the stage only returns data for other stages, so it runs only if one of them is not skipped
+def get_stages(config):
+    tables = get_game_table_paths(config)
+    stats_dir = config["stats_output_dir"]
+    summary_outputs = [os.path.join(stats_dir, "summarized_game_data.csv")]
+    if config["headless"]:
+        summary_outputs.append(os.path.join(stats_dir, "density_distributions.csv"))
+    stages = [
+        {"name": "analyze", "deps": [], "run": run_analyze,
+         "inputs": lambda: pgn_engine_vs_engine_eval_analyzer.find_pgn_files(config["input_pgn_dir"]),
+         "params": ["input_pgn_dir", "ccrl", "corrected_pgn_dir", "json_dir", "analyzer_output_format", "moves_dir",
+                    "moves_format", "validate", "shard_size_mb", "wdl_model", "wdl_ply"],
+         "outputs": lambda: [config["json_dir"]] + ([config["moves_dir"]] if config["moves_dir"] else [])},
+        {"name": "convert", "deps": ["analyze"], "run": run_convert,
+         "inputs": lambda: json_to_csv_converter.find_game_files(config["json_dir"]),
+         "params": ["csv_output_dir", "table_format", "alias_table"],
+         "outputs": lambda: list(tables.values())},
+        {"name": "games", "deps": ["convert"], "lazy": True,
+         "run": lambda config, inputs: read_game_table(tables["all"]),
+         "inputs": lambda: [tables["all"]], "params": [], "outputs": lambda: []},
+        {"name": "player_games", "deps": ["convert"], "lazy": True,
+         "run": lambda config, inputs: read_game_table(tables[config["player_stats_input"]], PLAYER_GAMES_COLUMNS),
+         "inputs": lambda: [tables[config["player_stats_input"]]], "params": ["player_stats_input"],
+         "outputs": lambda: []},
+        {"name": "summary", "deps": ["games"], "run": run_summary, "inputs": lambda: [],
+         "params": ["stats_output_dir", "headless"], "outputs": lambda: summary_outputs},
+        {"name": "player_stats", "deps": ["player_games"], "run": run_player_stats, "inputs": lambda: [],
+         "params": ["player_stats_output_dir", "bootstrap_resamples", "bootstrap_seed"],
+         "outputs": lambda: [os.path.join(config["player_stats_output_dir"], "player_stats_merged_engines.csv")]},
+        {"name": "pairing_matrix", "deps": ["player_games"], "run": run_pairing_matrix, "inputs": lambda: [],
+         "params": ["stats_output_dir", "table_format"],
+         "outputs": lambda: [os.path.join(stats_dir, f"pairing_matrix.{config['table_format']}"),
+                             os.path.join(stats_dir, "pairing_matrix_dense.npz")]}
     ]
+    # Without PGN input, the pipeline starts from the existing analyzer outputs
+    if not config["input_pgn_dir"]:
+        stages = [stage for stage in stages if stage["name"] != "analyze"]
+        stages[0]["deps"] = []
+    return stages
 
-    # Sequentially run the scripts with their full paths and arguments
-    for script_name, args in scripts:
-        script_path = os.path.join(base_path, script_name)
-        print(f"Running {script_path}...")
-        run_script(script_path, args)
+# Function to calculate the cache key of a stage from its settings, the size and modification time of its input
+# files and the keys of the lazy stages it depends on (other stages hand their results over through the input files)
+def get_stage_key(stage, config, dep_keys):
+    fingerprints = []
+    for path in sorted(stage["inputs"]()):
+        if os.path.exists(path):
+            stat = os.stat(path)
+            fingerprints.append([path, stat.st_size, stat.st_mtime_ns])
+        else:
+            fingerprints.append([path, None, None])
+    description = {"name": stage["name"], "params": {name: config[name] for name in stage["params"]},
+                   "inputs": fingerprints, "deps": [dep_keys[dep] for dep in stage["deps"] if dep in dep_keys]}
+    return hashlib.sha256(json.dumps(description, sort_keys=True).encode()).hexdigest()
+
+def load_pipeline_cache(cache_path):
+    if not os.path.exists(cache_path):
+        return {}
+    try:
+        with open(cache_path, 'r') as cache_file:
+            return json.load(cache_file)
+    except (ValueError, OSError) as e:
+        print(f"Ignoring unreadable pipeline cache {cache_path}: {e}")
+        return {}
+
+# Function to save the cache keys of the stages that finished. It is written to a temporary file first, so an
+# interrupted run never leaves a truncated cache behind.
+def save_pipeline_cache(cache_path, cache):
+    with open(cache_path + ".tmp", 'w') as cache_file:
+        json.dump(cache, cache_file, indent=4)
+    os.replace(cache_path + ".tmp", cache_path)
+
+# Function to run the stages of the pipeline in dependency order, with up to max_parallel stages at a time.
+# Returns the names of the stages that ran.
+def run_pipeline(stages, config, cache_path, force=False, max_parallel=2):
+    cache = {} if force else load_pipeline_cache(cache_path)
+    profile_options = get_profile_options(config["profile_report"], config["profiler"] or None)
+    stages_by_name = {stage["name"]: stage for stage in stages}
+    lazy_keys = {}
+    lazy_results = {}
+    lazy_locks = {stage["name"]: threading.Lock() for stage in stages if stage.get("lazy")}
+    ran = []
+
+    # Function to get the result of a lazy stage, running it the first time it is needed
+    def get_result(name):
+        with lazy_locks[name]:
+            if name not in lazy_results:
+                stage = stages_by_name[name]
+                lazy_results[name] = run_stage(stage)
+            return lazy_results[name]
+
+    def run_stage(stage):
+        start_time = time.time()
+        inputs = {dep: get_result(dep) for dep in stage["deps"] if dep in lazy_locks}
+        print(f"Running stage {stage['name']}...")
+        record = new_record(profile_options, f"pipeline:{stage['name']}", None)
+        with phase(record, "run"):
+            result = stage["run"](config, inputs)
+        write_record(profile_options, record)
+        print(f"Stage {stage['name']} finished in {time.time() - start_time:.2f} seconds")
+        ran.append(stage["name"])
+        return result
+
+    def process_stage(stage):
+        key = get_stage_key(stage, config, lazy_keys)
+        if stage.get("lazy"):
+            lazy_keys[stage["name"]] = key
+            return
+        outputs = stage["outputs"]()
+        if cache.get(stage["name"]) == key and all(os.path.exists(path) for path in outputs):
+            print(f"Skipping stage {stage['name']}: its inputs did not change")
+            return
+        run_stage(stage)
+        cache[stage["name"]] = key
+
+    pending = list(stages)
+    done = set()
+    running = {}
+    with ThreadPoolExecutor(max_workers=max_parallel) as executor:
+        while pending or running:
+            for stage in [stage for stage in pending if all(dep in done for dep in stage["deps"])]:
+                pending.remove(stage)
+                running[executor.submit(process_stage, stage)] = stage["name"]
+            if not running:
+                raise ValueError(f"Unknown or circular dependencies: {[stage['name'] for stage in pending]}")
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                future.result()
+                done.add(name)
+                save_pipeline_cache(cache_path, cache)
+    return ran
+
+# Function to read the config file and apply the overrides of the command line
+def load_config(config_path=None, overrides=None):
+    config = dict(DEFAULT_CONFIG)
+    if config_path:
+        with open(config_path, 'r') as config_file:
+            file_config = json.load(config_file)
+        unknown = set(file_config) - set(DEFAULT_CONFIG)
+        if unknown:
+            raise ValueError(f"Unknown keys in {config_path}: {sorted(unknown)}")
+        config.update(file_config)
+    config.update({name: value for name, value in (overrides or {}).items() if value is not None})
+    config["stats_output_dir"] = config["stats_output_dir"] or config["csv_output_dir"]
+    config["player_stats_output_dir"] = config["player_stats_output_dir"] or config["stats_output_dir"]
+    if config["wdl_model"] not in WDL_MODELS:
+        raise ValueError(f"Unknown wdl_model {config['wdl_model']}, expected one of {WDL_MODELS}")
+    if not config["json_dir"] or not config["csv_output_dir"]:
+        raise ValueError("json_dir and csv_output_dir must be set in the config file or on the command line")
+    return config
+
+def main(config, force=False, max_parallel=2):
+    if not os.path.exists(config["csv_output_dir"]):
+        os.makedirs(config["csv_output_dir"])
+    cache_path = os.path.join(config["csv_output_dir"], PIPELINE_CACHE_FILE_NAME)
+    run_pipeline(get_stages(config), config, cache_path, force, max_parallel)
 
 if __name__ == "__main__":
-    main()
+    start_time = time.time()
+    parser = argparse.ArgumentParser(usage="python main.py [--config pipeline.json] [--input-pgn-dir DIR] [--json-dir DIR] [--csv-output-dir DIR] [...] [--force]")
+    parser.add_argument("--config", help="JSON file with the keys of DEFAULT_CONFIG")
+    for name, default in DEFAULT_CONFIG.items():
+        option = "--" + name.replace("_", "-")
+        if isinstance(default, bool):
+            parser.add_argument(option, dest=name, action=argparse.BooleanOptionalAction, default=None)
+        else:
+            parser.add_argument(option, dest=name, type=type(default), default=None)
+    parser.add_argument("--force", action="store_true", help="run every stage, even if its inputs did not change")
+    parser.add_argument("--max-parallel", type=int, default=2, help="maximum number of stages that run at a time")
+    args = vars(parser.parse_args())
+    config_path, force, max_parallel = args.pop("config"), args.pop("force"), args.pop("max_parallel")
+    try:
+        config = load_config(config_path, args)
+    except ValueError as e:
+        parser.error(str(e))
+
+    main(config, force, max_parallel)
+    print("Pipeline finished in {:.2f} minutes".format((time.time() - start_time) / 60.0))
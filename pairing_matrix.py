@@ -0,0 +1,118 @@
+"""This script builds the head-to-head pairing matrix of the engines from a game table (the CSV or Parquet files of
+json_to_csv_converter.py): for each (White, Black) pair of engines, the number of games, the score of White, the
+mean sGI, sGPL and STCPL of both sides and the difference between the mean sGPL of White and Black.
+The engines are coded as integers and each game gets the code White * engines + Black of its pair, so all pairs
+are aggregated with one grouped pass (np.unique and np.bincount) over the games, whatever the number of engines.
+The pairs that played are written to pairing_matrix.csv (sparse, one row per pair; or .parquet with --table-format
+parquet, which is much faster to write for large tables) and every stat is also written as an engines x engines
+matrix to pairing_matrix_dense.npz (dense, NaN for pairs that did not play).
+"""
+
+import argparse
+import os
+import time
+import numpy as np
+import pandas as pd
+from engine_aliases import load_engine_aliases, compile_engine_aliases
+from json_to_csv_converter import merge_frame_engines
+
+PAIR_STATS = ['sgi', 'sgpl', 'stcpl']
+
+# Columns of the game table that are needed for the pairing matrix
+PAIRING_COLUMNS = ['White', 'Black', 'WhiteResult', 'BlackResult'] + \
+    [f'{color}_{stat}' for color in ['white', 'black'] for stat in PAIR_STATS]
+
+# Function to read the columns of a game table that are needed for the pairing matrix
+def read_pairing_games(table_path):
+    if table_path.endswith('.parquet'):
+        return pd.read_parquet(table_path, columns=PAIRING_COLUMNS)
+    return pd.read_csv(table_path, usecols=PAIRING_COLUMNS)
+
+# Function to calculate the mean of values for each pair, ignoring missing values. Pairs without values get NaN.
+def mean_by_pair(pair_index, values, n_pairs):
+    valid = ~np.isnan(values)
+    count = np.bincount(pair_index[valid], minlength=n_pairs)
+    total = np.bincount(pair_index[valid], weights=values[valid], minlength=n_pairs)
+    return np.divide(total, count, out=np.full(n_pairs, np.nan), where=count > 0)
+
+# Function to aggregate the games of each (White, Black) pair. Returns the sparse table of the pairs that played,
+# the sorted engine names and the White and Black engine codes of each row of the table. Games without an engine
+# name are dropped.
+def aggregate_pairs(df):
+    names = pd.concat([df['White'], df['Black']], ignore_index=True).astype(object)
+    codes, engines = pd.factorize(names, sort=True)
+    white_codes, black_codes = codes[:len(df)], codes[len(df):]
+    named = (white_codes >= 0) & (black_codes >= 0)
+    n_engines = len(engines)
+    pair_codes, pair_index = np.unique(white_codes[named].astype(np.int64) * n_engines + black_codes[named],
+                                       return_inverse=True)
+    pair_index = pair_index.ravel()
+    n_pairs = len(pair_codes)
+    # Unfinished games have '...' as result and are not scored
+    white_result = pd.to_numeric(df['WhiteResult'], errors='coerce').to_numpy(dtype=np.float64)[named]
+    scored = ~np.isnan(white_result)
+    pairs = pd.DataFrame({'White': np.asarray(engines)[pair_codes // n_engines],
+                          'Black': np.asarray(engines)[pair_codes % n_engines]})
+    pairs['games'] = np.bincount(pair_index, minlength=n_pairs)
+    pairs['scored_games'] = np.bincount(pair_index[scored], minlength=n_pairs)
+    pairs['white_score'] = np.bincount(pair_index[scored], weights=white_result[scored], minlength=n_pairs)
+    pairs['white_score_pct'] = np.divide(pairs['white_score'], pairs['scored_games'], out=np.full(n_pairs, np.nan),
+                                         where=pairs['scored_games'] > 0)
+    for stat in PAIR_STATS:
+        for color in ['white', 'black']:
+            values = pd.to_numeric(df[f'{color}_{stat}'], errors='coerce').to_numpy(dtype=np.float64)[named]
+            pairs[f'mean_{color}_{stat}'] = mean_by_pair(pair_index, values, n_pairs)
+    pairs['sgpl_diff'] = pairs['mean_white_sgpl'] - pairs['mean_black_sgpl']
+    return pairs, np.asarray(engines, dtype=str), pair_codes // n_engines, pair_codes % n_engines
+
+# Function to place the stats of the pairs in engines x engines matrices (rows: White, columns: Black). Game counts
+# are int32 (0 for pairs that did not play) and the other stats float32 (NaN for pairs that did not play).
+def pairs_to_dense(pairs, white_codes, black_codes, n_engines):
+    matrices = {}
+    for column in pairs.columns[2:]:
+        if column in ('games', 'scored_games'):
+            matrix = np.zeros((n_engines, n_engines), dtype=np.int32)
+        else:
+            matrix = np.full((n_engines, n_engines), np.nan, dtype=np.float32)
+        matrix[white_codes, black_codes] = pairs[column].to_numpy()
+        matrices[column] = matrix
+    return matrices
+
+# Function to save the sparse and dense pairing matrices. The dense matrices are not compressed, so they are written
+# in about the time it takes to copy them.
+def save_pairing_matrix(pairs, engines, white_codes, black_codes, output_dir, table_format="csv"):
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    sparse_path = os.path.join(output_dir, f'pairing_matrix.{table_format}')
+    if table_format == "parquet":
+        pairs.to_parquet(sparse_path, index=False)
+    else:
+        pairs.to_csv(sparse_path, index=False)
+    dense_path = os.path.join(output_dir, 'pairing_matrix_dense.npz')
+    np.savez(dense_path, engines=engines, **pairs_to_dense(pairs, white_codes, black_codes, len(engines)))
+    print(f"Pairing matrix of {len(engines)} engines ({len(pairs)} pairs) saved to {sparse_path} and {dense_path}")
+
+def main(table_path, output_dir, merge_engine_versions=False, alias_table_path=None, table_format="csv"):
+    if not os.path.exists(table_path):
+        print(f"File not found: {table_path}")
+        return
+    df = read_pairing_games(table_path)
+    if merge_engine_versions:
+        df = merge_frame_engines(df, compile_engine_aliases(load_engine_aliases(alias_table_path)))
+    save_pairing_matrix(*aggregate_pairs(df), output_dir, table_format)
+
+if __name__ == "__main__":
+    start_time = time.time()
+    parser = argparse.ArgumentParser(usage="python pairing_matrix.py <game_table.csv|.parquet> <output_dir> [--merge-engine-versions [--alias-table aliases.json]] [--table-format {csv,parquet}]")
+    parser.add_argument("table_path")
+    parser.add_argument("output_dir")
+    parser.add_argument("--merge-engine-versions", action="store_true",
+                        help="merge all versions of the same engine, as json_to_csv_merge_versions.py does")
+    parser.add_argument("--alias-table",
+                        help="JSON file mapping each engine to its aliases (default: the table of engine_aliases.py)")
+    parser.add_argument("--table-format", choices=["csv", "parquet"], default="csv",
+                        help="format of the sparse pairing matrix")
+    args = parser.parse_args()
+
+    main(args.table_path, args.output_dir, args.merge_engine_versions, args.alias_table, args.table_format)
+    print("Script finished in {:.2f} minutes".format((time.time() - start_time) / 60.0))
@@ -9,9 +9,39 @@ import chess.engine
 import json
 import os
 from chess.engine import Cp, Wdl
-import sys
 import time
+import argparse
+import io
+import collections
+import threading
+from concurrent.futures import ProcessPoolExecutor
 import chardet
+import shutil
+from pgn_eval_scanner import scan_games
+from eval_corrector_ccrl import (process_game, eval_from_ccrl_comment, correct_pgn_file, correct_pgn_lines,
+                                 get_corrected_pgn_name)
+from compressed_pgn import open_pgn, is_pgn_file, is_compressed, strip_compression_extension
+from batch_metrics import calculate_batch_stats, flatten_pawns_lists, WDL_MODELS, DEFAULT_WDL_MODEL, DEFAULT_WDL_PLY
+from split_large_pgn import GAME_START_REGEX, load_game_index, plan_shards
+from analysis_manifest import load_manifest, save_manifest, describe_input_file, is_up_to_date
+from columnar_output import (OUTPUT_FORMATS, OUTPUT_EXTENSIONS, MOVES_FORMATS, resolve_output_format,
+                             games_to_table, open_columnar_writer, moves_to_table, get_moves_path, open_moves_writer)
+from stage_profiler import (PROFILERS, get_profile_options, new_record, phase, add_phase_time, add_counts,
+                            merge_record, write_record, capture_profile, file_size, get_peak_rss,
+                            write_pipeline_record)
+from pipeline_queues import (DONE, new_queue, queue_put, queue_get, start_stage_thread, queue_metrics,
+                             format_queue_metrics)
+
+# Version of the analyzer outputs, recorded in the manifest. Increase it when the stats change, so that the next
+# run analyzes every file again.
+ANALYZER_VERSION = 1
+
+# Number of games whose stats are calculated together
+BATCH_SIZE = 4096
+
+# Capacity of the queues between the stages of the pipelined analyzer (--pipeline): shards for the reader, and shards
+# (with worker processes) or batches of games for the writer
+PIPELINE_QUEUE_DEPTH = 4
 
 # Function to extract the evaluation from a node
 def extract_eval_from_node(node):
@@ -25,11 +55,17 @@ def extract_eval_from_node(node):
 
 # Function to extract the evaluations from a PGN file
 def extract_pawn_evals_from_pgn(game):
-    pawns_list = [0]
+    evals = []
     for node in game.mainline():
         eval_value = extract_eval_from_node(node)
         if eval_value is not None:
-            pawns_list.append(eval_value)
+            evals.append(eval_value)
+    return pawns_list_from_evals(evals)
+
+# Function to build the pawns_list from the evals of the mainline moves, where the eval before the first move
+# is set to the eval after it
+def pawns_list_from_evals(evals):
+    pawns_list = [0] + evals
     if len(pawns_list) > 1:
         pawns_list[0] = pawns_list[1]
     #print("pawns_list: ", pawns_list)
@@ -188,100 +224,583 @@ def calculate_engine_vs_engine_GI(pawns_list, game_result):
     # Return the average SCPL for both White and Black
     return white_stcpl, black_stcpl, white_sgi, black_sgi, white_sgpl, black_sgpl
 
+# Function to detect the character encoding of a PGN file from its (decompressed) first bytes
 def detect_encoding(file_path):
-    with open(file_path, 'rb') as f:
+    with open_pgn(file_path) as f:
         raw_data = f.read(50000)  # Read first 50,000 bytes to guess encoding
     return chardet.detect(raw_data)['encoding']
 
-def main(input_pgn_dir, output_json_dir):
-    # Ensure the output directory exists
-    if not os.path.exists(output_json_dir):
-        os.makedirs(output_json_dir)
-    # Define the output JSON file path
-    aggregated_data = {}
-    key_counter = 1
-    # walk through all pgn files in the dir
+# Function to read the games of a PGN file as (headers, pawns_list) pairs. By default only the headers and the
+# eval comments are scanned; with validate=True every game is parsed and replayed by python-chess.
+# With ccrl=True the input is a raw CCRL PGN file, whose evals are corrected on the fly as eval_corrector_ccrl.py
+# does. If an exporter is given, the (corrected) games are also written with it.
+def read_games(pgn, validate=False, ccrl=False, exporter=None):
+    if validate or exporter is not None:
+        while True:
+            game = chess.pgn.read_game(pgn)
+            if game is None:
+                break
+            if ccrl:
+                process_game(game)
+            if exporter is not None:
+                game.accept(exporter)
+            yield game.headers, extract_pawn_evals_from_pgn(game)
+    else:
+        for headers, evals in scan_games(pgn, eval_from_ccrl_comment if ccrl else None):
+            yield headers, pawns_list_from_evals(evals)
+
+# Function to get the details of a game from its headers
+def get_game_details(headers):
+    game_result = headers.get('Result', None)
+    if game_result == '1-0':
+        whiteResult = 1
+        blackResult = 0
+    elif game_result == '0-1':
+        whiteResult = 0
+        blackResult = 1
+    elif game_result == '1/2-1/2':
+        whiteResult = 0.5
+        blackResult = 0.5
+    else:
+        whiteResult = '...'
+        blackResult = '...'
+    # Further game details
+    game_details = {
+        "White": headers.get("White", None),
+        "Black": headers.get("Black", None),
+        "Event": headers.get("Event", None),
+        "Site": headers.get("Site", None),
+        "Round": headers.get("Round", None),
+        "WhiteElo": headers.get("WhiteElo", None),
+        "BlackElo": headers.get("BlackElo", None),
+        "WhiteResult": whiteResult,
+        "BlackResult": blackResult,
+        "Date": headers.get("Date", None),
+            }
+    return game_details
+
+# Function to calculate the stats of a single game
+def analyze_game(headers, pawns_list):
+    # Get the headers of the game
+    game_result = headers.get('Result', None)
+    game_details = get_game_details(headers)
+
+    white_acpl, black_acpl = calculate_acpl(pawns_list)
+
+    #black_moves = (len(pawns_list) - 1) // 2
+    #white_moves = len(pawns_list) - 1 - black_moves
+
+    # Calculate GI and GPL for both players
+    white_gi, black_gi, white_gpl, black_gpl, white_move_number, black_move_number = gi_and_gpl(pawns_list, game_result)
+
+    white_stcpl, black_stcpl, white_sgi, black_sgi, white_sgpl, black_sgpl = calculate_engine_vs_engine_GI(pawns_list, game_result)
+
+    game_data = {
+        "white_sgi": round(white_sgi, 4), "black_sgi": round(black_sgi, 4),
+        "white_sgpl": round(white_sgpl, 4), "black_sgpl": round(black_sgpl, 4),
+        "white_stcpl": round(white_stcpl, 4), "black_stcpl": round(black_stcpl, 4),
+        "white_gi": round(white_gi, 4), "black_gi": round(black_gi, 4),
+        "white_gpl": round(white_gpl, 4), "black_gpl": round(black_gpl, 4),
+        "white_acpl": round(white_acpl, 4), "black_acpl": round(black_acpl, 4),
+        "white_move_number": white_move_number, "black_move_number": black_move_number,
+        **game_details,
+    }
+    return game_data
+
+# Function to calculate the stats of a batch of (headers, pawns_list) games at once, with the same results as
+# analyze_game for the default WDL model. With per_move=True the per-move arrays of calculate_batch_stats are
+# returned too.
+def analyze_games(games, wdl_model=DEFAULT_WDL_MODEL, wdl_ply=DEFAULT_WDL_PLY, per_move=False):
+    pawns, offsets = flatten_pawns_lists([pawns_list for headers, pawns_list in games])
+    stats = calculate_batch_stats(pawns, offsets, [headers.get('Result', None) for headers, pawns_list in games],
+                                  wdl_model, wdl_ply, per_move)
+    if per_move:
+        stats, moves = stats
+        return games_data_from_stats(stats, [headers for headers, pawns_list in games]), moves
+    return games_data_from_stats(stats, [headers for headers, pawns_list in games])
+
+# Function to build the per-game dicts of the output files from the batch stats and the headers of the games
+def games_data_from_stats(stats, headers_list):
+    stats = {name: values.tolist() for name, values in stats.items()}
+    games_data = []
+    for index, headers in enumerate(headers_list):
+        game_data = {name: values[index] if name.endswith('_move_number') else round(values[index], 4)
+                     for name, values in stats.items()}
+        game_data.update(get_game_details(headers))
+        games_data.append(game_data)
+    return games_data
+
+# Function to list the PGN files of a directory (plain or compressed) in the order they are processed
+def find_pgn_files(input_pgn_dir):
+    pgn_files = []
     for dirpath, dirnames, filenames in os.walk(input_pgn_dir):
         for filename in filenames:
-            if filename.endswith('.pgn'):
-                aggregated_data = {}
-                pgn_file_path = os.path.join(dirpath, filename)
-                print("pgn_file_path :", pgn_file_path)
-                json_file_name = filename.replace('.pgn', '.json')
-                output_json_path = os.path.join(output_json_dir, json_file_name)    
+            if is_pgn_file(filename):
+                pgn_files.append(os.path.join(dirpath, filename))
+    return pgn_files
+
+# Function to find the byte offset of the first game that starts after the given offset, or None if there is none
+def find_game_start(pgn_file, offset):
+    pgn_file.seek(offset)
+    buffer = b""
+    buffer_offset = offset
+    while True:
+        chunk = pgn_file.read(1024 * 1024)
+        if not chunk:
+            return None
+        buffer += chunk
+        match = GAME_START_REGEX.search(buffer)
+        if match:
+            return buffer_offset + match.end()
+        # Keep the end of the buffer in case a game start is cut by the chunk boundary
+        buffer_offset += len(buffer) - 256
+        buffer = buffer[-256:]
+
+# Function to split a PGN file into (start, end) byte ranges of about shard_size bytes, aligned to game starts.
+# The game index written by split_large_pgn.py is used if the file has one.
+def split_into_shards(pgn_file_path, shard_size):
+    file_size = os.path.getsize(pgn_file_path)
+    offsets = load_game_index(pgn_file_path)
+    if offsets is not None and len(offsets) > 1:
+        return [(int(start), int(end)) for start, end in plan_shards(offsets, shard_size)]
+    starts = [0]
+    with open(pgn_file_path, 'rb') as pgn_file:
+        while starts[-1] + shard_size < file_size:
+            game_start = find_game_start(pgn_file, starts[-1] + shard_size)
+            if game_start is None:
+                break
+            starts.append(game_start)
+    return list(zip(starts, starts[1:] + [file_size]))
+
+# Function to read the bytes of a byte range of a file (to the end of the file if end is None)
+def read_shard(pgn_file_path, start, end):
+    with open(pgn_file_path, 'rb') as pgn_file:
+        pgn_file.seek(start)
+        return pgn_file.read() if end is None else pgn_file.read(end - start)
+
+# Function to calculate the stats of a batch of games of a shard, and count them in the profiling record. Returns the
+# stats of the games and their per-move arrays (None unless the task writes them).
+def analyze_batch(games, task, record):
+    moves = None
+    with phase(record, 'metrics'):
+        games_data = analyze_games(games, task['wdl_model'], task['wdl_ply'], task['per_move'])
+        if task['per_move']:
+            games_data, moves = games_data
+    if record is not None:
+        add_counts(record, games=len(games), plies=sum(len(pawns_list) for headers, pawns_list in games))
+    return games_data, moves
+
+# Function to analyze the games of a whole PGN file (end=None) or of a byte range of it, batch by batch. The bytes of
+# the range can be given as data if they were already read (prefetched). Yields the stats of each batch of games and
+# their per-move arrays (None unless the task writes them), with the game indexes counted from the start of the
+# batch. The profiling record (None if profiling is off) is completed once the last batch is taken.
+def iter_shard_batches(task, record, data=None):
+    pgn_file_path, file_encoding, start, end = task['pgn_file_path'], task['file_encoding'], task['start'], task['end']
+    add_counts(record, bytes_read=(end if end is not None else file_size(pgn_file_path)) - start)
+    ccrl = task['ccrl']
+    corrected_pgn_path = get_corrected_pgn_part_path(task)
+    if corrected_pgn_path and not task['validate']:
+        # Correct the evals at the text level and analyze the corrected PGN
+        with phase(record, 'correct'):
+            if data is not None:
+                with open(corrected_pgn_path, 'wb') as corrected_pgn:
+                    corrected_pgn.writelines(correct_pgn_lines(io.BytesIO(data)))
+            else:
+                correct_pgn_file(pgn_file_path, corrected_pgn_path, start, end)
+        add_counts(record, bytes_written=file_size(corrected_pgn_path))
+        pgn_file_path, start, end, ccrl, data = corrected_pgn_path, 0, None, False, None
+        corrected_pgn_path = None
+    if data is None and end is None:
+        pgn = open_pgn(pgn_file_path, 'r', encoding=file_encoding, errors='replace')
+    else:
+        if data is None:
+            data = read_shard(pgn_file_path, start, end)
+        pgn = io.TextIOWrapper(io.BytesIO(data), encoding=file_encoding, errors='replace')
+    corrected_pgn = open(corrected_pgn_path, 'w') if corrected_pgn_path else None
+    exporter = chess.pgn.FileExporter(corrected_pgn) if corrected_pgn else None
+    loop_start = time.perf_counter()
+    # The time spent in the caller between the batches is not counted
+    consumer_seconds = 0.0
+    with pgn, capture_profile(task['profile'], 'analyze', task['pgn_file_path'], task['start']):
+        games = []
+        for game in read_games(pgn, task['validate'], ccrl, exporter):
+            games.append(game)
+            if len(games) == BATCH_SIZE:
+                batch = analyze_batch(games, task, record)
+                yield_start = time.perf_counter()
+                yield batch
+                consumer_seconds += time.perf_counter() - yield_start
+                games = []
+        if games:
+            batch = analyze_batch(games, task, record)
+            yield_start = time.perf_counter()
+            yield batch
+            consumer_seconds += time.perf_counter() - yield_start
+    if corrected_pgn:
+        corrected_pgn.close()
+        add_counts(record, bytes_written=file_size(corrected_pgn_path))
+    if record is not None:
+        # The games are read, parsed and their evals extracted between the batches
+        add_phase_time(record, 'parse', time.perf_counter() - loop_start - consumer_seconds -
+                       record['phases'].get('metrics', 0.0))
+        record['peak_rss_bytes'] = get_peak_rss()
+
+# Function to analyze the games of a whole PGN file (end=None) or of a byte range of it. Runs in worker processes.
+# The bytes of the range can be given as data if they were already read (prefetched). Returns the stats of the games,
+# the profiling record of the shard (None if profiling is off) and the per-move arrays of each batch of games (empty
+# unless the task writes them), with the game indexes counted from the start of the shard.
+def analyze_shard(task, data=None):
+    if task['reused']:
+        return [], None, []
+    record = new_record(task['profile'], 'analyze', task['pgn_file_path'])
+    games_data = []
+    moves_batches = []
+    for games, moves in iter_shard_batches(task, record, data):
+        if moves is not None:
+            moves['game'] += len(games_data)
+            moves_batches.append(moves)
+        games_data.extend(games)
+    return games_data, record, moves_batches
+
+# Function to get the path of the corrected PGN file of a task, or None if corrected PGN files are not written.
+# Shards of a file write to their own part file, which is appended to the corrected PGN file when merging.
+def get_corrected_pgn_part_path(task):
+    if not task['corrected_pgn_path']:
+        return None
+    if task['end'] is None:
+        return task['corrected_pgn_path']
+    return f"{task['corrected_pgn_path']}.part{task['start']}"
+
+# Function to append the part file of a shard to its corrected PGN file
+def merge_corrected_pgn_part(task):
+    part_path = get_corrected_pgn_part_path(task)
+    if part_path is None or part_path == task['corrected_pgn_path']:
+        return
+    with open(task['corrected_pgn_path'], 'wb' if task['start'] == 0 else 'ab') as corrected_pgn, \
+            open(part_path, 'rb') as part:
+        shutil.copyfileobj(part, corrected_pgn)
+    os.remove(part_path)
+
+def main(input_pgn_dir, output_json_dir, validate=False, workers=1, shard_size_mb=64, wdl_model=DEFAULT_WDL_MODEL,
+         wdl_ply=DEFAULT_WDL_PLY, ccrl=False, corrected_pgn_dir=None, output_format="json", force=False,
+         profile_report=None, profiler=None, moves_dir=None, moves_format="parquet", pipeline=False,
+         queue_depth=PIPELINE_QUEUE_DEPTH, mp_context=None):
+    output_format = resolve_output_format(output_format)
+    if moves_dir:
+        moves_format = resolve_output_format(moves_format)
+    profile_options = get_profile_options(profile_report, profiler)
+    file_records = {}
+    # Ensure the output directories exist
+    if not os.path.exists(output_json_dir):
+        os.makedirs(output_json_dir)
+    if corrected_pgn_dir and not os.path.exists(corrected_pgn_dir):
+        os.makedirs(corrected_pgn_dir)
+    manifest = load_manifest(output_json_dir)
+
+    # Split the work into shards: whole files, and game-aligned byte ranges of large files when running in parallel or
+    # pipelined. Files that did not change since the last run with the same settings are not analyzed again.
+    def plan_tasks():
+        for pgn_file_path in find_pgn_files(input_pgn_dir):
+            manifest_key = os.path.relpath(pgn_file_path, input_pgn_dir)
+            previous_entry = manifest["files"].get(manifest_key)
+            corrected_pgn_path = None
+            if corrected_pgn_dir:
+                corrected_pgn_name = get_corrected_pgn_name(os.path.basename(pgn_file_path))
+                corrected_pgn_path = os.path.join(corrected_pgn_dir, corrected_pgn_name)
+            output_path = get_output_path(pgn_file_path, output_json_dir, output_format)
+            record = file_records[pgn_file_path] = new_record(profile_options, 'analyze', pgn_file_path)
+            with phase(record, 'hash'):
+                manifest_entry = describe_input_file(pgn_file_path, previous_entry)
+            manifest_entry.update({'analyzer_version': ANALYZER_VERSION, 'wdl_model': wdl_model, 'wdl_ply': wdl_ply,
+                                   'ccrl': ccrl, 'validate': validate, 'output_format': output_format,
+                                   'corrected_pgn_path': corrected_pgn_path})
+            moves_path = None
+            if moves_dir:
+                moves_path = get_moves_path(moves_dir, pgn_file_path, moves_format)
+                manifest_entry.update({'moves_dir': moves_dir, 'moves_format': moves_format})
+            # Files without games have no output file
+            output_paths = [path for path in [output_path, corrected_pgn_path, moves_path] if path] \
+                if previous_entry and previous_entry.get('games') else []
+            if not force and is_up_to_date(previous_entry, manifest_entry, output_paths):
+                manifest_entry['games'] = previous_entry['games']
+                yield {'pgn_file_path': pgn_file_path, 'manifest_key': manifest_key,
+                       'manifest_entry': manifest_entry, 'reused': True, 'profile': profile_options}
+                continue
+            with phase(record, 'detect_encoding'):
                 file_encoding = detect_encoding(pgn_file_path)
-                #print("file_encoding: ", file_encoding)
-                with open(pgn_file_path, encoding=file_encoding, errors='replace') as pgn:
-                    while True:
-                        game = chess.pgn.read_game(pgn)
-                        if game is None:
-                            break
-                        # Get the headers of the game
-                        game_result = game.headers.get('Result', None)
-                        if game_result == '1-0':
-                            whiteResult = 1
-                            blackResult = 0
-                        elif game_result == '0-1':
-                            whiteResult = 0
-                            blackResult = 1
-                        elif game_result == '1/2-1/2':
-                            whiteResult = 0.5
-                            blackResult = 0.5
-                        else:
-                            whiteResult = '...'
-                            blackResult = '...'
-                        # Further game details
-                        game_details = {
-                            "White": game.headers.get("White", None),
-                            "Black": game.headers.get("Black", None),
-                            "Event": game.headers.get("Event", None),
-                            "Site": game.headers.get("Site", None),
-                            "Round": game.headers.get("Round", None),
-                            "WhiteElo": game.headers.get("WhiteElo", None),
-                            "BlackElo": game.headers.get("BlackElo", None),
-                            "WhiteResult": whiteResult,
-                            "BlackResult": blackResult,
-                            "Date": game.headers.get("Date", None),
-                                }
-
-                        pawns_list = extract_pawn_evals_from_pgn(game)
-                        white_acpl, black_acpl = calculate_acpl(pawns_list)
-
-                        #black_moves = (len(pawns_list) - 1) // 2
-                        #white_moves = len(pawns_list) - 1 - black_moves
-
-                        # Calculate GI and GPL for both players
-                        white_gi, black_gi, white_gpl, black_gpl, white_move_number, black_move_number = gi_and_gpl(pawns_list, game_result)
-
-                        white_stcpl, black_stcpl, white_sgi, black_sgi, white_sgpl, black_sgpl = calculate_engine_vs_engine_GI(pawns_list, game_result)
-
-                        key = key_counter
-                        game_data = {
-                            "white_sgi": round(white_sgi, 4), "black_sgi": round(black_sgi, 4),
-                            "white_sgpl": round(white_sgpl, 4), "black_sgpl": round(black_sgpl, 4),
-                            "white_stcpl": round(white_stcpl, 4), "black_stcpl": round(black_stcpl, 4),
-                            "white_gi": round(white_gi, 4), "black_gi": round(black_gi, 4),
-                            "white_gpl": round(white_gpl, 4), "black_gpl": round(black_gpl, 4),
-                            "white_acpl": round(white_acpl, 4), "black_acpl": round(black_acpl, 4),
-                            "white_move_number": white_move_number, "black_move_number": black_move_number,
-                            **game_details,
-                        }
-                        aggregated_data[key] = game_data
-                        key_counter += 1
-                if aggregated_data:
-                    with open(output_json_path, 'w') as json_file:
-                        json.dump(aggregated_data, json_file, indent=4)
-                    #print(f"Aggregated data saved to {output_json_path}")
-    print(f"#Games = {key_counter}")
-    
+            #print("file_encoding: ", file_encoding)
+            # Compressed files are read as a stream from start to end
+            if (workers > 1 or pipeline) and not is_compressed(pgn_file_path):
+                shards = split_into_shards(pgn_file_path, shard_size_mb * 1024 * 1024)
+            else:
+                shards = [(0, None)]
+            for start, end in shards:
+                yield {'pgn_file_path': pgn_file_path, 'file_encoding': file_encoding, 'start': start, 'end': end,
+                       'validate': validate, 'wdl_model': wdl_model, 'wdl_ply': wdl_ply, 'ccrl': ccrl,
+                       'corrected_pgn_path': corrected_pgn_path, 'manifest_key': manifest_key,
+                       'manifest_entry': manifest_entry, 'reused': False, 'profile': profile_options,
+                       'per_move': moves_path is not None, 'moves_path': moves_path}
+
+    executor = ProcessPoolExecutor(max_workers=workers, mp_context=mp_context) if workers > 1 else None
+    state = new_merge_state(output_json_dir, output_format, moves_format, manifest, file_records)
+    if pipeline:
+        queues = run_pipeline(plan_tasks(), state, executor, workers, queue_depth)
+        for pipeline_queue in queues:
+            print(format_queue_metrics(pipeline_queue))
+        write_pipeline_record(profile_options, input_pgn_dir, queues)
+    elif executor:
+        tasks = list(plan_tasks())
+        for task, (games, shard_record, moves_batches) in zip(tasks, executor.map(analyze_shard, tasks)):
+            merge_results(state, task, games, shard_record, moves_batches)
+        finish_merge(state)
+    else:
+        # Each batch of games is merged as soon as it is scored, so only the JSON output holds all the games of a file
+        for task in list(plan_tasks()):
+            for results in iter_task_results(task):
+                merge_results(state, task, *results)
+        finish_merge(state)
+    if executor:
+        executor.shutdown()
+    print(f"#Games = {state['key_counter']}")
+
+# Function to start the merge of the results of the tasks into the output files
+def new_merge_state(output_json_dir, output_format, moves_format, manifest, file_records):
+    return {'output_json_dir': output_json_dir, 'output_format': output_format, 'moves_format': moves_format,
+            'manifest': manifest, 'file_records': file_records, 'aggregated_data': {}, 'output_writer': None,
+            'moves_writer': None, 'name_dictionaries': {}, 'key_counter': 1, 'file_first_key': 1,
+            'current_task': None, 'merging_task': None}
+
+# Function to analyze a task in the calling process, batch by batch. Yields the results of each batch of games as
+# (games, None, moves_batches, False) and then the end of the task as ([], shard_record, [], True), to be passed
+# to merge_results as they come.
+def iter_task_results(task, data=None):
+    record = None
+    if not task['reused']:
+        record = new_record(task['profile'], 'analyze', task['pgn_file_path'])
+        for games, moves in iter_shard_batches(task, record, data):
+            yield games, None, [] if moves is None else [moves], False
+    yield [], record, [], True
+
+# Function to merge the results of a task, or with last=False a part of them (e.g. the games of a batch), followed by
+# the other parts and the last one. The results must be merged in task order, so the game keys are the same as in a
+# sequential run. Columnar and JSON Lines files are written batch by batch instead of collecting the games of a whole
+# file, and so are the per-move files.
+def merge_results(state, task, games, shard_record, moves_batches, last=True):
+    pgn_file_path = task['pgn_file_path']
+    record = state['file_records'][pgn_file_path]
+    if task is not state['merging_task']:
+        state['merging_task'] = task
+        if state['current_task'] is None or pgn_file_path != state['current_task']['pgn_file_path']:
+            finish_output_file(state['current_task'], state['key_counter'] - state['file_first_key'],
+                               state['aggregated_data'], state['output_writer'], state['output_json_dir'],
+                               state['manifest'], state['file_records'], state['moves_writer'])
+            state.update({'aggregated_data': {}, 'output_writer': None, 'moves_writer': None,
+                          'name_dictionaries': {}, 'current_task': task, 'file_first_key': state['key_counter']})
+            print("pgn_file_path :", pgn_file_path)
+        if task['reused']:
+            # Keep the keys of the games of the previous run
+            print("Unchanged since the last run, reusing its output")
+            state['key_counter'] += task['manifest_entry']['games']
+            return
+    if last:
+        merge_record(record, shard_record)
+        merge_corrected_pgn_part(task)
+    if moves_batches:
+        with phase(record, 'write_moves'):
+            if state['moves_writer'] is None:
+                state['moves_writer'] = open_moves_writer(task['moves_path'], state['moves_format'])
+            for moves in moves_batches:
+                state['moves_writer'].write_table(moves_to_table(state['key_counter'], moves))
+    output_format = state['output_format']
+    if output_format != "json":
+        if games:
+            with phase(record, 'write'):
+                if state['output_writer'] is None:
+                    output_path = get_output_path(pgn_file_path, state['output_json_dir'], output_format)
+                    state['output_writer'] = open(output_path, 'w') if output_format == "jsonl" \
+                        else open_columnar_writer(output_path, output_format)
+                if output_format == "jsonl":
+                    write_jsonl_games(state['output_writer'], state['key_counter'], games)
+                else:
+                    state['output_writer'].write_table(games_to_table(
+                        state['key_counter'], games, state['name_dictionaries'] if output_format == "arrow" else None))
+            state['key_counter'] += len(games)
+        return
+    aggregated_data = state['aggregated_data']
+    for game_data in games:
+        aggregated_data[state['key_counter']] = game_data
+        state['key_counter'] += 1
+
+# Function to finish the output file of the last PGN file once the results of all tasks are merged
+def finish_merge(state):
+    finish_output_file(state['current_task'], state['key_counter'] - state['file_first_key'],
+                       state['aggregated_data'], state['output_writer'], state['output_json_dir'], state['manifest'],
+                       state['file_records'], state['moves_writer'])
+
+# Function to run the tasks as a pipeline of stages connected by bounded queues, so that reading, computing and
+# writing overlap: a reader thread plans the tasks (hashing the files and detecting their encoding) and prefetches the
+# bytes of the next shards, the calling thread analyzes them (or hands them to the worker processes of the executor,
+# keeping queue_depth shards in flight beyond the workers), and a writer thread merges the results and serializes the
+# output files. Returns the metrics of the queues.
+def run_pipeline(tasks, state, executor, workers, queue_depth):
+    stop_event = threading.Event()
+    errors = []
+    read_queue = new_queue('read', queue_depth, stop_event)
+    write_queue = new_queue('write', queue_depth, stop_event)
+    if executor:
+        # Start the worker processes before the threads, so that they are not forked while a thread holds a lock
+        executor.submit(os.getpid).result()
+    threads = [start_stage_thread('reader', prefetch_shards, (tasks, read_queue), stop_event, errors),
+               start_stage_thread('writer', write_results, (state, write_queue), stop_event, errors)]
+    try:
+        in_flight = collections.deque()
+        while True:
+            item = queue_get(read_queue)
+            if item is DONE:
+                break
+            task, data, read_seconds = item
+            if executor is None:
+                # Each batch of games is handed to the writer as soon as it is scored
+                if not all(queue_put(write_queue, (task, read_seconds, results))
+                           for results in iter_task_results(task, data)):
+                    break
+                continue
+            in_flight.append((task, read_seconds, executor.submit(analyze_shard, task, data)))
+            if len(in_flight) >= workers + queue_depth:
+                task, read_seconds, future = in_flight.popleft()
+                if not queue_put(write_queue, (task, read_seconds, future.result() + (True,))):
+                    break
+        while in_flight and not stop_event.is_set():
+            task, read_seconds, future = in_flight.popleft()
+            queue_put(write_queue, (task, read_seconds, future.result() + (True,)))
+        queue_put(write_queue, DONE)
+    except BaseException:
+        stop_event.set()
+        raise
+    finally:
+        for thread in threads:
+            thread.join()
+    if errors:
+        raise errors[0]
+    return [queue_metrics(read_queue), queue_metrics(write_queue)]
+
+# Function of the reader thread of the pipeline: plans the tasks and reads the bytes of each shard to analyze.
+# Compressed files are not prefetched; they are decompressed as a stream while they are analyzed.
+def prefetch_shards(tasks, read_queue):
+    for task in tasks:
+        data = None
+        read_start = time.perf_counter()
+        if not task['reused'] and not is_compressed(task['pgn_file_path']):
+            data = read_shard(task['pgn_file_path'], task['start'], task['end'])
+        if not queue_put(read_queue, (task, data, time.perf_counter() - read_start)):
+            return
+    queue_put(read_queue, DONE)
+
+# Function of the writer thread of the pipeline: merges the results in task order and writes the output files
+def write_results(state, write_queue):
+    while True:
+        item = queue_get(write_queue)
+        if item is DONE:
+            break
+        task, read_seconds, results = item
+        # results are the arguments of merge_results, the last of which tells whether the task is complete
+        if results[-1] and not task['reused']:
+            add_phase_time(state['file_records'][task['pgn_file_path']], 'read', read_seconds)
+        merge_results(state, task, *results)
+    if not write_queue['stop'].is_set():
+        finish_merge(state)
+
+# Function to write or close the output file of a PGN file once all its games are merged, to record the file in the
+# manifest and to write its profiling record. output_writer is the writer of the columnar or JSON Lines file, if any.
+def finish_output_file(task, games_count, aggregated_data, output_writer, output_json_dir, manifest,
+                       file_records=None, moves_writer=None):
+    if task is None:
+        return
+    record = file_records.get(task['pgn_file_path']) if file_records else None
+    if not task['reused']:
+        with phase(record, 'write'):
+            write_json(aggregated_data, task['pgn_file_path'], output_json_dir)
+            if output_writer:
+                output_writer.close()
+            if moves_writer:
+                moves_writer.close()
+        output_format = task['manifest_entry']['output_format']
+        add_counts(record, bytes_written=file_size(get_output_path(task['pgn_file_path'], output_json_dir,
+                                                                   output_format)) + file_size(task.get('moves_path')))
+    manifest["files"][task['manifest_key']] = dict(task['manifest_entry'], games=games_count)
+    save_manifest(output_json_dir, manifest)
+    if record is not None:
+        record['reused'] = task['reused']
+        write_record(task['profile'], record)
+
+# Function to get the path of the output file of a PGN file
+def get_output_path(pgn_file_path, output_json_dir, output_format="json"):
+    output_file_name = strip_compression_extension(os.path.basename(pgn_file_path)).replace(
+        '.pgn', OUTPUT_EXTENSIONS[output_format])
+    return os.path.join(output_json_dir, output_file_name)
+
+# Function to write the games of a PGN file to its JSON file
+def write_json(aggregated_data, pgn_file_path, output_json_dir):
+    if aggregated_data:
+        output_json_path = get_output_path(pgn_file_path, output_json_dir)
+        with open(output_json_path, 'w') as json_file:
+            json.dump(aggregated_data, json_file, indent=4)
+        #print(f"Aggregated data saved to {output_json_path}")
+
+# Function to append games to a JSON Lines file, one compact JSON object per line with the game key first, and to
+# flush them, so the games are on disk as soon as they are scored
+def write_jsonl_games(jsonl_file, first_key, games_data):
+    jsonl_file.writelines(json.dumps({'key': key, **game_data}, separators=(',', ':')) + '\n'
+                          for key, game_data in enumerate(games_data, first_key))
+    jsonl_file.flush()
+
 if __name__ == "__main__":
     start_time = time.time()
-    if len(sys.argv) < 3:
-        print("Usage: python pgn_engine_vs_engine_eval_analyzer.py <input_pgn_dir> <output_json_dir>")
-        sys.exit(1)
+    parser = argparse.ArgumentParser(usage="python pgn_engine_vs_engine_eval_analyzer.py <input_pgn_dir> <output_json_dir> [--validate] [--workers N] [--wdl-model MODEL] [--wdl-ply PLY] [--ccrl [--corrected-pgn-dir DIR]] [--output-format {json,jsonl,parquet,arrow}] [--moves-dir DIR [--moves-format {parquet,arrow}]] [--pipeline [--queue-depth N]] [--force] [--profile-report report.jsonl [--profiler {cprofile,pyinstrument}]]")
+    parser.add_argument("input_pgn_dir")
+    parser.add_argument("output_json_dir")
+    parser.add_argument("--validate", action="store_true",
+                        help="parse and replay every game with python-chess instead of only scanning the eval comments")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of worker processes; large files are split into game-aligned shards")
+    parser.add_argument("--shard-size-mb", type=int, default=64,
+                        help="approximate size of the shards of large PGN files when running with --workers or --pipeline")
+    parser.add_argument("--wdl-model", choices=WDL_MODELS, default=DEFAULT_WDL_MODEL,
+                        help="WDL model of python-chess used to convert evals to expected points")
+    parser.add_argument("--wdl-ply", type=int, default=DEFAULT_WDL_PLY,
+                        help="ply at which the Stockfish WDL models are evaluated")
+    parser.add_argument("--ccrl", action="store_true",
+                        help="read raw CCRL PGN files and correct their evals on the fly, as eval_corrector_ccrl.py does")
+    parser.add_argument("--corrected-pgn-dir",
+                        help="with --ccrl, also write the corrected PGN files to this directory")
+    parser.add_argument("--output-format", choices=OUTPUT_FORMATS, default="json",
+                        help="write typed columnar files (Parquet, or Arrow IPC that can be memory-mapped), or JSON Lines "
+                             "(one game per line, written as the games are scored), instead of JSON")
+    parser.add_argument("--moves-dir",
+                        help="also write the per-move terms of the stats (evals, CP loss, GPL, skipped losses) to a "
+                             "dataset in this directory, partitioned by source PGN file")
+    parser.add_argument("--moves-format", choices=MOVES_FORMATS, default="parquet",
+                        help="format of the per-move files")
+    parser.add_argument("--pipeline", action="store_true",
+                        help="overlap reading, analysis and writing: a reader thread prefetches the next shards and a "
+                             "writer thread serializes the finished files, connected by bounded queues")
+    parser.add_argument("--queue-depth", type=int, default=PIPELINE_QUEUE_DEPTH,
+                        help="with --pipeline, number of shards (or batches of games, for the writer without --workers) "
+                             "each queue holds before the stage feeding it blocks")
+    parser.add_argument("--force", action="store_true",
+                        help="analyze every PGN file, even the ones that did not change since the last run")
+    parser.add_argument("--profile-report",
+                        help="append the timings, rates, bytes and peak RSS of each file to this JSON Lines file")
+    parser.add_argument("--profiler", choices=PROFILERS,
+                        help="with --profile-report, also capture a profile of the analysis of each file")
+    args = parser.parse_args()
+    if args.corrected_pgn_dir and not args.ccrl:
+        parser.error("--corrected-pgn-dir requires --ccrl")
 
-    input_pgn_dir = sys.argv[1]
-    output_json_dir = sys.argv[2]
-    main(input_pgn_dir, output_json_dir)
+    main(args.input_pgn_dir, args.output_json_dir, validate=args.validate, workers=args.workers,
+         shard_size_mb=args.shard_size_mb, wdl_model=args.wdl_model, wdl_ply=args.wdl_ply, ccrl=args.ccrl,
+         corrected_pgn_dir=args.corrected_pgn_dir, output_format=args.output_format, force=args.force,
+         profile_report=args.profile_report, profiler=args.profiler, moves_dir=args.moves_dir,
+         moves_format=args.moves_format, pipeline=args.pipeline, queue_depth=args.queue_depth)
     end_time = time.time()
     print("Script finished in {:.2f} minutes".format((end_time - start_time) / 60.0))
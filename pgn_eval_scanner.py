@@ -0,0 +1,197 @@
+"""This script provides a lightweight PGN scanner that reads the headers and the [%eval ...] comments of each game
+without building a chess.pgn.Game tree or replaying the moves on a board. It follows the tokenization rules of
+chess.pgn.read_game, so the headers and evals it returns are the same as the ones the analyzer would get from
+python-chess for well-formed games (such as the PGN files written by eval_corrector_ccrl.py).
+"""
+
+import re
+import chess.pgn
+
+MATE_SCORE = 10000
+
+# Default values of the Seven Tag Roster, as set by chess.pgn.Headers
+DEFAULT_HEADERS = {
+    "Event": "?",
+    "Site": "?",
+    "Date": "????.??.??",
+    "Round": "?",
+    "White": "?",
+    "Black": "?",
+    "Result": "*",
+}
+
+# Tokens of the movetext that matter for the evals: SAN moves (same pattern as chess.pgn.MOVETEXT_REGEX), comments,
+# rest-of-line comments, variation brackets and results. Move numbers and NAGs never match a SAN move and are skipped.
+SAN_PATTERN = r"[NBKRQ]?[a-h]?[1-8]?[\-x]?[a-h][1-8](?:=?[nbrqkNBRQK])?|[PNBRQK]?@[a-h][1-8]|--|Z0|0000|@@@@|O-O(?:-O)?|0-0(?:-0)?"
+
+RESULT_PATTERN = r"\*|1-0|0-1|1/2-1/2"
+
+MOVETEXT_TOKEN_REGEX = re.compile(r"(" + SAN_PATTERN + r")|\{([^}]*)(\}?)|(\()|(\))|(;)|(" + RESULT_PATTERN + r")")
+
+# Same as above for lines without variations, where the mate or cp value of the first [%eval ...] annotation
+# (same pattern as chess.pgn.EVAL_REGEX) is captured together with its comment
+SIMPLE_MOVETEXT_REGEX = re.compile(r"(" + SAN_PATTERN + r")"
+                                   r"|\{[^}]*?(?:\[%eval\s(?:\#([+-]?\d+)|([+-]?(?:\d{0,10}\.\d{1,2}|\d{1,10}\.?)))"
+                                   r"(?:,\d+)?\][^}]*)?\}"
+                                   r"|(" + RESULT_PATTERN + r")")
+
+# Function to convert the first [%eval ...] annotation of a comment to pawns from White's perspective,
+# mirroring node.eval().pov(chess.WHITE).score(mate_score=10000) / 100.0
+def eval_from_comment(comment, white_to_move):
+    match = chess.pgn.EVAL_REGEX.search(comment)
+    if not match:
+        return None
+    return eval_from_groups(match.group("mate"), match.group("cp"), white_to_move)
+
+# Function to convert the mate or cp value of an [%eval ...] annotation to pawns from White's perspective
+def eval_from_groups(mate, cp, white_to_move):
+    if mate:
+        mate = int(mate)
+        if mate > 0:
+            return (MATE_SCORE - mate) / 100.0
+        elif mate < 0:
+            return (-MATE_SCORE - mate) / 100.0
+        # #0 means that the side to move has been mated
+        return -MATE_SCORE / 100.0 if white_to_move else MATE_SCORE / 100.0
+    return round(float(cp) * 100) / 100.0
+
+# Function to read the next game from a PGN text handle. Returns a (headers, evals) tuple, where evals holds the
+# eval of every mainline move that has one, or None at the end of the file. By default evals are read from
+# [%eval ...] annotations; parse_comment(comment, white_to_move) can be given to read them from the comments of each
+# move in another format instead, where comment is the comments of the move joined like in chess.pgn.
+def read_game_evals(handle, parse_comment=None):
+    # Ignore leading empty lines and comments
+    line = handle.readline().lstrip("\ufeff")
+    while line.isspace() or line.startswith("%") or line.startswith(";"):
+        line = handle.readline()
+    if not line:
+        return None
+
+    # Parse game headers
+    headers = dict(DEFAULT_HEADERS)
+    consecutive_empty_lines = 0
+    while line:
+        if line.startswith("%") or line.startswith(";"):
+            line = handle.readline()
+            continue
+        # Ignore up to one consecutive empty line between headers
+        if consecutive_empty_lines < 1 and line.isspace():
+            consecutive_empty_lines += 1
+            line = handle.readline()
+            continue
+        if not line.startswith("["):
+            break
+        consecutive_empty_lines = 0
+        tag_match = chess.pgn.TAG_REGEX.match(line)
+        if tag_match:
+            headers[tag_match.group(1)] = tag_match.group(2)
+        line = handle.readline()
+
+    # Side to move at the start of the game, from the FEN header if the game does not start from the initial position
+    fen = headers.get("FEN")
+    white_to_move = not (fen and len(fen.split()) > 1 and fen.split()[1] == "b")
+
+    # Parse movetext. Only comments that belong to mainline moves are kept, variations are skipped.
+    evals = []
+    move_eval = None
+    move_comments = []
+    variation_depth = 0
+    has_move = False
+    fresh_line = True
+    while line:
+        if fresh_line:
+            if line.startswith("%") or line.startswith(";"):
+                line = handle.readline()
+                continue
+            # An empty line means the end of a game
+            if line.isspace():
+                break
+        fresh_line = True
+
+        # Fast path for lines that only hold moves and complete comments, which is every line of a PGN file
+        # exported by python-chess without variations
+        if parse_comment is None and not variation_depth and "(" not in line and ")" not in line and ";" not in line \
+                and line.rfind("{") <= line.rfind("}"):
+            for move, mate, cp, result in SIMPLE_MOVETEXT_REGEX.findall(line):
+                if move:
+                    if move_eval is not None:
+                        evals.append(move_eval)
+                        move_eval = None
+                    has_move = True
+                    white_to_move = not white_to_move
+                elif result:
+                    if headers["Result"] == "*":
+                        headers["Result"] = result
+                elif (mate or cp) and has_move and move_eval is None:
+                    move_eval = eval_from_groups(mate, cp, white_to_move)
+            line = handle.readline()
+            continue
+
+        for match in MOVETEXT_TOKEN_REGEX.finditer(line):
+            kind = match.lastindex
+            if kind == 1:
+                # A mainline move: store the eval of the previous move and switch the side to move
+                if variation_depth:
+                    continue
+                if move_comments:
+                    move_eval = parse_comment("\n".join(move_comments).strip(), white_to_move)
+                    move_comments = []
+                if move_eval is not None:
+                    evals.append(move_eval)
+                    move_eval = None
+                has_move = True
+                white_to_move = not white_to_move
+            elif kind == 3:
+                comment = match.group(2)
+                if not match.group(3):
+                    # Consume until the end of a comment that spans several lines
+                    comment_lines = [comment]
+                    line = handle.readline()
+                    while line and "}" not in line:
+                        comment_lines.append(line)
+                        line = handle.readline()
+                    if line:
+                        close_index = line.find("}")
+                        comment_lines.append(line[:close_index])
+                        line = line[close_index + 1:]
+                    comment = "".join(comment_lines)
+                    # Continue with the rest of the line after the comment
+                    fresh_line = False
+                if not variation_depth and has_move:
+                    if parse_comment is not None:
+                        move_comments.append(comment)
+                    elif move_eval is None:
+                        move_eval = eval_from_comment(comment, white_to_move)
+                if not fresh_line:
+                    break
+            elif kind == 4:
+                if variation_depth or has_move:
+                    variation_depth += 1
+            elif kind == 5:
+                if variation_depth:
+                    variation_depth -= 1
+            elif variation_depth:
+                continue
+            elif kind == 6:
+                # The rest of the line is a comment
+                break
+            elif headers["Result"] == "*":
+                # The result in the movetext is only used when the Result header is missing or unknown
+                headers["Result"] = match.group(7)
+
+        if fresh_line:
+            line = handle.readline()
+
+    if move_comments:
+        move_eval = parse_comment("\n".join(move_comments).strip(), white_to_move)
+    if move_eval is not None:
+        evals.append(move_eval)
+    return headers, evals
+
+# Generator over all games of a PGN text handle
+def scan_games(handle, parse_comment=None):
+    while True:
+        game = read_game_evals(handle, parse_comment)
+        if game is None:
+            break
+        yield game
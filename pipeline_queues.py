@@ -0,0 +1,89 @@
+"""This script holds the bounded queues that connect the threads of the pipelined analyzer
+(pgn_engine_vs_engine_eval_analyzer.py --pipeline): a reader thread that prefetches the next shards, the compute stage
+and a writer thread that serializes the finished files. Because the queues are bounded, a stage that runs ahead blocks
+until the next stage catches up (backpressure), which also bounds the memory taken by the prefetched shards.
+Each queue has a single producer and a single consumer and records how long the producer was blocked because the
+queue was full, how long the consumer waited for an item and the depth of the queue after each put. A stage that
+fails sets the stop event of the pipeline, which unblocks the other stages.
+"""
+
+import queue
+import threading
+import time
+
+# Item put in a queue after the last one
+DONE = "__done__"
+
+# Seconds between two checks of the stop event while blocked on a queue
+POLL_SECONDS = 0.1
+
+# Function to create a bounded queue of a pipeline, with its metrics
+def new_queue(name, maxsize, stop_event):
+    return {"name": name, "queue": queue.Queue(maxsize), "maxsize": maxsize, "stop": stop_event, "items": 0,
+            "blocked_puts": 0, "put_wait_seconds": 0.0, "get_wait_seconds": 0.0, "depth_sum": 0, "max_depth": 0}
+
+# Function to put an item in a queue, blocking while the queue is full. Returns False if the pipeline was stopped.
+def queue_put(pipeline_queue, item):
+    start = time.perf_counter()
+    blocked = False
+    while True:
+        if pipeline_queue["stop"].is_set():
+            return False
+        try:
+            pipeline_queue["queue"].put(item, timeout=POLL_SECONDS if blocked else 0)
+            break
+        except queue.Full:
+            blocked = True
+    if blocked:
+        pipeline_queue["blocked_puts"] += 1
+        pipeline_queue["put_wait_seconds"] += time.perf_counter() - start
+    if item is not DONE:
+        depth = pipeline_queue["queue"].qsize()
+        pipeline_queue["items"] += 1
+        pipeline_queue["depth_sum"] += depth
+        pipeline_queue["max_depth"] = max(pipeline_queue["max_depth"], depth)
+    return True
+
+# Function to get the next item of a queue, blocking while the queue is empty. Returns DONE after the last item or if
+# the pipeline was stopped.
+def queue_get(pipeline_queue):
+    start = time.perf_counter()
+    while True:
+        if pipeline_queue["stop"].is_set():
+            return DONE
+        try:
+            item = pipeline_queue["queue"].get(timeout=POLL_SECONDS)
+            break
+        except queue.Empty:
+            continue
+    pipeline_queue["get_wait_seconds"] += time.perf_counter() - start
+    return item
+
+# Function to run a stage of a pipeline in a thread. If the stage fails, its exception is added to errors and the
+# pipeline is stopped.
+def start_stage_thread(name, function, args, stop_event, errors):
+    def run_stage():
+        try:
+            function(*args)
+        except BaseException as error:
+            errors.append(error)
+            stop_event.set()
+    thread = threading.Thread(target=run_stage, name=name, daemon=True)
+    thread.start()
+    return thread
+
+# Function to get the metrics of a queue: the number of items, the mean and maximum depth, the number of puts that
+# blocked on a full queue and the seconds the producer was blocked (backpressure) and the consumer waited
+def queue_metrics(pipeline_queue):
+    items = pipeline_queue["items"]
+    return {"queue": pipeline_queue["name"], "maxsize": pipeline_queue["maxsize"], "items": items,
+            "mean_depth": pipeline_queue["depth_sum"] / items if items else 0.0,
+            "max_depth": pipeline_queue["max_depth"], "blocked_puts": pipeline_queue["blocked_puts"],
+            "producer_blocked_seconds": pipeline_queue["put_wait_seconds"],
+            "consumer_wait_seconds": pipeline_queue["get_wait_seconds"]}
+
+# Function to describe the metrics of a queue in one line
+def format_queue_metrics(metrics):
+    return (f"queue {metrics['queue']}: {metrics['items']} items, depth mean {metrics['mean_depth']:.1f} "
+            f"max {metrics['max_depth']}/{metrics['maxsize']}, producer blocked {metrics['blocked_puts']} times "
+            f"for {metrics['producer_blocked_seconds']:.2f} s, consumer waited {metrics['consumer_wait_seconds']:.2f} s")
@@ -0,0 +1,302 @@
+"""This script computes mergeable partial aggregates ("sketches") of the per-game stats, so that the player stats of
+csv_to_player_stats.py and the summary of chess_stats_summarizer.py can be built from shards of the games that are
+processed separately, in parallel or on different machines, without loading all the games in memory.
+For each player and color a sketch holds the number of games and, for each stat, the count, sum, mean and Welford M2
+of its values and a t-digest of them for the medians. Sketches are dicts of NumPy arrays saved as .npz files and
+merging them is associative, so shards can be merged in any grouping.
+Sums, averages, variances and standard deviations are the same as the ones of the full table up to floating point
+rounding. Medians are exact for players with at most TDIGEST_COMPRESSION games per color and approximate otherwise.
+"""
+
+import argparse
+import functools
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+from csv_to_player_stats import STATS, PLAYER_STATS_COLUMNS, games_by_player, save_player_stats
+from chess_stats_summarizer import save_summary
+from json_to_csv_converter import iter_game_chunks, CHUNK_ROWS
+from engine_aliases import load_engine_aliases, compile_engine_aliases, engine_ids
+from columnar_output import pq
+
+SKETCH_STATS = STATS + ['move_number']
+
+COLORS = ['white', 'black']
+
+# Maximum number of centroids of the t-digest of a player and color. Up to this number of values, the values
+# themselves are kept.
+TDIGEST_COMPRESSION = 500
+
+# Function to compress weighted points (centroids) into a t-digest for each group, using the k1 scale function of
+# the merging t-digest. Groups with at most `compression` centroids are kept as they are.
+def compress_centroids(groups, means, weights, compression=TDIGEST_COMPRESSION):
+    order = np.lexsort((means, groups))
+    groups, means, weights = groups[order], means[order], weights[order]
+    if len(groups) == 0:
+        return groups, means, weights
+    n_groups = groups[-1] + 1
+    sizes = np.bincount(groups, minlength=n_groups)
+    totals = np.bincount(groups, weights=weights, minlength=n_groups)
+    first = np.cumsum(sizes) - sizes
+    group_start = np.cumsum(totals) - totals
+    # Quantile of the middle of each centroid within its group, and its cluster in k1 = compression/(2*pi)*asin(2q-1)
+    q = np.clip((np.cumsum(weights) - weights / 2 - group_start[groups]) / totals[groups], 0, 1)
+    cluster = np.floor(compression / (2 * np.pi) * np.arcsin(2 * q - 1)).astype(np.int64)
+    rank = np.arange(len(groups)) - first[groups]
+    cluster = np.where(sizes[groups] <= compression, rank, cluster)
+    boundary = np.ones(len(groups), dtype=bool)
+    boundary[1:] = (groups[1:] != groups[:-1]) | (cluster[1:] != cluster[:-1])
+    cluster_index = np.cumsum(boundary) - 1
+    cluster_weights = np.bincount(cluster_index, weights=weights)
+    cluster_sizes = np.bincount(cluster_index)
+    cluster_means = np.bincount(cluster_index, weights=weights * means) / cluster_weights
+    # Centroids that are not merged keep their exact value
+    cluster_means = np.where(cluster_sizes == 1, means[boundary], cluster_means)
+    return groups[boundary], cluster_means, cluster_weights
+
+# Function to calculate the q-quantile of each group from its centroids, interpolating between the centroids
+# as pandas interpolates between values (so medians of groups whose values are all kept are exact). Groups without
+# values get NaN.
+def centroid_quantiles(groups, means, weights, n_groups, q=0.5):
+    quantiles = np.full(n_groups, np.nan)
+    if len(groups) == 0:
+        return quantiles
+    order = np.lexsort((means, groups))
+    groups, means, weights = groups[order], means[order], weights[order]
+    sizes = np.bincount(groups, minlength=n_groups)
+    totals = np.bincount(groups, weights=weights, minlength=n_groups)
+    first = np.cumsum(sizes) - sizes
+    last = first + sizes - 1
+    # Cumulative weight at the middle of each centroid within its group
+    centers = np.cumsum(weights) - weights / 2 - (np.cumsum(totals) - totals)[groups]
+    keys = groups + centers / totals[groups]
+    present = sizes > 0
+    hi = np.searchsorted(keys, np.arange(n_groups) + q)
+    hi = np.clip(hi, first, np.maximum(last, first))[present]
+    lo = np.maximum(hi - 1, first[present])
+    target = q * totals[present]
+    span = centers[hi] - centers[lo]
+    frac = np.clip(np.divide(target - centers[lo], span, out=np.ones(len(hi)), where=span > 0), 0, 1)
+    quantiles[present] = means[lo] * (1 - frac) + means[hi] * frac
+    return quantiles
+
+# Function to combine the count, mean and M2 of two sets of values (Chan et al.)
+def combine_moments(count_a, mean_a, m2_a, count_b, mean_b, m2_b):
+    count = count_a + count_b
+    delta = mean_b - mean_a
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.where(count > 0, mean_a + delta * count_b / count, 0.0)
+        m2 = np.where(count > 0, m2_a + m2_b + delta ** 2 * count_a * count_b / count, 0.0)
+    return count, mean, m2
+
+# Function to calculate the sketch of a DataFrame of games with the columns of the all-games CSV
+def sketch_games(df, compression=TDIGEST_COMPRESSION):
+    games, players = games_by_player(df)
+    groups = (games['Player'] * 2 + games['color']).to_numpy()
+    n_groups = 2 * len(players)
+    sketch = {'players': np.asarray(players, dtype=str), 'games': np.bincount(groups, minlength=n_groups),
+              'compression': np.array(compression)}
+    for stat in SKETCH_STATS:
+        values = games[stat].to_numpy(dtype=np.float64)
+        valid = ~np.isnan(values)
+        stat_groups, values = groups[valid], values[valid]
+        count = np.bincount(stat_groups, minlength=n_groups)
+        total = np.bincount(stat_groups, weights=values, minlength=n_groups)
+        mean = np.divide(total, count, out=np.zeros(n_groups), where=count > 0)
+        sketch[f'{stat}_count'] = count
+        sketch[f'{stat}_sum'] = total
+        sketch[f'{stat}_mean'] = mean
+        sketch[f'{stat}_m2'] = np.bincount(stat_groups, weights=(values - mean[stat_groups]) ** 2, minlength=n_groups)
+        (sketch[f'{stat}_centroid_group'], sketch[f'{stat}_centroid_mean'],
+         sketch[f'{stat}_centroid_weight']) = compress_centroids(stat_groups, values, np.ones(len(values)), compression)
+    return sketch
+
+# Function to place the per-group values of a sketch at their groups in a merged sketch
+def align_to_groups(values, groups, n_groups):
+    aligned = np.zeros(n_groups, dtype=values.dtype)
+    aligned[groups] = values
+    return aligned
+
+# Function to merge two sketches. Both must have been built with the same compression, otherwise their medians would
+# not have the accuracy of either.
+def merge_sketches(sketch_a, sketch_b):
+    compression = int(sketch_a['compression'])
+    if int(sketch_b['compression']) != compression:
+        raise ValueError(f"Cannot merge sketches built with compressions {compression} and {int(sketch_b['compression'])}")
+    players = np.union1d(sketch_a['players'], sketch_b['players'])
+    n_groups = 2 * len(players)
+    # Groups of each sketch in the merged sketch
+    new_groups = []
+    for sketch in [sketch_a, sketch_b]:
+        player_index = np.searchsorted(players, sketch['players'])
+        new_groups.append((player_index[:, None] * 2 + np.arange(2)).ravel())
+
+    aligned_a = {name: align_to_groups(sketch_a[name], new_groups[0], n_groups) for name in sketch_a
+                 if name not in ('players', 'compression') and '_centroid_' not in name}
+    aligned_b = {name: align_to_groups(sketch_b[name], new_groups[1], n_groups) for name in sketch_b
+                 if name not in ('players', 'compression') and '_centroid_' not in name}
+
+    merged = {'players': players, 'games': aligned_a['games'] + aligned_b['games'],
+              'compression': np.array(compression)}
+    for stat in SKETCH_STATS:
+        (merged[f'{stat}_count'], merged[f'{stat}_mean'], merged[f'{stat}_m2']) = combine_moments(
+            aligned_a[f'{stat}_count'], aligned_a[f'{stat}_mean'], aligned_a[f'{stat}_m2'],
+            aligned_b[f'{stat}_count'], aligned_b[f'{stat}_mean'], aligned_b[f'{stat}_m2'])
+        merged[f'{stat}_sum'] = aligned_a[f'{stat}_sum'] + aligned_b[f'{stat}_sum']
+        groups = np.concatenate([new_groups[0][sketch_a[f'{stat}_centroid_group']],
+                                 new_groups[1][sketch_b[f'{stat}_centroid_group']]])
+        means = np.concatenate([sketch_a[f'{stat}_centroid_mean'], sketch_b[f'{stat}_centroid_mean']])
+        weights = np.concatenate([sketch_a[f'{stat}_centroid_weight'], sketch_b[f'{stat}_centroid_weight']])
+        (merged[f'{stat}_centroid_group'], merged[f'{stat}_centroid_mean'],
+         merged[f'{stat}_centroid_weight']) = compress_centroids(groups, means, weights, compression)
+    return merged
+
+def save_sketch(sketch, sketch_path):
+    np.savez_compressed(sketch_path, **sketch)
+
+def load_sketch(sketch_path):
+    with np.load(sketch_path) as data:
+        return {name: data[name] for name in data.files}
+
+# Function to iterate over the games of a CSV or Parquet game table, or of an output file of the analyzer
+# (JSON, Parquet or Arrow IPC), as DataFrames of at most chunk_rows games
+def iter_game_frames(file_path, chunk_rows=CHUNK_ROWS):
+    if file_path.endswith('.csv'):
+        yield from pd.read_csv(file_path, usecols=PLAYER_STATS_COLUMNS, chunksize=chunk_rows)
+    elif file_path.endswith('.parquet'):
+        for batch in pq.ParquetFile(file_path, memory_map=True).iter_batches(batch_size=chunk_rows,
+                                                                            columns=PLAYER_STATS_COLUMNS):
+            df = batch.to_pandas()
+            # Dictionary-encoded names are read as categoricals
+            df['White'] = df['White'].astype(object)
+            df['Black'] = df['Black'].astype(object)
+            yield df
+    else:
+        for games in iter_game_chunks(file_path, chunk_rows):
+            yield pd.DataFrame(games, columns=PLAYER_STATS_COLUMNS)
+
+# Function to calculate the sketch of a file chunk by chunk. Runs in worker processes.
+def sketch_file(task):
+    file_path, chunk_rows, alias_index, compression = task
+    if file_path.endswith('.npz'):
+        return load_sketch(file_path)
+    sketch = None
+    for df in iter_game_frames(file_path, chunk_rows):
+        if alias_index is not None:
+            # Merge all versions of the same engine, as json_to_csv_merge_versions.py does
+            for col in ['White', 'Black']:
+                df[col] = engine_ids(alias_index, df[col]).astype(object)
+        chunk_sketch = sketch_games(df, compression)
+        sketch = chunk_sketch if sketch is None else merge_sketches(sketch, chunk_sketch)
+    if sketch is None:
+        sketch = sketch_games(pd.DataFrame(columns=PLAYER_STATS_COLUMNS), compression)
+    print(f"Sketched {file_path}: {int(sketch['games'].sum() / 2)} games")
+    return sketch
+
+# Function to calculate the merged sketch of several files (game tables, analyzer outputs or sketches). With an alias
+# index of engine_aliases.py, all versions of the same engine are merged.
+def build_sketch(file_paths, workers=1, chunk_rows=CHUNK_ROWS, alias_index=None, compression=TDIGEST_COMPRESSION):
+    tasks = [(file_path, chunk_rows, alias_index, compression) for file_path in file_paths]
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            return functools.reduce(merge_sketches, executor.map(sketch_file, tasks))
+    return functools.reduce(merge_sketches, map(sketch_file, tasks))
+
+# Function to build the table of csv_to_player_stats.aggregate_player_stats from a sketch
+def player_stats_from_sketch(sketch):
+    players = sketch['players']
+    player_stats = pd.DataFrame(index=range(len(players)))
+    by_color = {name: sketch[name].reshape(len(players), 2) for name in sketch
+                if name not in ('players', 'compression') and '_centroid_' not in name}
+    for color_index, color in enumerate(COLORS):
+        for stat in STATS:
+            player_stats[f'{color}_{stat}_sum'] = by_color[f'{stat}_sum'][:, color_index]
+    player_stats['White_games'] = by_color['games'][:, 0]
+    player_stats['Black_games'] = by_color['games'][:, 1]
+    player_stats['white_move_sum'] = by_color['move_number_sum'][:, 0].astype(np.int64)
+    player_stats['black_move_sum'] = by_color['move_number_sum'][:, 1].astype(np.int64)
+    player_stats['total_game_count'] = player_stats['White_games'] + player_stats['Black_games']
+    player_stats['total_moves'] = player_stats['white_move_sum'] + player_stats['black_move_sum']
+    for stat in STATS:
+        player_stats[f'total_{stat}_sum'] = player_stats[f'white_{stat}_sum'] + player_stats[f'black_{stat}_sum']
+    for stat in STATS:
+        count, mean, m2 = combine_moments(*(by_color[f'{stat}_{moment}'][:, 0] for moment in ['count', 'mean', 'm2']),
+                                          *(by_color[f'{stat}_{moment}'][:, 1] for moment in ['count', 'mean', 'm2']))
+        # The variance of a single game is 0, as in aggregate_player_stats
+        var = np.divide(m2, count - 1, out=np.zeros(len(players)), where=count > 1)
+        median = centroid_quantiles(sketch[f'{stat}_centroid_group'] // 2, sketch[f'{stat}_centroid_mean'],
+                                    sketch[f'{stat}_centroid_weight'], len(players))
+        player_stats[f'{stat}_median'] = np.nan_to_num(median)
+        player_stats[f'{stat}_var'] = var
+        player_stats[f'{stat}_std'] = np.sqrt(var)
+    player_stats.insert(0, 'Player', players)
+    return player_stats
+
+# Function to save the summary of chess_stats_summarizer.py from a sketch. Only the columns of the game stats are
+# summarized, and games without a player name are not counted.
+def save_summary_from_sketch(sketch, output_directory):
+    cols_to_analyze, averages, medians = [], [], []
+    for stat in SKETCH_STATS:
+        for color_index, color in enumerate(COLORS):
+            in_color = sketch[f'{stat}_centroid_group'] % 2 == color_index
+            count = sketch[f'{stat}_count'][color_index::2].sum()
+            cols_to_analyze.append(f'{color}_{stat}')
+            averages.append(sketch[f'{stat}_sum'][color_index::2].sum() / count if count else np.nan)
+            medians.append(centroid_quantiles(np.zeros(in_color.sum(), dtype=np.int64),
+                                              sketch[f'{stat}_centroid_mean'][in_color],
+                                              sketch[f'{stat}_centroid_weight'][in_color], 1)[0])
+    merge_cols = ['sgi', 'sgpl', 'stcpl', 'gi', 'gpl']
+    overall_averages, overall_medians = {}, {}
+    for col in merge_cols:
+        count = sketch[f'{col}_count'].sum()
+        overall_averages[col] = sketch[f'{col}_sum'].sum() / count if count else np.nan
+        centroid_means = sketch[f'{col}_centroid_mean']
+        overall_medians[col] = centroid_quantiles(np.zeros(len(centroid_means), dtype=np.int64), centroid_means,
+                                                  sketch[f'{col}_centroid_weight'], 1)[0]
+    total_moves = int(sketch['move_number_sum'].sum())
+    total_games = int(sketch['games'][0::2].sum())
+    save_summary(output_directory, cols_to_analyze, averages, medians, merge_cols, overall_averages, overall_medians,
+                 total_moves, total_games)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(usage="python player_stats_sketch.py build <sketch.npz> <input files...> [--workers N] [--merge-engine-versions [--alias-table aliases.json]]\n"
+                                           "       python player_stats_sketch.py player-stats <output_dir> <sketch.npz...>\n"
+                                           "       python player_stats_sketch.py summary <output_dir> <sketch.npz...>")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    build_parser = subparsers.add_parser("build", help="sketch game tables (CSV/Parquet), analyzer outputs or sketches into one sketch")
+    build_parser.add_argument("sketch_path")
+    build_parser.add_argument("input_files", nargs="+")
+    build_parser.add_argument("--workers", type=int, default=1, help="number of files sketched in parallel")
+    build_parser.add_argument("--chunk-rows", type=int, default=CHUNK_ROWS, help="number of games sketched at a time")
+    build_parser.add_argument("--merge-engine-versions", action="store_true",
+                              help="merge all versions of the same engine, as json_to_csv_merge_versions.py does")
+    build_parser.add_argument("--alias-table",
+                              help="JSON file mapping each engine to its aliases (default: the table of engine_aliases.py)")
+    build_parser.add_argument("--compression", type=int, default=TDIGEST_COMPRESSION,
+                              help="maximum number of t-digest centroids per player and color")
+    for command, help_text in [("player-stats", "write player_stats_merged_engines.csv from sketches"),
+                               ("summary", "write summarized_game_data.csv from sketches")]:
+        output_parser = subparsers.add_parser(command, help=help_text)
+        output_parser.add_argument("output_dir")
+        output_parser.add_argument("sketch_paths", nargs="+")
+    args = parser.parse_args()
+
+    if args.command == "build":
+        alias_index = None
+        if args.merge_engine_versions:
+            alias_index = compile_engine_aliases(load_engine_aliases(args.alias_table))
+        sketch = build_sketch(args.input_files, args.workers, args.chunk_rows, alias_index, args.compression)
+        save_sketch(sketch, args.sketch_path)
+        print(f"Sketch saved to {args.sketch_path}")
+    else:
+        try:
+            sketch = functools.reduce(merge_sketches, map(load_sketch, args.sketch_paths))
+        except ValueError as e:
+            parser.error(str(e))
+        if args.command == "player-stats":
+            save_player_stats(player_stats_from_sketch(sketch), args.output_dir)
+        else:
+            if not os.path.exists(args.output_dir):
+                os.makedirs(args.output_dir)
+            save_summary_from_sketch(sketch, args.output_dir)
@@ -0,0 +1,170 @@
+"""This script keeps a persistent state of the player stats, so that new games can be added without reading all the
+games again. The state is a directory with the sketch of player_stats_sketch.py of each source file (analyzer outputs
+or game tables), their merged sketch and state.json, which records the content hash, size and modification time of
+each source file and the settings of the sketches.
+`update` sketches only the source files that are new or changed since the last update and merges them into the state,
+so an update costs about the size of the new games. The games of a source file that changed or no longer exists are
+retracted: its previous sketch is dropped and the merged sketch is rebuilt from the sketches of the other files
+(t-digests cannot be subtracted), which costs about the number of players times the number of files.
+`emit` writes player_stats_merged_engines.csv from the merged sketch, as csv_to_player_stats.py does.
+"""
+
+import argparse
+import functools
+import hashlib
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+import pandas as pd
+from player_stats_sketch import (TDIGEST_COMPRESSION, sketch_file, sketch_games, merge_sketches, save_sketch,
+                                 load_sketch, player_stats_from_sketch, PLAYER_STATS_COLUMNS)
+from csv_to_player_stats import save_player_stats
+from json_to_csv_converter import find_game_files, CHUNK_ROWS
+from analysis_manifest import describe_input_file
+from engine_aliases import load_engine_aliases, compile_engine_aliases
+
+STATE_VERSION = 1
+
+STATE_FILE_NAME = "state.json"
+
+TOTAL_SKETCH_NAME = "total.npz"
+
+# Function to load the state of a directory, or an empty one if there is none
+def load_state(state_dir):
+    state_path = os.path.join(state_dir, STATE_FILE_NAME)
+    if not os.path.exists(state_path):
+        return {"version": STATE_VERSION, "settings": None, "files": {}}
+    with open(state_path, 'r') as state_file:
+        state = json.load(state_file)
+    if state.get("version") != STATE_VERSION:
+        raise ValueError(f"{state_path} has version {state.get('version')}, expected {STATE_VERSION}")
+    return state
+
+# Function to save the state. It is written to a temporary file first, so an interrupted update never leaves a
+# truncated state behind.
+def save_state(state_dir, state):
+    state_path = os.path.join(state_dir, STATE_FILE_NAME)
+    with open(state_path + ".tmp", 'w') as state_file:
+        json.dump(state, state_file, indent=4)
+    os.replace(state_path + ".tmp", state_path)
+
+# Function to get the name of the sketch of a source file in the state directory
+def get_sketch_name(file_path):
+    return "sketch_" + hashlib.sha256(file_path.encode('utf-8')).hexdigest()[:16] + ".npz"
+
+# Function to list the source files of the inputs, which can be files or directories of analyzer outputs
+def find_source_files(input_paths):
+    source_files = []
+    for input_path in input_paths:
+        if os.path.isdir(input_path):
+            source_files.extend(sorted(find_game_files(input_path)))
+        else:
+            source_files.append(input_path)
+    return [os.path.abspath(file_path) for file_path in source_files]
+
+# Function to get the empty sketch, the merged sketch of a state without files
+def empty_sketch(compression):
+    return sketch_games(pd.DataFrame(columns=PLAYER_STATS_COLUMNS), compression)
+
+# Function to fold the new and changed source files into the state of a directory and to retract the games of the
+# changed and deleted ones. Returns the state.
+def update_state(state_dir, input_paths, workers=1, chunk_rows=CHUNK_ROWS, merge_engine_versions=False,
+                 alias_table_path=None, compression=TDIGEST_COMPRESSION):
+    if not os.path.exists(state_dir):
+        os.makedirs(state_dir)
+    state = load_state(state_dir)
+    settings = {"merge_engine_versions": merge_engine_versions, "alias_table": alias_table_path,
+                "compression": compression}
+    if state["settings"] is not None and state["settings"] != settings:
+        print(f"The settings changed from {state['settings']}, sketching every file again")
+        for entry in state["files"].values():
+            sketch_path = os.path.join(state_dir, entry["sketch"])
+            if os.path.exists(sketch_path):
+                os.remove(sketch_path)
+        state["files"] = {}
+    alias_index = compile_engine_aliases(load_engine_aliases(alias_table_path)) if merge_engine_versions else None
+
+    # Files that no longer exist are retracted, files that changed are retracted and sketched again
+    retracted = [file_path for file_path in state["files"] if not os.path.exists(file_path)]
+    changed = []
+    for file_path in find_source_files(input_paths):
+        previous_entry = state["files"].get(file_path)
+        entry = describe_input_file(file_path, previous_entry)
+        if previous_entry and previous_entry["sha256"] == entry["sha256"]:
+            previous_entry.update(entry)
+            continue
+        if previous_entry:
+            retracted.append(file_path)
+        changed.append((file_path, entry))
+
+    tasks = [(file_path, chunk_rows, alias_index, compression) for file_path, entry in changed]
+    if workers > 1 and len(tasks) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            new_sketches = list(executor.map(sketch_file, tasks))
+    else:
+        new_sketches = list(map(sketch_file, tasks))
+
+    total_path = os.path.join(state_dir, TOTAL_SKETCH_NAME)
+    for file_path in retracted:
+        print(f"Retracting the games of {file_path}")
+        entry = state["files"].pop(file_path)
+        sketch_path = os.path.join(state_dir, entry["sketch"])
+        if os.path.exists(sketch_path) and file_path not in dict(changed):
+            os.remove(sketch_path)
+    for (file_path, entry), sketch in zip(changed, new_sketches):
+        entry["sketch"] = get_sketch_name(file_path)
+        entry["games"] = int(sketch['games'][0::2].sum())
+        save_sketch(sketch, os.path.join(state_dir, entry["sketch"]))
+        state["files"][file_path] = entry
+
+    if retracted or state["settings"] != settings or not os.path.exists(total_path):
+        # Rebuild the merged sketch from the sketches of the remaining files, in the order of their paths
+        sketches = [load_sketch(os.path.join(state_dir, state["files"][file_path]["sketch"]))
+                    for file_path in sorted(state["files"])]
+        total = functools.reduce(merge_sketches, sketches, empty_sketch(compression))
+    else:
+        total = functools.reduce(merge_sketches, new_sketches, load_sketch(total_path))
+    state["settings"] = settings
+    save_sketch(total, total_path)
+    save_state(state_dir, state)
+    print(f"{len(changed)} files sketched, {len(retracted)} retracted, "
+          f"{sum(entry['games'] for entry in state['files'].values())} games in {len(state['files'])} files")
+    return state
+
+# Function to write the player stats of the state of a directory
+def emit_player_stats(state_dir, player_stats_output_dir):
+    total_path = os.path.join(state_dir, TOTAL_SKETCH_NAME)
+    if not os.path.exists(total_path):
+        print(f"No player stats state in {state_dir}, run update first")
+        return
+    save_player_stats(player_stats_from_sketch(load_sketch(total_path)), player_stats_output_dir)
+
+if __name__ == "__main__":
+    start_time = time.time()
+    parser = argparse.ArgumentParser(usage="python player_stats_state.py update <state_dir> <input files or dirs...> [--workers N] [--merge-engine-versions [--alias-table aliases.json]]\n"
+                                           "       python player_stats_state.py emit <state_dir> <player_stats_output_dir>")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    update_parser = subparsers.add_parser("update", help="fold new and changed game files into the state")
+    update_parser.add_argument("state_dir")
+    update_parser.add_argument("input_paths", nargs="+",
+                               help="analyzer outputs (JSON, Parquet or Arrow IPC), game tables or directories of them")
+    update_parser.add_argument("--workers", type=int, default=1, help="number of files sketched in parallel")
+    update_parser.add_argument("--chunk-rows", type=int, default=CHUNK_ROWS, help="number of games sketched at a time")
+    update_parser.add_argument("--merge-engine-versions", action="store_true",
+                               help="merge all versions of the same engine, as json_to_csv_merge_versions.py does")
+    update_parser.add_argument("--alias-table",
+                               help="JSON file mapping each engine to its aliases (default: the table of engine_aliases.py)")
+    update_parser.add_argument("--compression", type=int, default=TDIGEST_COMPRESSION,
+                               help="maximum number of t-digest centroids per player and color")
+    emit_parser = subparsers.add_parser("emit", help="write player_stats_merged_engines.csv from the state")
+    emit_parser.add_argument("state_dir")
+    emit_parser.add_argument("player_stats_output_dir")
+    args = parser.parse_args()
+
+    if args.command == "update":
+        update_state(args.state_dir, args.input_paths, args.workers, args.chunk_rows, args.merge_engine_versions,
+                     args.alias_table, args.compression)
+    else:
+        emit_player_stats(args.state_dir, args.player_stats_output_dir)
+    print("Script finished in {:.2f} minutes".format((time.time() - start_time) / 60.0))
@@ -0,0 +1,198 @@
+"""This script benchmarks the pipeline offline on synthetic CCRL PGN files from generate_ccrl_pgn.py. It times each
+stage end to end (eval correction, splitting, analysis, conversion, summary and player stats) and the hot functions
+(gi_and_gpl, calculate_engine_vs_engine_GI, the batch metrics, the eval scanner, the text-level corrector and the game
+index), and hashes the output files of every stage.
+With --save-baseline the results are stored as a baseline; otherwise they are compared against the stored baseline,
+reporting the timings that are slower than the tolerance allows and the outputs that are not identical. The exit
+code is 1 if any output differs or any timing regressed.
+"""
+
+import argparse
+import contextlib
+import hashlib
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import chess_stats_summarizer
+import csv_to_player_stats
+import eval_corrector_ccrl
+import json_to_csv_converter
+import pgn_engine_vs_engine_eval_analyzer as analyzer
+import split_large_pgn
+from batch_metrics import calculate_batch_stats, flatten_pawns_lists
+from generate_ccrl_pgn import generate_ccrl_pgn
+from pgn_eval_scanner import scan_games
+
+# Output files that change between identical runs (modification times, rendering metadata)
+UNSTABLE_OUTPUTS = ('.png', 'analyzer_manifest.json', 'pipeline_cache.json')
+
+# Function to calculate the SHA-256 hashes of the output files of a stage
+def hash_outputs(output_dir):
+    hashes = {}
+    for dirpath, dirnames, filenames in os.walk(output_dir):
+        for filename in filenames:
+            if filename.endswith(UNSTABLE_OUTPUTS):
+                continue
+            file_path = os.path.join(dirpath, filename)
+            with open(file_path, 'rb') as f:
+                hashes[os.path.relpath(file_path, output_dir).replace(os.sep, '/')] = hashlib.sha256(f.read()).hexdigest()
+    return dict(sorted(hashes.items()))
+
+# Function to run a function repeat times and return the fastest time and its result. The output of the stages is
+# hidden unless verbose.
+def time_call(function, repeat=1, verbose=False):
+    best = None
+    result = None
+    for _ in range(repeat):
+        output = contextlib.nullcontext() if verbose else contextlib.redirect_stdout(io.StringIO())
+        with output:
+            start = time.perf_counter()
+            result = function()
+            elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+# Function to define the stages of the benchmark as (name, function, output directory) tuples, in the order they run
+def get_benchmark_stages(work_dir):
+    pgn_dir = os.path.join(work_dir, 'pgn')
+    corrected_dir = os.path.join(work_dir, 'corrected')
+    split_dir = os.path.join(work_dir, 'split')
+    json_dir = os.path.join(work_dir, 'json')
+    json_ccrl_dir = os.path.join(work_dir, 'json_ccrl')
+    csv_dir = os.path.join(work_dir, 'csv')
+    stats_dir = os.path.join(work_dir, 'stats')
+    player_stats_dir = os.path.join(work_dir, 'player_stats')
+    corrected_pgn = os.path.join(corrected_dir, 'games_corrected.pgn')
+    return [
+        ('correct', lambda: eval_corrector_ccrl.main(pgn_dir, corrected_dir), corrected_dir),
+        ('split', lambda: split_large_pgn.split_pgn_file(corrected_pgn, split_dir, max_file_size_mb=1), split_dir),
+        ('analyze', lambda: analyzer.main(corrected_dir, json_dir, force=True), json_dir),
+        ('analyze_ccrl', lambda: analyzer.main(pgn_dir, json_ccrl_dir, ccrl=True, force=True), json_ccrl_dir),
+        ('convert', lambda: json_to_csv_converter.main(json_dir, csv_dir, merge_engines=True), csv_dir),
+        ('summary', lambda: chess_stats_summarizer.main(os.path.join(csv_dir, 'engine_aggregated_game_data.csv'),
+                                                        stats_dir, headless=True), stats_dir),
+        ('player_stats', lambda: csv_to_player_stats.main(
+            os.path.join(csv_dir, 'engine_aggregated_game_data_merged_engines.csv'), player_stats_dir),
+         player_stats_dir)
+    ]
+
+# Function to define the benchmarks of the hot functions, run on the games of the corrected PGN file
+def get_function_benchmarks(work_dir):
+    corrected_pgn = os.path.join(work_dir, 'corrected', 'games_corrected.pgn')
+    raw_pgn = os.path.join(work_dir, 'pgn', 'games.pgn')
+    with open(corrected_pgn) as pgn:
+        games = [(headers, analyzer.pawns_list_from_evals(evals)) for headers, evals in scan_games(pgn)]
+    pawns_lists = [pawns_list for headers, pawns_list in games]
+    results = [headers.get('Result') for headers, pawns_list in games]
+    with open(raw_pgn, 'rb') as f:
+        raw_bytes = f.read()
+
+    def run_scan():
+        with open(corrected_pgn) as pgn:
+            return sum(1 for _ in scan_games(pgn))
+
+    def run_batch_stats():
+        pawns, offsets = flatten_pawns_lists(pawns_lists)
+        return calculate_batch_stats(pawns, offsets, results)
+
+    return [
+        ('gi_and_gpl', lambda: [analyzer.gi_and_gpl(p, r) for p, r in zip(pawns_lists, results)]),
+        ('calculate_engine_vs_engine_GI',
+         lambda: [analyzer.calculate_engine_vs_engine_GI(p, r) for p, r in zip(pawns_lists, results)]),
+        ('calculate_acpl', lambda: [analyzer.calculate_acpl(p) for p in pawns_lists]),
+        ('calculate_batch_stats', run_batch_stats),
+        ('scan_games', run_scan),
+        ('correct_pgn_lines', lambda: sum(len(line) for line in eval_corrector_ccrl.correct_pgn_lines(
+            io.BytesIO(raw_bytes)))),
+        ('build_game_index', lambda: split_large_pgn.build_game_index(raw_bytes))
+    ]
+
+# Function to run the benchmarks. Returns the results: the settings of the synthetic data, the timings in seconds
+# and the hashes of the outputs of each stage.
+def run_benchmarks(work_dir, settings, repeat=3, verbose=False):
+    if os.path.exists(work_dir):
+        shutil.rmtree(work_dir)
+    pgn_path = os.path.join(work_dir, 'pgn', 'games.pgn')
+    timings = {}
+    timings['generate'], games = time_call(lambda: generate_ccrl_pgn(pgn_path, **settings), 1, verbose)
+    print(f"Generated {games} games ({os.path.getsize(pgn_path) / 1024 / 1024:.1f} MB) in {timings['generate']:.2f} s")
+    outputs = {}
+    for name, function, output_dir in get_benchmark_stages(work_dir):
+        timings[name], _ = time_call(function, repeat, verbose)
+        outputs[name] = hash_outputs(output_dir)
+        print(f"stage {name}: {timings[name]:.3f} s")
+    for name, function in get_function_benchmarks(work_dir):
+        timings[name], _ = time_call(function, repeat, verbose)
+        print(f"function {name}: {timings[name]:.3f} s")
+    return {'settings': settings, 'timings': timings, 'outputs': outputs}
+
+# Function to compare results against a baseline. Returns the list of problems found.
+def compare_with_baseline(results, baseline, tolerance):
+    if baseline['settings'] != results['settings']:
+        return [f"The baseline was run with other settings: {baseline['settings']}"]
+    problems = []
+    for name, seconds in results['timings'].items():
+        baseline_seconds = baseline['timings'].get(name)
+        if baseline_seconds is None or name == 'generate':
+            continue
+        change = seconds / baseline_seconds - 1 if baseline_seconds else 0
+        print(f"{name}: {baseline_seconds:.3f} s -> {seconds:.3f} s ({change:+.1%})")
+        if change > tolerance:
+            problems.append(f"{name} is {change:.1%} slower than the baseline")
+    for stage, hashes in results['outputs'].items():
+        baseline_hashes = baseline['outputs'].get(stage, {})
+        for file_name in sorted(set(hashes) | set(baseline_hashes)):
+            if hashes.get(file_name) != baseline_hashes.get(file_name):
+                problems.append(f"Output {stage}/{file_name} differs from the baseline")
+    return problems
+
+def main(work_dir, baseline_path, settings, repeat=3, tolerance=0.2, save_baseline=False, verbose=False):
+    results = run_benchmarks(work_dir, settings, repeat, verbose)
+    if save_baseline:
+        with open(baseline_path, 'w') as baseline_file:
+            json.dump(results, baseline_file, indent=4)
+        print(f"Baseline saved to {baseline_path}")
+        return 0
+    if not os.path.exists(baseline_path):
+        print(f"No baseline at {baseline_path}, run with --save-baseline first")
+        return 0
+    with open(baseline_path) as baseline_file:
+        baseline = json.load(baseline_file)
+    problems = compare_with_baseline(results, baseline, tolerance)
+    for problem in problems:
+        print(problem)
+    if not problems:
+        print("No regressions: all outputs are identical and all timings are within the tolerance")
+    return 1 if problems else 0
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(usage="python run_benchmarks.py [--work-dir DIR] [--baseline benchmark_baseline.json] [--save-baseline] [--games N | --target-size-mb MB] [--seed S] [--repeat N] [--tolerance T]")
+    parser.add_argument("--work-dir", default=os.path.join(tempfile.gettempdir(), "engine_vs_engine_benchmark"),
+                        help="directory for the synthetic data and the outputs; it is emptied first")
+    parser.add_argument("--baseline", default="benchmark_baseline.json", help="baseline to compare against or save")
+    parser.add_argument("--save-baseline", action="store_true", help="save the results as the baseline")
+    parser.add_argument("--games", type=int, default=5000, help="number of synthetic games")
+    parser.add_argument("--target-size-mb", type=float,
+                        help="generate games until the synthetic PGN file reaches this size instead of --games")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the synthetic games")
+    parser.add_argument("--min-plies", type=int, default=20, help="minimum length of the synthetic games")
+    parser.add_argument("--max-plies", type=int, default=160, help="maximum length of the synthetic games")
+    parser.add_argument("--mate-rate", type=float, default=0.005, help="probability that an eval is a mate score")
+    parser.add_argument("--book-plies", type=int, default=8, help="maximum number of book moves without evals")
+    parser.add_argument("--encoding", default="utf-8", help="encoding of the synthetic PGN file")
+    parser.add_argument("--repeat", type=int, default=3, help="number of runs of each benchmark; the fastest counts")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="relative slowdown over the baseline that is reported as a regression")
+    parser.add_argument("--verbose", action="store_true", help="show the output of the stages")
+    args = parser.parse_args()
+
+    settings = {'games': args.games, 'seed': args.seed, 'min_plies': args.min_plies, 'max_plies': args.max_plies,
+                'mate_rate': args.mate_rate, 'book_plies': args.book_plies, 'encoding': args.encoding}
+    if args.target_size_mb:
+        settings['target_size_mb'] = args.target_size_mb
+    sys.exit(main(args.work_dir, args.baseline, settings, args.repeat, args.tolerance, args.save_baseline,
+                  args.verbose))
@@ -0,0 +1,218 @@
+"""This script checks offline that the fast paths of the pipeline give the same results as the reference ones, on
+synthetic CCRL PGN files from generate_ccrl_pgn.py:
+- the batch metrics (batch_metrics.calculate_batch_stats) against calculate_acpl, gi_and_gpl and
+  calculate_engine_vs_engine_GI of the analyzer, game by game;
+- the player stats of the merged sketches of player_stats_sketch.py against the exact ones of csv_to_player_stats.py:
+  the game counts, sums, variances and standard deviations must match, and the medians must be within the rank error
+  of the t-digest;
+- the output of the analyzer with --workers and sharding, with --pipeline and on compressed (.gz and .bz2) copies of
+  the input against the output of a serial run;
+- the fast scanner and the text-level corrector against their python-chess (--validate) paths, on games that start
+  from a FEN with Black to move and have variations, comments over two lines and ; comments.
+Each problem found is printed, and the exit code is 1 if there is any.
+"""
+
+import argparse
+import bz2
+import contextlib
+import gzip
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import numpy as np
+import csv_to_player_stats
+import eval_corrector_ccrl
+import json_to_csv_converter
+import pgn_engine_vs_engine_eval_analyzer as analyzer
+from batch_metrics import calculate_batch_stats, flatten_pawns_lists
+from generate_ccrl_pgn import generate_ccrl_pgn
+from pgn_eval_scanner import scan_games
+from player_stats_sketch import SKETCH_STATS, TDIGEST_COMPRESSION, sketch_games, merge_sketches, player_stats_from_sketch
+
+# Tolerance of the stats that are computed in another order than the reference (sums of floats)
+FLOAT_TOLERANCE = 1e-9
+
+# Maximum distance between 0.5 and the rank of a median of a sketch among the games of its player, times the
+# compression of the sketch
+MEDIAN_RANK_TOLERANCE = 2
+
+# Number of rows of the game table in each sketch that is merged, and compressions of the sketches that are checked:
+# the default one and one low enough for the centroids of the players to be compressed when the sketches are merged
+SKETCH_CHUNK_ROWS = 250
+SKETCH_COMPRESSIONS = [TDIGEST_COMPRESSION, 50]
+
+# Probability of each PGN edge case of generate_ccrl_pgn (FEN start, variation, comment over two lines, ; comment) in
+# a synthetic game
+EDGE_CASE_RATE = 0.05
+
+# Function to run a function, hiding its output unless verbose
+def run_quietly(function, verbose=False):
+    output = contextlib.nullcontext() if verbose else contextlib.redirect_stdout(io.StringIO())
+    with output:
+        return function()
+
+# Function to check the batch metrics against the stats of the analyzer, game by game. Returns the problems found.
+def check_batch_metrics(pgn_path):
+    with open(pgn_path) as pgn:
+        games = [(headers, analyzer.pawns_list_from_evals(evals)) for headers, evals in scan_games(pgn)]
+    # calculate_engine_vs_engine_GI needs a move of each side after the first one to score unfinished games
+    games = [(headers, pawns_list) for headers, pawns_list in games if len(pawns_list) > 3]
+    pawns, offsets = flatten_pawns_lists([pawns_list for headers, pawns_list in games])
+    stats = calculate_batch_stats(pawns, offsets, [headers.get('Result') for headers, pawns_list in games])
+    problems = []
+    for index, (headers, pawns_list) in enumerate(games):
+        game_result = headers.get('Result')
+        expected = dict(zip(['white_acpl', 'black_acpl'], analyzer.calculate_acpl(pawns_list)))
+        expected.update(zip(['white_gi', 'black_gi', 'white_gpl', 'black_gpl', 'white_move_number', 'black_move_number'],
+                            analyzer.gi_and_gpl(pawns_list, game_result)))
+        expected.update(zip(['white_stcpl', 'black_stcpl', 'white_sgi', 'black_sgi', 'white_sgpl', 'black_sgpl'],
+                            analyzer.calculate_engine_vs_engine_GI(pawns_list, game_result)))
+        for name, value in expected.items():
+            if not np.isclose(stats[name][index], value, rtol=FLOAT_TOLERANCE, atol=FLOAT_TOLERANCE):
+                problems.append(f"batch metrics: {name} of game {index + 1} is {stats[name][index]}, expected {value}")
+    print(f"batch metrics: {len(games)} games checked, {len(problems)} problems")
+    return problems
+
+# Function to check the player stats of sketches of chunks of a game table, merged, against the exact player stats.
+# Returns the problems found.
+def check_sketch_merge(csv_path, compression=TDIGEST_COMPRESSION):
+    df = csv_to_player_stats.read_csv(csv_path, usecols=csv_to_player_stats.PLAYER_STATS_COLUMNS)
+    sketches = [sketch_games(df[start:start + SKETCH_CHUNK_ROWS], compression)
+                for start in range(0, len(df), SKETCH_CHUNK_ROWS)]
+    sketch = sketches[0]
+    for chunk_sketch in sketches[1:]:
+        sketch = merge_sketches(sketch, chunk_sketch)
+    exact = csv_to_player_stats.aggregate_player_stats(df).set_index('Player')
+    merged = player_stats_from_sketch(sketch).set_index('Player')
+    problems = []
+    if sorted(exact.index) != sorted(merged.index):
+        return [f"sketch merge: players {sorted(merged.index)}, expected {sorted(exact.index)}"]
+    merged = merged.loc[exact.index]
+    for column in exact.columns:
+        if column.endswith('_median'):
+            continue
+        if not np.allclose(merged[column].to_numpy(dtype=np.float64), exact[column].to_numpy(dtype=np.float64),
+                           rtol=FLOAT_TOLERANCE, atol=FLOAT_TOLERANCE):
+            problems.append(f"sketch merge: {column} differs from the exact player stats")
+    games, players = csv_to_player_stats.games_by_player(df)
+    tolerance = MEDIAN_RANK_TOLERANCE / compression
+    for stat in SKETCH_STATS:
+        if f'{stat}_median' not in exact.columns:
+            continue
+        for player_index, player in enumerate(players):
+            values = np.sort(np.nan_to_num(games[stat].to_numpy(dtype=np.float64)[games['Player'] == player_index]))
+            median = merged.loc[player, f'{stat}_median']
+            # Fractions of the games below and up to the median
+            low = np.searchsorted(values, median, 'left') / len(values)
+            high = np.searchsorted(values, median, 'right') / len(values)
+            if not low - tolerance <= 0.5 <= high + tolerance:
+                problems.append(f"sketch merge: the {stat} median of {player} has rank {low:.3f}-{high:.3f} "
+                                f"with compression {compression}")
+    print(f"sketch merge: {len(sketches)} sketches of {len(exact)} players with compression {compression} checked, "
+          f"{len(problems)} problems")
+    return problems
+
+# Function to read the games of the output files of the analyzer as {file name: list of games}. The keys of the games
+# are not compared, only their order.
+def read_analyzer_output(output_dir):
+    outputs = {}
+    for file_name in sorted(os.listdir(output_dir)):
+        if file_name.endswith('.json') and file_name != 'analyzer_manifest.json':
+            with open(os.path.join(output_dir, file_name)) as json_file:
+                outputs[file_name] = list(json.load(json_file).values())
+    return outputs
+
+# Function to compress copies of the PGN files of a directory with gzip and bz2, alternately
+def compress_pgn_files(pgn_dir, compressed_dir):
+    os.makedirs(compressed_dir)
+    for index, file_name in enumerate(sorted(os.listdir(pgn_dir))):
+        extension, open_compressed = ('.gz', gzip.open) if index % 2 == 0 else ('.bz2', bz2.open)
+        with open(os.path.join(pgn_dir, file_name), 'rb') as pgn_file, \
+                open_compressed(os.path.join(compressed_dir, file_name + extension), 'wb') as compressed_file:
+            shutil.copyfileobj(pgn_file, compressed_file)
+
+# Function to check that the analyzer writes the same games with workers and shards, with the pipeline, from
+# compressed files, with --validate and from the files corrected with eval_corrector_ccrl.py --validate as in a serial
+# run of the files corrected by the text-level corrector, and the same games from the raw CCRL files with --ccrl with
+# and without --validate. Returns the problems found.
+def check_analyzer_modes(raw_dir, pgn_dir, work_dir, workers=2, verbose=False):
+    compressed_dir = os.path.join(work_dir, 'compressed')
+    compress_pgn_files(pgn_dir, compressed_dir)
+    validated_pgn_dir = os.path.join(work_dir, 'corrected_validate')
+    run_quietly(lambda: eval_corrector_ccrl.main(raw_dir, validated_pgn_dir, validate=True), verbose)
+    # (name, input directory, options of the analyzer, run whose output it must match)
+    runs = [
+        ('serial', pgn_dir, {}, None),
+        ('workers', pgn_dir, {'workers': workers, 'shard_size_mb': 1}, 'serial'),
+        ('pipeline', pgn_dir, {'workers': workers, 'shard_size_mb': 1, 'pipeline': True}, 'serial'),
+        ('pipeline_serial', pgn_dir, {'pipeline': True}, 'serial'),
+        ('compressed', compressed_dir, {'workers': workers}, 'serial'),
+        ('validate', pgn_dir, {'workers': workers, 'validate': True}, 'serial'),
+        ('corrected_validate', validated_pgn_dir, {'workers': workers}, 'serial'),
+        ('ccrl', raw_dir, {'workers': workers, 'ccrl': True}, None),
+        ('ccrl_validate', raw_dir, {'workers': workers, 'ccrl': True, 'validate': True}, 'ccrl'),
+    ]
+    outputs = {}
+    for name, input_dir, options, reference_name in runs:
+        output_dir = os.path.join(work_dir, f'json_{name}')
+        run_quietly(lambda: analyzer.main(input_dir, output_dir, force=True, **options), verbose)
+        outputs[name] = read_analyzer_output(output_dir)
+    problems = []
+    for name, input_dir, options, reference_name in runs:
+        if reference_name is None:
+            continue
+        output, reference = outputs[name], outputs[reference_name]
+        if sorted(output) != sorted(reference):
+            problems.append(f"analyzer {name}: files {sorted(output)}, expected {sorted(reference)}")
+            continue
+        for file_name, games in output.items():
+            if games != reference[file_name]:
+                problems.append(f"analyzer {name}: {file_name} differs from the {reference_name} run")
+    print(f"analyzer: {sum(1 for run in runs if run[3])} modes checked against a reference run "
+          f"({sum(len(games) for games in outputs['serial'].values())} games), {len(problems)} problems")
+    return problems
+
+# Function to run the checks. Returns the problems found.
+def run_regression_checks(work_dir, target_size_mb=3, seed=0, workers=2, verbose=False):
+    if os.path.exists(work_dir):
+        shutil.rmtree(work_dir)
+    raw_dir = os.path.join(work_dir, 'pgn')
+    pgn_dir = os.path.join(work_dir, 'corrected')
+    csv_dir = os.path.join(work_dir, 'csv')
+    # Two files, so that both a .gz and a .bz2 copy are analyzed
+    games = sum(generate_ccrl_pgn(os.path.join(raw_dir, f'games{index + 1}.pgn'), seed=seed + index,
+                                  target_size_mb=target_size_mb / 2, edge_case_rate=EDGE_CASE_RATE)
+                for index in range(2))
+    print(f"Generated {games} games")
+    run_quietly(lambda: eval_corrector_ccrl.main(raw_dir, pgn_dir), verbose)
+    problems = []
+    for file_name in sorted(os.listdir(pgn_dir)):
+        problems += check_batch_metrics(os.path.join(pgn_dir, file_name))
+    problems += check_analyzer_modes(raw_dir, pgn_dir, work_dir, workers, verbose)
+    run_quietly(lambda: json_to_csv_converter.main(os.path.join(work_dir, 'json_serial'), csv_dir), verbose)
+    for compression in SKETCH_COMPRESSIONS:
+        problems += check_sketch_merge(os.path.join(csv_dir, 'engine_aggregated_game_data.csv'), compression)
+    return problems
+
+def main(work_dir, target_size_mb=3, seed=0, workers=2, verbose=False):
+    problems = run_regression_checks(work_dir, target_size_mb, seed, workers, verbose)
+    for problem in problems:
+        print(problem)
+    if not problems:
+        print("No regressions: the fast paths give the same results as the reference ones")
+    return 1 if problems else 0
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(usage="python run_regression_checks.py [--work-dir DIR] [--target-size-mb MB] [--seed S] [--workers N] [--verbose]")
+    parser.add_argument("--work-dir", default=os.path.join(tempfile.gettempdir(), "engine_vs_engine_regression"),
+                        help="directory for the synthetic data and the outputs; it is emptied first")
+    parser.add_argument("--target-size-mb", type=float, default=3, help="size of the synthetic PGN file")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the synthetic games")
+    parser.add_argument("--workers", type=int, default=2, help="number of worker processes of the analyzer runs")
+    parser.add_argument("--verbose", action="store_true", help="show the output of the stages")
+    args = parser.parse_args()
+
+    sys.exit(main(args.work_dir, args.target_size_mb, args.seed, args.workers, args.verbose))
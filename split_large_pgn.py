@@ -1,63 +1,199 @@
-# Function to split a large PGN file into smaller files based on size and content
+# Function to split a large PGN file into smaller files based on size or number of games.
+# The input file is memory-mapped and the byte offsets of its games are found in a single pass. The offsets can
+# also be saved as a sidecar index, so that other stages can seek to game N without splitting the file.
+# Compressed PGN files (.pgn.gz, .pgn.bz2, .pgn.xz, .pgn.zst) are decompressed as a stream and split game by game
+# into the same files as their decompressed content; they cannot have an index.
 
 import os
-import chardet
-
-# Function to detect the character encoding of a file
-def detect_encoding(file_path):
-    with open(file_path, 'rb') as file:
-        raw_data = file.read(150000)  # Read the first 150,000 bytes to guess the encoding
-        result = chardet.detect(raw_data)
-        return result['encoding']
-
-def find_last_complete_game(buffer):
-    last_valid_result_index = max(buffer.rfind(b" 1-0"), buffer.rfind(b" 0-1"), buffer.rfind(b" 1/2-1/2"))
-    if last_valid_result_index == -1:
-        return -1
-    end_of_game_index = buffer.find(b"\n", last_valid_result_index)
-    return end_of_game_index if end_of_game_index != -1 else last_valid_result_index
-
-def split_pgn_file(input_file_path, output_directory, max_file_size_mb):
-    if not os.path.exists(output_directory):
-        os.makedirs(output_directory)
+import re
+import mmap
+import argparse
+import numpy as np
+from compressed_pgn import open_pgn, is_compressed
 
-    max_file_size = max_file_size_mb * 1024 * 1024  # Convert MB to Bytes
-    file_counter = 1
-    buffer = b""
-    encoding = detect_encoding(input_file_path)
+# A game starts with a tag pair after an empty line
+GAME_START_REGEX = re.compile(rb'\n[ \t\r]*\n(?=\[[A-Za-z0-9][A-Za-z0-9_+#=:-]*\s+")')
 
-    with open(input_file_path, 'rb') as file:  # Open in binary mode
-        while True:
-            chunk = file.read(1024 * 1024)  # Read 1MB chunk at a time
-            if not chunk and not buffer:  # End of file
+# Suffix of the sidecar index of a PGN file
+INDEX_SUFFIX = '.idx.npy'
+
+# Number of bytes decompressed at a time when splitting a compressed PGN file
+STREAM_CHUNK_SIZE = 16 * 1024 * 1024
+
+# Number of bytes at the end of the decompressed data in which game starts are not searched until more data is read,
+# so that a game start is never cut by a chunk boundary
+STREAM_LOOKAHEAD = 256
+
+# Function to find the byte offsets of the games of a PGN file (a bytes-like object such as an mmap). Returns
+# an array with the start of each game followed by the size of the file, so game n is data[offsets[n]:offsets[n + 1]].
+def build_game_index(data):
+    starts = [0]
+    for match in GAME_START_REGEX.finditer(data):
+        # Empty lines before the first game belong to it
+        if len(starts) == 1 and not data[:match.end()].strip():
+            continue
+        starts.append(match.end())
+    starts.append(len(data))
+    return np.array(starts, dtype=np.int64)
+
+# Function to open a PGN file as a read-only memory map, or None if the file is empty
+def open_pgn_mmap(file):
+    if os.fstat(file.fileno()).st_size == 0:
+        return None
+    return mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+# Function to read the games of a PGN stream (e.g. a decompressed file) one by one, as bytes. The games are the same
+# as the ones of build_game_index on the whole data.
+def iter_game_bytes(stream, chunk_size=STREAM_CHUNK_SIZE):
+    buffer = b""
+    first_game = True
+    scan_start = 0
+    while True:
+        chunk = stream.read(chunk_size)
+        buffer += chunk
+        scan_end = len(buffer) - STREAM_LOOKAHEAD if chunk else len(buffer)
+        game_start = 0
+        for match in GAME_START_REGEX.finditer(buffer, scan_start):
+            if match.end() > scan_end:
                 break
+            scan_start = match.end()
+            # Empty lines before the first game belong to it
+            if first_game and not buffer[:match.end()].strip():
+                continue
+            first_game = False
+            yield buffer[game_start:match.end()]
+            game_start = match.end()
+        buffer = buffer[game_start:]
+        scan_start -= game_start
+        if not chunk:
+            break
+    if buffer:
+        yield buffer
 
-            buffer += chunk
+def get_index_path(pgn_file_path):
+    return pgn_file_path + INDEX_SUFFIX
 
-            if len(buffer) >= max_file_size:
-                split_index = find_last_complete_game(buffer)
+# Function to build the game index of a PGN file and save it next to the file
+def write_game_index(pgn_file_path):
+    if is_compressed(pgn_file_path):
+        raise ValueError(f"{pgn_file_path} is compressed; only uncompressed PGN files can be indexed")
+    with open(pgn_file_path, 'rb') as file:
+        mm = open_pgn_mmap(file)
+        offsets = build_game_index(mm) if mm is not None else np.array([0], dtype=np.int64)
+        if mm is not None:
+            mm.close()
+    np.save(get_index_path(pgn_file_path), offsets)
+    return offsets
 
-                if split_index != -1:
-                    # Write the complete games to a new file
-                    with open(os.path.join(output_directory, f'games{file_counter}.pgn'), 'wb') as current_file:
-                        current_file.write(buffer[:split_index + 1])
-                    buffer = buffer[split_index + 1:]
-                    # Remove leading whitespaces (including newline) from the new buffer
-                    buffer = buffer.lstrip(b' \t\r\n')
-                else:
-                    # In case no complete game is found, increase buffer size
-                    continue
+# Function to load the sidecar index of a PGN file. Returns None if there is no index or if it does not match
+# the size of the file, e.g. because games were appended after the index was written.
+def load_game_index(pgn_file_path):
+    index_path = get_index_path(pgn_file_path)
+    if not os.path.exists(index_path) or os.path.getmtime(index_path) < os.path.getmtime(pgn_file_path):
+        return None
+    offsets = np.load(index_path)
+    if len(offsets) == 0 or offsets[-1] != os.path.getsize(pgn_file_path):
+        return None
+    return offsets
 
-                file_counter += 1
+# Function to read the bytes of game n of a PGN file using its index
+def read_game_bytes(pgn_file_path, offsets, n):
+    with open(pgn_file_path, 'rb') as file:
+        file.seek(offsets[n])
+        return file.read(offsets[n + 1] - offsets[n])
+
+# Function to choose the (start, end) byte ranges of the output files: at most max_file_size bytes each (but at
+# least one game), or games_per_file games each
+def plan_shards(offsets, max_file_size=None, games_per_file=None):
+    if games_per_file:
+        boundaries = list(offsets[::games_per_file])
+        if boundaries[-1] != offsets[-1]:
+            boundaries.append(offsets[-1])
+        return list(zip(boundaries, boundaries[1:]))
+    shards = []
+    start_game = 0
+    n_games = len(offsets) - 1
+    while start_game < n_games:
+        end_game = int(np.searchsorted(offsets, offsets[start_game] + max_file_size, side='right')) - 1
+        end_game = min(max(end_game, start_game + 1), n_games)
+        shards.append((offsets[start_game], offsets[end_game]))
+        start_game = end_game
+    return shards
+
+# Function to split a stream of games into files of at most max_file_size bytes (but at least one game) or of
+# games_per_file games, as plan_shards does for the offsets of a whole file
+def split_pgn_stream(stream, output_directory, max_file_size=None, games_per_file=None):
+    current_file = None
+    file_counter = 0
+    games_in_file = 0
+    bytes_in_file = 0
+    for game in iter_game_bytes(stream):
+        if current_file is None or (games_per_file and games_in_file == games_per_file) or \
+                (not games_per_file and bytes_in_file + len(game) > max_file_size):
+            if current_file is not None:
+                current_file.close()
                 print("file_counter: ", file_counter)
+            file_counter += 1
+            current_file = open(os.path.join(output_directory, f'games{file_counter}.pgn'), 'wb')
+            games_in_file = 0
+            bytes_in_file = 0
+        current_file.write(game)
+        games_in_file += 1
+        bytes_in_file += len(game)
+    if current_file is not None:
+        current_file.close()
+        print("file_counter: ", file_counter)
 
-    # Write remaining buffer to file, if any
-    if buffer:
-        with open(os.path.join(output_directory, f'games{file_counter}.pgn'), 'wb') as current_file:
-            current_file.write(buffer)
+def split_pgn_file(input_file_path, output_directory, max_file_size_mb=100, games_per_file=None, write_index=False):
+    if write_index and is_compressed(input_file_path):
+        raise ValueError(f"{input_file_path} is compressed; only uncompressed PGN files can be indexed")
+    if not os.path.exists(output_directory):
+        os.makedirs(output_directory)
+
+    max_file_size = max_file_size_mb * 1024 * 1024  # Convert MB to Bytes
+
+    if is_compressed(input_file_path):
+        with open_pgn(input_file_path) as stream:
+            split_pgn_stream(stream, output_directory, max_file_size, games_per_file)
+        return
+
+    with open(input_file_path, 'rb') as file:  # Open in binary mode
+        mm = open_pgn_mmap(file)
+        if mm is None:
+            return
+        offsets = build_game_index(mm)
+        if write_index:
+            np.save(get_index_path(input_file_path), offsets)
+        view = memoryview(mm)
+        # Write the games of each shard without copying them into Python objects
+        for file_counter, (start, end) in enumerate(plan_shards(offsets, max_file_size, games_per_file), 1):
+            with open(os.path.join(output_directory, f'games{file_counter}.pgn'), 'wb') as current_file:
+                current_file.write(view[start:end])
+            print("file_counter: ", file_counter)
+        view.release()
+        mm.close()
 
 if __name__ == "__main__":
-    input_file_path = ''
-    output_directory = ''
-    max_file_size_mb = 100
-    split_pgn_file(input_file_path, output_directory, max_file_size_mb)
+    parser = argparse.ArgumentParser(usage="python split_large_pgn.py <input_file_path (.pgn, .pgn.gz, .pgn.bz2, .pgn.xz or .pgn.zst)> [<output_directory>] [--max-file-size-mb MB | --games-per-file N] [--write-index | --index-only]")
+    parser.add_argument("input_file_path")
+    parser.add_argument("output_directory", nargs="?", default="")
+    parser.add_argument("--max-file-size-mb", type=int, default=100,
+                        help="approximate maximum size of the output files")
+    parser.add_argument("--games-per-file", type=int,
+                        help="split by number of games instead of size")
+    parser.add_argument("--write-index", action="store_true",
+                        help="also save the game offsets next to the input file")
+    parser.add_argument("--index-only", action="store_true",
+                        help="only save the game offsets next to the input file, without splitting it")
+    args = parser.parse_args()
+    if (args.index_only or args.write_index) and is_compressed(args.input_file_path):
+        parser.error("--write-index and --index-only require an uncompressed PGN file")
+
+    if args.index_only:
+        offsets = write_game_index(args.input_file_path)
+        print(f"Indexed {len(offsets) - 1} games in {get_index_path(args.input_file_path)}")
+    else:
+        if not args.output_directory:
+            parser.error("output_directory is required unless --index-only is given")
+        split_pgn_file(args.input_file_path, args.output_directory, args.max_file_size_mb, args.games_per_file,
+                       args.write_index)
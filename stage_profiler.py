@@ -0,0 +1,148 @@
+"""This script holds the opt-in instrumentation of the analyzer, the corrector and the converters. For each input file
+a record with the time spent in each phase, the number of games and plies, the bytes read and written, the rates and
+the peak RSS is appended to a JSON Lines report (--profile-report). The hot loop of each file can also be captured
+with cProfile (--profiler cprofile, saved as .prof files next to the report) or pyinstrument (--profiler pyinstrument,
+saved as .html files; pyinstrument must be installed).
+The rates are per second spent in the phases of the file, so they do not depend on how many files or shards ran in
+parallel. When profiling is off the records are None and every function here does nothing.
+"""
+
+import cProfile
+import importlib.util
+import json
+import os
+import resource
+import sys
+import time
+from contextlib import contextmanager
+
+PROFILERS = ["cprofile", "pyinstrument"]
+
+# Function to get the profiling options that are passed to the stages (and to their worker processes), or None if
+# profiling is off
+def get_profile_options(report_path=None, profiler=None):
+    if not report_path:
+        return None
+    if profiler == "pyinstrument" and importlib.util.find_spec("pyinstrument") is None:
+        raise ImportError("pyinstrument is required for --profiler pyinstrument, install it with: pip install pyinstrument")
+    return {"report_path": report_path, "profiler": profiler}
+
+# Function to reset the peak RSS of the process, so that the peak of each file can be measured. Only Linux can reset
+# it; elsewhere the peak of the whole process is reported.
+def reset_peak_rss():
+    try:
+        with open("/proc/self/clear_refs", "w") as clear_refs:
+            clear_refs.write("5")
+    except OSError:
+        pass
+
+# Function to get the peak RSS of the process in bytes, since the last reset_peak_rss on Linux
+def get_peak_rss():
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    return max_rss if sys.platform == "darwin" else max_rss * 1024
+
+# Function to start the record of a file, or None if profiling is off
+def new_record(profile_options, stage, file_path):
+    if profile_options is None:
+        return None
+    reset_peak_rss()
+    return {"stage": stage, "file": file_path, "timestamp": time.time(), "phases": {}, "games": 0, "plies": 0,
+            "bytes_read": 0, "bytes_written": 0, "peak_rss_bytes": 0}
+
+# Function to measure the time spent in a phase of a file
+@contextmanager
+def phase(record, name):
+    if record is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_phase_time(record, name, time.perf_counter() - start)
+
+def add_phase_time(record, name, seconds):
+    if record is not None:
+        record["phases"][name] = record["phases"].get(name, 0.0) + seconds
+
+# Function to add to the counters of a record (games, plies, bytes_read and bytes_written)
+def add_counts(record, **counts):
+    if record is not None:
+        for name, count in counts.items():
+            record[name] += count
+
+# Function to add the record of a shard of a file (e.g. from a worker process) to the record of the file
+def merge_record(record, shard_record):
+    if record is None or shard_record is None:
+        return
+    for name, seconds in shard_record["phases"].items():
+        add_phase_time(record, name, seconds)
+    add_counts(record, games=shard_record["games"], plies=shard_record["plies"],
+               bytes_read=shard_record["bytes_read"], bytes_written=shard_record["bytes_written"])
+    record["peak_rss_bytes"] = max(record["peak_rss_bytes"], shard_record["peak_rss_bytes"])
+
+# Function to complete a record with the total time of its phases, the rates and the peak RSS
+def finish_record(record):
+    if record is None:
+        return None
+    seconds = record["seconds"] = sum(record["phases"].values())
+    record["peak_rss_bytes"] = max(record["peak_rss_bytes"], get_peak_rss())
+    record["games_per_sec"] = record["games"] / seconds if seconds else None
+    record["plies_per_sec"] = record["plies"] / seconds if seconds else None
+    record["read_mb_per_sec"] = record["bytes_read"] / 1024 / 1024 / seconds if seconds else None
+    return record
+
+# Function to append a finished record to the JSON Lines report
+def write_record(profile_options, record):
+    if profile_options is None or record is None:
+        return
+    finish_record(record)
+    with open(profile_options["report_path"], "a") as report:
+        report.write(json.dumps(record) + "\n")
+
+# Function to append the queue metrics of a pipelined run (see pipeline_queues.py) to the JSON Lines report
+def write_pipeline_record(profile_options, input_path, queues):
+    if profile_options is None:
+        return
+    record = {"stage": "pipeline", "file": input_path, "timestamp": time.time(), "queues": queues}
+    with open(profile_options["report_path"], "a") as report:
+        report.write(json.dumps(record) + "\n")
+
+# Function to capture a profile of the code run inside it with the profiler of the options, if any. The profile is
+# saved next to the report, named after the stage, the file and the start of the shard.
+@contextmanager
+def capture_profile(profile_options, stage, file_path, start=0):
+    if profile_options is None or not profile_options["profiler"]:
+        yield
+        return
+    output_path = f"{os.path.splitext(profile_options['report_path'])[0]}.{stage}.{os.path.basename(file_path)}.{start}"
+    if profile_options["profiler"] == "pyinstrument":
+        import pyinstrument
+        profiler = pyinstrument.Profiler()
+        profiler.start()
+        try:
+            yield
+        finally:
+            profiler.stop()
+            with open(output_path + ".html", "w") as html_file:
+                html_file.write(profiler.output_html())
+    else:
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            profiler.dump_stats(output_path + ".prof")
+
+# Function to get the size of a file, or 0 if it does not exist
+def file_size(file_path):
+    return os.path.getsize(file_path) if file_path and os.path.exists(file_path) else 0